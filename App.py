@@ -1,17 +1,214 @@
 # app1_complete_full_features.py - 带126邮箱验证的完整功能记账本
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
 import plotly.express as px
 import plotly.graph_objects as go
 import json
 import os
+import sqlite3
+import copy
 import hashlib
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import secrets
 import re
+import io
+import sys
+import argparse
+import functools
+import queue
+import threading
+import time
+import heapq
+import concurrent.futures
+import contextlib
+import itertools
+import collections
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+try:
+    import openpyxl
+except ImportError:  # 未安装 openpyxl 时只提供 CSV 导出
+    openpyxl = None
+
+# 各会话共享同一份交易表、修改时各自复制，依赖 pandas 的写时复制（pandas 3 起默认开启）
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+try:
+    import fcntl
+except ImportError:  # Windows 上没有 fcntl，只在进程内加锁
+    fcntl = None
+
+
+def open_smtp_connection(config):
+    """按配置建立并登录SMTP连接（未配置密码时不登录，用于无需认证的本地中继）"""
+    if config.get("use_ssl", False):
+        server = smtplib.SMTP_SSL(config["smtp_server"], config["smtp_port"], timeout=30)
+    else:
+        server = smtplib.SMTP(config["smtp_server"], config["smtp_port"], timeout=30)
+        if config.get("enable_tls", False):
+            server.starttls()
+
+    if config.get("sender_password"):
+        server.login(config["sender_email"], config["sender_password"])
+    return server
+
+
+class MailJob:
+    """一次邮件发送（或连接测试）任务的句柄，界面可轮询其状态"""
+
+    def __init__(self, config, message=None):
+        self.id = secrets.token_hex(8)
+        self.config = config
+        self.message = message  # None 表示只测试连接
+        self.status = "排队中"  # 排队中 / 发送中 / 等待重试 / 已完成 / 失败
+        self.attempts = 0
+        self.error = ""
+        self.finished = threading.Event()
+
+    @property
+    def done(self):
+        return self.finished.is_set()
+
+    @property
+    def ok(self):
+        return self.status == "已完成"
+
+    def wait(self, timeout=None):
+        """等待任务结束，返回是否成功"""
+        self.finished.wait(timeout)
+        return self.ok
+
+
+class MailDeliveryWorker:
+    """后台发送邮件：有界队列、复用已登录的SMTP连接，失败时按指数退避重试"""
+    QUEUE_SIZE = 100
+    IDLE_TIMEOUT = 60  # 连接空闲超过该秒数即关闭，下次发送时重新连接
+    MAX_ATTEMPTS = 3
+    BACKOFF_BASE = 1.0  # 第 n 次重试前等待 BACKOFF_BASE * 2**(n-1) 秒
+    PERMANENT_ERRORS = (smtplib.SMTPAuthenticationError, smtplib.SMTPNotSupportedError,
+                        smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused)  # 重试也不会成功的错误
+
+    def __init__(self, connect=open_smtp_connection):
+        self.connect = connect
+        self.queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.server = None
+        self.server_config = None
+        self.last_used = 0.0
+        self.thread = threading.Thread(target=self.run, name="mail-delivery", daemon=True)
+        self.thread.start()
+
+    def submit(self, config, message=None):
+        """加入发送队列并立即返回任务句柄；队列已满时任务直接失败"""
+        job = MailJob(dict(config), message)
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            self.finish(job, "失败", "邮件队列已满，请稍后再试")
+        return job
+
+    def run(self):
+        while True:
+            try:
+                job = self.queue.get(timeout=self.IDLE_TIMEOUT)
+            except queue.Empty:
+                self.close()
+                continue
+            self.deliver(job)
+            self.queue.task_done()
+
+    def deliver(self, job):
+        while True:
+            job.attempts += 1
+            job.status = "发送中"
+            try:
+                server = self.connection(job.config)
+                if job.message is not None:
+                    server.send_message(job.message)
+                self.last_used = time.monotonic()
+                self.finish(job, "已完成")
+                return
+            except Exception as e:
+                self.close()
+                if isinstance(e, self.PERMANENT_ERRORS) or job.attempts >= self.MAX_ATTEMPTS:
+                    self.finish(job, "失败", str(e))
+                    return
+                job.status = "等待重试"
+                job.error = str(e)
+                time.sleep(self.BACKOFF_BASE * 2 ** (job.attempts - 1))
+
+    def connection(self, config):
+        """返回可用的已登录连接：配置变化或空闲过久时重连，复用前先用 NOOP 确认连接仍然有效"""
+        if self.server is not None and (
+                config != self.server_config or time.monotonic() - self.last_used > self.IDLE_TIMEOUT):
+            self.close()
+
+        if self.server is not None:
+            try:
+                if self.server.noop()[0] != 250:
+                    self.close()
+            except (smtplib.SMTPException, OSError):
+                self.close()
+
+        if self.server is None:
+            self.server = self.connect(config)
+            self.server_config = config
+            self.last_used = time.monotonic()
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+    def finish(self, job, status, error=""):
+        job.status = status
+        job.error = error
+        job.finished.set()
+
+
+@st.cache_resource
+def get_mail_worker():
+    """进程内共享的邮件发送线程（跨会话、跨重跑复用）"""
+    return MailDeliveryWorker()
+
+
+def show_mail_jobs(jobs, failure_help=None):
+    """显示邮件任务的发送状态，jobs 为 (说明, 任务) 列表；有任务未完成时每2秒自动刷新，全部完成后不再刷新"""
+    if any(not job.done for _, job in jobs):
+        poll_mail_jobs(jobs, failure_help)
+    else:
+        render_mail_jobs(jobs, failure_help)
+
+
+@st.fragment(run_every=2)
+def poll_mail_jobs(jobs, failure_help=None):
+    """每2秒刷新一次任务状态；全部完成后整页重跑一次，换成不再刷新的最终状态"""
+    render_mail_jobs(jobs, failure_help)
+    if all(job.done for _, job in jobs):
+        st.rerun()
+
+
+def render_mail_jobs(jobs, failure_help=None):
+    """显示各邮件任务的当前状态；有任务失败时附上 failure_help"""
+    for label, job in jobs:
+        if not job.done:
+            retry_note = f"（第{job.attempts}次失败: {job.error}）" if job.status == "等待重试" else ""
+            st.info(f"📧 {label}: {job.status}{retry_note}")
+        elif job.ok:
+            st.success(f"✅ {label}: 成功")
+        else:
+            st.error(f"❌ {label}: 失败 - {job.error}")
+
+    if failure_help and any(job.done and not job.ok for _, job in jobs):
+        st.error(failure_help)
 
 
 class EmailManager:
@@ -62,67 +259,330 @@ class EmailManager:
         return True
 
     def test_connection(self):
-        """测试邮箱连接"""
-        try:
-            if self.smtp_config.get("use_ssl", False):
-                # 使用SSL连接
-                server = smtplib.SMTP_SSL(self.smtp_config["smtp_server"], self.smtp_config["smtp_port"])
-            else:
-                server = smtplib.SMTP(self.smtp_config["smtp_server"], self.smtp_config["smtp_port"])
-                if self.smtp_config["enable_tls"]:
-                    server.starttls()
-
-            server.login(self.smtp_config["sender_email"], self.smtp_config["sender_password"])
-            server.quit()
-            return True, "邮箱连接测试成功"
-        except Exception as e:
-            return False, f"邮箱连接测试失败: {str(e)}"
+        """测试邮箱连接（在后台进行），返回可轮询的任务"""
+        return get_mail_worker().submit(self.smtp_config)
 
     def send_reset_email(self, recipient_email, reset_token, username):
-        """发送密码重置邮件"""
+        """发送密码重置邮件（加入后台发送队列），返回可轮询的任务"""
+        # 创建邮件内容
+        subject = "智能记账本 - 密码重置请求"
+
+        body = f"""
+        <html>
+        <body>
+            <h2>智能记账本 - 密码重置请求</h2>
+            <p>尊敬的 {username}，</p>
+            <p>我们收到了您的密码重置请求。请使用以下验证码来完成密码重置：</p>
+            <div style="background-color: #f0f0f0; padding: 15px; border-radius: 5px; text-align: center; font-size: 24px; font-weight: bold; margin: 20px 0;">
+                {reset_token}
+            </div>
+            <p><strong>注意：</strong>该验证码在30分钟内有效，如非本人操作请忽略此邮件。</p>
+            <hr>
+            <p style="color: #666; font-size: 12px;">此为系统自动发送邮件，请勿回复。</p>
+        </body>
+        </html>
+        """
+
+        # 创建邮件
+        msg = MIMEMultipart()
+        msg['From'] = self.smtp_config.get("sender_email", "")
+        msg['To'] = recipient_email
+        msg['Subject'] = subject
+        msg.attach(MIMEText(body, 'html'))
+
+        return get_mail_worker().submit(self.smtp_config, msg)
+
+    def send_budget_digest(self, recipient_email, username, alerts):
+        """把一批预算提醒合并为一封邮件发送（加入后台发送队列），返回可轮询的任务"""
+        subject = f"智能记账本 - 预算提醒汇总（{len(alerts)} 条）"
+
+        rows = "".join(
+            f"<tr><td>{alert['月份']}</td><td>{alert['类别']}</td><td>{alert['阈值']}%</td>"
+            f"<td>{alert['已用金额']:,.2f} / {alert['预算金额']:,.2f} {alert['币种']}</td><td>{alert['时间']}</td></tr>"
+            for alert in alerts
+        )
+        body = f"""
+        <html>
+        <body>
+            <h2>智能记账本 - 预算提醒汇总</h2>
+            <p>尊敬的 {username}，以下预算的使用率达到了提醒阈值：</p>
+            <table border="1" cellpadding="6" style="border-collapse: collapse;">
+                <tr><th>月份</th><th>类别</th><th>阈值</th><th>已用 / 预算</th><th>时间</th></tr>
+                {rows}
+            </table>
+            <hr>
+            <p style="color: #666; font-size: 12px;">此为系统自动发送邮件，请勿回复。可在应用侧边栏的预算提醒中关闭每日邮件汇总。</p>
+        </body>
+        </html>
+        """
+
+        msg = MIMEMultipart()
+        msg['From'] = self.smtp_config.get("sender_email", "")
+        msg['To'] = recipient_email
+        msg['Subject'] = subject
+        msg.attach(MIMEText(body, 'html'))
+
+        return get_mail_worker().submit(self.smtp_config, msg)
+
+
+class UserDirectory:
+    """用户目录：内存中按用户名和邮箱索引用户信息，供所有会话共享
+
+    登录时间只追加写入登录日志，登录过程中不会重写 users.json；
+    注册、重置密码等需要写 users.json 时再把日志合并进去。
+    """
+
+    def __init__(self, users_file="users.json", login_log_file="login_log.jsonl"):
+        self.users_file = users_file
+        self.login_log_file = login_log_file
+        self.lock = threading.Lock()
+        self.users = {}
+        self.emails = {}  # 邮箱（小写）-> 用户名
+        self.signature = None
+        self.log_offset = 0  # 登录日志已读取到的位置
+
+    @staticmethod
+    def email_key(email):
+        return email.strip().lower()
+
+    def file_signature(self):
         try:
-            # 创建邮件内容
-            subject = "智能记账本 - 密码重置请求"
-
-            body = f"""
-            <html>
-            <body>
-                <h2>智能记账本 - 密码重置请求</h2>
-                <p>尊敬的 {username}，</p>
-                <p>我们收到了您的密码重置请求。请使用以下验证码来完成密码重置：</p>
-                <div style="background-color: #f0f0f0; padding: 15px; border-radius: 5px; text-align: center; font-size: 24px; font-weight: bold; margin: 20px 0;">
-                    {reset_token}
-                </div>
-                <p><strong>注意：</strong>该验证码在30分钟内有效，如非本人操作请忽略此邮件。</p>
-                <hr>
-                <p style="color: #666; font-size: 12px;">此为系统自动发送邮件，请勿回复。</p>
-            </body>
-            </html>
-            """
-
-            # 创建邮件
-            msg = MIMEMultipart()
-            msg['From'] = self.smtp_config["sender_email"]
-            msg['To'] = recipient_email
-            msg['Subject'] = subject
-            msg.attach(MIMEText(body, 'html'))
-
-            # 发送邮件
-            if self.smtp_config.get("use_ssl", False):
-                server = smtplib.SMTP_SSL(self.smtp_config["smtp_server"], self.smtp_config["smtp_port"])
-            else:
-                server = smtplib.SMTP(self.smtp_config["smtp_server"], self.smtp_config["smtp_port"])
-                if self.smtp_config["enable_tls"]:
-                    server.starttls()
-
-            server.login(self.smtp_config["sender_email"], self.smtp_config["sender_password"])
-            server.send_message(msg)
-            server.quit()
+            stat = os.stat(self.users_file)
+            return stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            return None
 
-            return True, "密码重置邮件发送成功"
+    def refresh(self):
+        """users.json 被其他进程改动过时重新加载，再读入登录日志新追加的部分（调用方需持有锁）"""
+        signature = self.file_signature()
+        if signature != self.signature:
+            users = {}
+            if signature is not None:
+                with open(self.users_file, 'r', encoding='utf-8') as f:
+                    users = json.load(f)
+            self.users = users
+            self.log_offset = 0
+            self.emails = {self.email_key(info["email"]): username
+                           for username, info in users.items() if info.get("email")}
+            self.signature = signature
+        self.replay_login_log()
+
+    def replay_login_log(self):
+        """从上次读到的位置起应用登录日志中的完整行"""
+        try:
+            f = open(self.login_log_file, 'rb')
+        except FileNotFoundError:
+            self.log_offset = 0
+            return
+        with f:
+            if os.fstat(f.fileno()).st_size < self.log_offset:
+                self.log_offset = 0  # 日志已被合并进 users.json 并清空
+            f.seek(self.log_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # 写了一半的行，下次再读
+                self.log_offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("user") in self.users:
+                    self.users[entry["user"]]["last_login"] = entry["at"]
+
+    def get(self, username):
+        """按用户名查找用户信息，不存在时返回 None"""
+        with self.lock:
+            self.refresh()
+            return self.users.get(username)
+
+    def username_for_email(self, email):
+        """按邮箱查找用户名，不存在时返回 None"""
+        with self.lock:
+            self.refresh()
+            return self.emails.get(self.email_key(email))
+
+    def add(self, username, info):
+        with self.lock:
+            self.refresh()
+            self.users[username] = info
+            self.emails[self.email_key(info["email"])] = username
+            self.save()
+
+    def update(self, username, **fields):
+        with self.lock:
+            self.refresh()
+            self.users[username].update(fields)
+            self.save()
+
+    def record_login(self, username):
+        """记录登录时间：只追加一行日志"""
+        at = datetime.now().isoformat()
+        with self.lock:
+            with open(self.login_log_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"user": username, "at": at}, ensure_ascii=False) + '\n')
+            if username in self.users:
+                self.users[username]["last_login"] = at
+
+    def save(self):
+        """写回 users.json（合并登录日志后清空日志，调用方需持有锁）"""
+        self.replay_login_log()
+        tmp_file = self.users_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.users, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self.users_file)
+        open(self.login_log_file, 'w', encoding='utf-8').close()
+        self.signature = self.file_signature()
+        self.log_offset = 0
+
+
+
+@st.cache_resource
+def get_user_directory():
+    """进程内共享的用户目录"""
+    return UserDirectory()
+
+
+class ResetTokenStore:
+    """密码重置令牌存储：字典按令牌查找，最小堆按过期时间排序，供所有会话共享
+
+    新令牌和使用标记只追加写入日志，不再整体重写令牌文件；每次请求最多顺带清理
+    SWEEP_BATCH 个过期令牌，后台线程定期批量清理并把日志合并回令牌文件。
+    """
+    SWEEP_INTERVAL = 300  # 秒
+    SWEEP_BATCH = 100
+
+    def __init__(self, tokens_file="reset_tokens.json", log_file="reset_tokens.log"):
+        self.tokens_file = tokens_file
+        self.log_file = log_file
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.expiry = []  # (过期时间, 令牌) 最小堆
+        self.signature = None
+        self.sweeper = threading.Thread(target=self.sweep_forever, name="reset-token-sweep", daemon=True)
+        self.sweeper.start()
+
+    def file_signature(self):
+        signature = []
+        for path in (self.tokens_file, self.log_file):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def refresh(self):
+        """文件被其他进程改动过时重新加载（调用方需持有锁）"""
+        signature = self.file_signature()
+        if signature == self.signature:
+            return
 
-        except Exception as e:
-            return False, f"发送邮件失败: {str(e)}"
+        tokens = {}
+        if os.path.exists(self.tokens_file):
+            with open(self.tokens_file, 'r', encoding='utf-8') as f:
+                tokens = json.load(f)
+        if os.path.exists(self.log_file):
+            with open(self.log_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # 写了一半的行
+                    if entry["op"] == "add":
+                        tokens[entry["token"]] = entry["info"]
+                    elif entry["op"] == "use" and entry["token"] in tokens:
+                        tokens[entry["token"]].update(used=True, used_at=entry["used_at"])
+
+        self.tokens = tokens
+        self.expiry = [(datetime.fromisoformat(info["expires_at"]), token) for token, info in tokens.items()]
+        heapq.heapify(self.expiry)
+        self.signature = signature
+
+    def append(self, entry):
+        with open(self.log_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.signature = self.file_signature()
+
+    def add(self, token, info):
+        with self.lock:
+            self.refresh()
+            self.expire(self.SWEEP_BATCH)
+            self.tokens[token] = info
+            heapq.heappush(self.expiry, (datetime.fromisoformat(info["expires_at"]), token))
+            self.append({"op": "add", "token": token, "info": info})
+
+    def get(self, token):
+        """查找令牌信息，不存在（或已被清理）时返回 None"""
+        with self.lock:
+            self.refresh()
+            self.expire(self.SWEEP_BATCH)
+            return self.tokens.get(token)
+
+    @staticmethod
+    def problem(info):
+        """令牌不能使用的原因，可以使用时返回 None"""
+        if not info:
+            return "无效的重置令牌"
+        if info.get("used", False):
+            return "该重置令牌已被使用"
+        if datetime.now() > datetime.fromisoformat(info["expires_at"]):
+            return "重置令牌已过期"
+        return None
+
+    def consume(self, token):
+        """在同一把锁内检查令牌存在、未使用且未过期并标记为已使用，同一令牌只能成功一次
+
+        返回 (是否成功, 用户名或失败原因)。
+        """
+        with self.lock:
+            self.refresh()
+            self.expire(self.SWEEP_BATCH)
+            info = self.tokens.get(token)
+            problem = self.problem(info)
+            if problem:
+                return False, problem
+            used_at = datetime.now().isoformat()
+            info.update(used=True, used_at=used_at)
+            self.append({"op": "use", "token": token, "used_at": used_at})
+            return True, info["username"]
+
+    def expire(self, limit=None):
+        """从堆顶移除已过期的令牌（最多 limit 个），返回移除的数量（调用方需持有锁）"""
+        now = datetime.now()
+        removed = 0
+        while self.expiry and self.expiry[0][0] <= now and (limit is None or removed < limit):
+            _, token = heapq.heappop(self.expiry)
+            if self.tokens.pop(token, None) is not None:
+                removed += 1
+        return removed
+
+    def sweep(self):
+        """清理所有过期令牌，并把日志合并回令牌文件"""
+        with self.lock:
+            self.refresh()
+            removed = self.expire()
+            if removed or os.path.exists(self.log_file) and os.path.getsize(self.log_file) > 0:
+                tmp_file = self.tokens_file + '.tmp'
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(self.tokens, f, ensure_ascii=False, indent=2)
+                os.replace(tmp_file, self.tokens_file)
+                open(self.log_file, 'w', encoding='utf-8').close()
+                self.signature = self.file_signature()
+            return removed
+
+    def sweep_forever(self):
+        while True:
+            time.sleep(self.SWEEP_INTERVAL)
+            try:
+                self.sweep()
+            except Exception:
+                pass  # 下次再试
+
+
+@st.cache_resource
+def get_reset_token_store():
+    """进程内共享的重置令牌存储"""
+    return ResetTokenStore()
 
 
 class UserManager:
@@ -131,6 +591,8 @@ class UserManager:
         self.reset_tokens_file = "reset_tokens.json"
         self.email_manager = EmailManager()
         self.setup_files()
+        self.directory = get_user_directory()
+        self.reset_tokens = get_reset_token_store()
 
     def setup_files(self):
         """初始化数据文件"""
@@ -160,35 +622,28 @@ class UserManager:
     def register_user(self, username, password, email):
         """注册新用户"""
         try:
-            with open(self.users_file, 'r', encoding='utf-8') as f:
-                users = json.load(f)
-
-            if username in users:
+            if self.directory.get(username) is not None:
                 return False, "用户名已存在"
 
             if not self.is_valid_email(email):
                 return False, "邮箱格式不正确"
 
             # 检查邮箱是否已被使用
-            for user_data in users.values():
-                if user_data.get("email") == email:
-                    return False, "该邮箱已被注册"
+            if self.directory.username_for_email(email) is not None:
+                return False, "该邮箱已被注册"
 
             # 创建用户数据目录
             user_data_dir = f"user_data/{username}"
             os.makedirs(user_data_dir, exist_ok=True)
 
             # 保存用户信息
-            users[username] = {
+            self.directory.add(username, {
                 "password_hash": self.hash_password(password),
                 "email": email,
                 "created_at": datetime.now().isoformat(),
                 "last_login": None,
                 "data_dir": user_data_dir
-            }
-
-            with open(self.users_file, 'w', encoding='utf-8') as f:
-                json.dump(users, f, ensure_ascii=False, indent=2)
+            })
 
             # 初始化用户数据文件
             self.init_user_data(username)
@@ -200,14 +655,10 @@ class UserManager:
     def verify_user(self, username, password):
         """验证用户登录"""
         try:
-            with open(self.users_file, 'r', encoding='utf-8') as f:
-                users = json.load(f)
-
-            if username in users and users[username]["password_hash"] == self.hash_password(password):
-                # 更新最后登录时间
-                users[username]["last_login"] = datetime.now().isoformat()
-                with open(self.users_file, 'w', encoding='utf-8') as f:
-                    json.dump(users, f, ensure_ascii=False, indent=2)
+            user = self.directory.get(username)
+            if user is not None and user["password_hash"] == self.hash_password(password):
+                # 更新最后登录时间（追加到登录日志）
+                self.directory.record_login(username)
                 return True, "登录成功"
             else:
                 return False, "用户名或密码错误"
@@ -231,9 +682,7 @@ class UserManager:
     def get_user_email(self, username):
         """获取用户邮箱"""
         try:
-            with open(self.users_file, 'r', encoding='utf-8') as f:
-                users = json.load(f)
-            return users.get(username, {}).get("email")
+            return (self.directory.get(username) or {}).get("email")
         except:
             return None
 
@@ -243,52 +692,34 @@ class UserManager:
             # 获取用户邮箱
             user_email = self.get_user_email(username)
             if not user_email:
-                return False, "用户名不存在"
+                return False, "用户名不存在", None
 
             # 生成重置令牌
             reset_token = self.generate_reset_token()
             expires_at = datetime.now() + timedelta(minutes=30)  # 30分钟有效期
 
             # 保存重置令牌
-            with open(self.reset_tokens_file, 'r', encoding='utf-8') as f:
-                reset_tokens = json.load(f)
-
-            reset_tokens[reset_token] = {
+            self.reset_tokens.add(reset_token, {
                 "username": username,
                 "email": user_email,
                 "expires_at": expires_at.isoformat(),
                 "used": False
-            }
+            })
 
-            with open(self.reset_tokens_file, 'w', encoding='utf-8') as f:
-                json.dump(reset_tokens, f, ensure_ascii=False, indent=2)
-
-            # 发送重置邮件
-            success, message = self.email_manager.send_reset_email(user_email, reset_token, username)
-            if success:
-                return True, f"密码重置邮件已发送到: {user_email}"
-            else:
-                return False, message
+            # 发送重置邮件（后台发送，返回的任务供界面显示发送进度）
+            job = self.email_manager.send_reset_email(user_email, reset_token, username)
+            return True, f"密码重置邮件正在发送到: {user_email}", job
 
         except Exception as e:
-            return False, f"密码重置请求失败: {str(e)}"
+            return False, f"密码重置请求失败: {str(e)}", None
 
     def verify_reset_token(self, reset_token):
         """验证重置令牌"""
         try:
-            with open(self.reset_tokens_file, 'r', encoding='utf-8') as f:
-                reset_tokens = json.load(f)
-
-            token_data = reset_tokens.get(reset_token)
-            if not token_data:
-                return False, "无效的重置令牌"
-
-            if token_data.get("used", False):
-                return False, "该重置令牌已被使用"
-
-            expires_at = datetime.fromisoformat(token_data["expires_at"])
-            if datetime.now() > expires_at:
-                return False, "重置令牌已过期"
+            token_data = self.reset_tokens.get(reset_token)
+            problem = ResetTokenStore.problem(token_data)
+            if problem:
+                return False, problem
 
             return True, token_data["username"]
 
@@ -298,52 +729,1651 @@ class UserManager:
     def reset_password(self, reset_token, new_password):
         """重置密码"""
         try:
-            # 验证令牌
-            success, result = self.verify_reset_token(reset_token)
+            # 验证令牌并立即标记为已使用，并发的两次重置只有一次能通过
+            success, result = self.reset_tokens.consume(reset_token)
             if not success:
                 return False, result
 
             username = result
 
             # 更新密码
-            with open(self.users_file, 'r', encoding='utf-8') as f:
-                users = json.load(f)
+            self.directory.update(
+                username,
+                password_hash=self.hash_password(new_password),
+                last_updated=datetime.now().isoformat()
+            )
 
-            users[username]["password_hash"] = self.hash_password(new_password)
-            users[username]["last_updated"] = datetime.now().isoformat()
+            return True, "密码重置成功"
 
-            with open(self.users_file, 'w', encoding='utf-8') as f:
-                json.dump(users, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            return False, f"密码重置失败: {str(e)}"
 
-            # 标记令牌为已使用
-            with open(self.reset_tokens_file, 'r', encoding='utf-8') as f:
-                reset_tokens = json.load(f)
 
-            reset_tokens[reset_token]["used"] = True
-            reset_tokens[reset_token]["used_at"] = datetime.now().isoformat()
+# 账本存储后端："json"（快照 + 追加日志，默认）或 "sqlite"
+STORAGE_BACKEND = os.environ.get("FINANCE_STORAGE_BACKEND", "json")
 
-            with open(self.reset_tokens_file, 'w', encoding='utf-8') as f:
-                json.dump(reset_tokens, f, ensure_ascii=False, indent=2)
+# 进程内共享账本快照的内存上限（MB），超出时按最近使用淘汰无人使用的账本
+LEDGER_CACHE_MB = int(os.environ.get("FINANCE_LEDGER_CACHE_MB", "512"))
 
-            return True, "密码重置成功"
+TRANSACTION_COLUMNS = ['日期', '类型', '类别', '项目描述', '金额', '币种', '支付方式', '对方账户', '汇率', '备注']
+ID_COLUMN = '交易ID'  # 交易的永久唯一编号，同时作为交易表的索引
+
+
+def new_transaction_id():
+    """生成交易ID"""
+    return secrets.token_hex(8)
+
+
+CATEGORY_COLUMNS = ['类型', '类别', '币种', '支付方式']  # 取值种类很少的列，内存中用分类类型存储
+TEXT_COLUMNS = ['项目描述', '对方账户', '备注']
+
+
+def to_cents(amount):
+    """金额（元）转为整数分"""
+    return int(round(float(amount) * 100))
+
+
+def from_cents(cents):
+    """整数分转为金额（元）"""
+    return cents / 100
+
+
+def add_amount(balance, delta):
+    """以整数分计算 balance + delta，避免余额反复加减后累积浮点误差"""
+    return from_cents(to_cents(balance) + to_cents(delta))
+
+
+def transaction_frame(rows=()):
+    """由交易记录构建以交易ID为索引的交易表
+
+    文件中的交易记录日期为字符串、金额为元；内存中日期为 datetime64，
+    金额为 int64 整数分，类型/类别/币种/支付方式为分类类型。
+    """
+    df = pd.DataFrame(rows, columns=[ID_COLUMN] + TRANSACTION_COLUMNS).set_index(ID_COLUMN)
+    df['日期'] = pd.to_datetime(df['日期'], format="%Y-%m-%d")
+    df['金额'] = (pd.to_numeric(df['金额']).astype(float) * 100).round().astype('int64')
+    df['汇率'] = pd.to_numeric(df['汇率']).astype(float)
+    for column in CATEGORY_COLUMNS:
+        df[column] = df[column].fillna('').astype(str).astype('category')
+    for column in TEXT_COLUMNS:
+        df[column] = df[column].fillna('').astype(str)
+    return df
+
+
+def transaction_records(df):
+    """把内存中的交易表转回文件格式的交易记录列表（含交易ID）"""
+    out = df.reset_index()
+    out['日期'] = out['日期'].dt.strftime("%Y-%m-%d")
+    out['金额'] = out['金额'] / 100
+    # 逐列转成 Python 列表再组装，比 to_dict('records') 逐个单元格装箱快得多
+    columns = list(out.columns)
+    values = [out[column].astype(object).tolist() for column in columns]
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def display_frame(df):
+    """把交易表格式化为显示用的文本（只应对当前页调用）"""
+    return df.assign(
+        日期=df['日期'].dt.strftime("%Y-%m-%d"),
+        金额=(df['金额'] / 100).map('{:,.2f}'.format),
+        汇率=df['汇率'].map('{:.2f}'.format)
+    )
 
-        except Exception as e:
-            return False, f"密码重置失败: {str(e)}"
+
+def concat_transactions(frames):
+    """拼接交易表，先合并分类列的取值，使结果保持分类类型"""
+    for column in CATEGORY_COLUMNS:
+        categories = pd.api.types.union_categoricals([frame[column] for frame in frames]).categories
+        for frame in frames:
+            frame[column] = frame[column].cat.set_categories(categories)
+    return pd.concat(frames)
+
+
+# 内存中的交易表始终按日期升序排列（同日按录入先后），日期范围用二分查找定位
+INSERT_BISECT_ROWS = 64  # 一次插入不超过此笔数时逐段定位插入，否则拼接后整体稳定排序
+
+
+def sort_transactions(df):
+    """按日期稳定排序交易表；已经有序时原样返回"""
+    if df['日期'].is_monotonic_increasing:
+        return df
+    return df.iloc[df['日期'].to_numpy().argsort(kind='stable')]
+
+
+def insert_transactions(df, new_rows):
+    """把新交易插入按日期排序的交易表，同日的排在已有交易之后，返回新的交易表"""
+    new_rows = sort_transactions(new_rows)
+    dates = df['日期'].to_numpy()
+    new_dates = new_rows['日期'].to_numpy().astype(dates.dtype)
+    if not len(dates) or not len(new_dates) or new_dates[0] >= dates[-1]:
+        return concat_transactions([df, new_rows])  # 最常见的情况：新交易的日期不早于已有交易，直接追加
+    if len(new_rows) > INSERT_BISECT_ROWS:
+        return sort_transactions(concat_transactions([df, new_rows]))
+
+    positions = np.searchsorted(dates, new_dates, side='right')
+    pieces, start = [], 0
+    for position in np.unique(positions):
+        pieces += [df.iloc[start:position], new_rows[positions == position]]
+        start = position
+    pieces.append(df.iloc[start:])
+    return concat_transactions(pieces)
+
+
+def date_range_slice(df, start_date=None, end_date=None):
+    """按日期排序的交易表中 start_date 至 end_date（含）的连续一段：二分查找定位后按位置切片，不复制数据"""
+    dates = df['日期'].to_numpy()
+    start = 0 if start_date is None else np.searchsorted(dates, np.datetime64(start_date, 'D').astype(dates.dtype))
+    end = len(dates) if end_date is None else np.searchsorted(
+        dates, np.datetime64(end_date, 'D').astype(dates.dtype), side='right')
+    return df.iloc[start:max(start, end)]
+
+
+IMPORT_REQUIRED_COLUMNS = ['日期', '类型', '金额', '支付方式']
+IMPORT_DEFAULTS = {'类别': '', '项目描述': '', '币种': '人民币', '对方账户': '', '汇率': 1.0, '备注': ''}
+
+
+def prepare_import_chunk(chunk):
+    """校验并转换一块导入数据，返回 (有效交易表, 无效行在块内的位置列表)"""
+    missing = [column for column in IMPORT_REQUIRED_COLUMNS if column not in chunk.columns]
+    if missing:
+        raise ValueError(f"缺少必需的列: {', '.join(missing)}")
+
+    chunk = chunk.reset_index(drop=True)
+    for column, default in IMPORT_DEFAULTS.items():
+        if column not in chunk.columns:
+            chunk[column] = default
+        elif column != '汇率':
+            chunk[column] = chunk[column].fillna('').astype(str).str.strip().replace('', default)
+
+    dates = pd.to_datetime(chunk['日期'], errors='coerce').dt.normalize()
+    amounts = pd.to_numeric(chunk['金额'], errors='coerce')
+    rates = pd.to_numeric(chunk['汇率'], errors='coerce').fillna(1.0)
+    types = chunk['类型'].astype(str).str.strip()
+
+    valid = (
+            dates.notna() & (amounts > 0) & (rates > 0) & types.isin(["收入", "支出", "转账"]) &
+            ~((types == "转账") & (chunk['支付方式'] == chunk['对方账户']))
+    )
+
+    rows = chunk[valid].assign(日期=dates[valid], 金额=amounts[valid], 汇率=rates[valid], 类型=types[valid])
+    rows.insert(0, ID_COLUMN, [new_transaction_id() for _ in range(len(rows))])
+    return transaction_frame(rows), list(chunk.index[~valid])
+
+
+TRANSACTION_PAGE_SIZES = [20, 50, 100, 200]
+EXPORT_CHUNK_ROWS = 10_000
+EXPORT_FORMATS = {'csv': 'text/csv'}
+if openpyxl is not None:
+    EXPORT_FORMATS['xlsx'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def iter_export_chunks(df, chunksize=EXPORT_CHUNK_ROWS):
+    """按块生成文件格式的交易表（不含交易ID，可直接重新导入），每次只复制一块"""
+    for start in range(0, max(len(df), 1), chunksize):
+        chunk = df.iloc[start:start + chunksize]
+        yield chunk[TRANSACTION_COLUMNS].assign(
+            日期=chunk['日期'].dt.strftime("%Y-%m-%d"),
+            金额=chunk['金额'] / 100
+        )
+
+
+def write_transactions_file(df, file, file_format='csv'):
+    """把交易表逐块写入二进制文件对象"""
+    if file_format == 'csv':
+        file.write('\ufeff'.encode('utf-8'))  # BOM，使 Excel 能正确识别中文
+        for i, chunk in enumerate(iter_export_chunks(df)):
+            file.write(chunk.to_csv(index=False, header=(i == 0)).encode('utf-8'))
+    elif file_format == 'xlsx':
+        if openpyxl is None:
+            raise ValueError("导出Excel需要安装 openpyxl")
+        # 只写模式逐行落盘，工作表不会整体保存在内存中
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet("交易记录")
+        sheet.append(TRANSACTION_COLUMNS)
+        for chunk in iter_export_chunks(df):
+            for row in chunk.itertuples(index=False, name=None):
+                sheet.append(row)
+        workbook.save(file)
+    else:
+        raise ValueError(f"不支持的导出格式: {file_format}")
+
+
+def export_transactions(df, file_format='csv'):
+    """生成下载用的导出文件"""
+    buffer = io.BytesIO()
+    write_transactions_file(df, buffer, file_format)
+    buffer.seek(0)
+    return buffer
+
+
+LEDGER_THREAD_LOCKS = {}  # 数据目录 -> 进程内的锁
+LEDGER_THREAD_LOCKS_GUARD = threading.Lock()
+
+
+@contextlib.contextmanager
+def ledger_lock(data_dir):
+    """用户数据目录的建议性文件锁，串行化各会话（及各进程）对账本的读写"""
+    with LEDGER_THREAD_LOCKS_GUARD:
+        thread_lock = LEDGER_THREAD_LOCKS.setdefault(data_dir, threading.Lock())
+
+    with thread_lock, open(os.path.join(data_dir, ".ledger.lock"), 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def ledger_op_keys(op):
+    """一条日志操作修改的对象（交易ID 或 (分区, 键)），用于检测两个会话的修改是否冲突
+
+    新增交易使用新生成的ID，不会与其他操作冲突。
+    """
+    kind = op['op']
+    if kind in ('update', 'delete'):
+        return {op['id']}
+    if kind in ('set', 'remove'):
+        return {(op['section'], op['key'])}
+    return set()
+
+
+def ledger_op_size(op):
+    """一条日志操作包含的交易笔数（用于判断何时合并快照）"""
+    return len(op['rows']) if op['op'] == 'add_many' else 1
+
+
+def apply_ledger_op(data, op):
+    """将一条日志操作应用到账本数据，返回交易行的 (旧记录, 新记录) 列表
+
+    data['transactions'] 为 交易ID -> 交易记录 的有序字典。
+    """
+    transactions = data['transactions']
+    kind = op['op']
+
+    if kind in ('add', 'add_many'):
+        changes = []
+        for row in (op['rows'] if kind == 'add_many' else [op['row']]):
+            if ID_COLUMN not in row:
+                row = {ID_COLUMN: new_transaction_id(), **row}
+                data['ids_assigned'] = True
+            transactions[row[ID_COLUMN]] = row
+            changes.append((None, row))
+        return changes
+    elif kind in ('update', 'delete'):
+        # 早期日志按位置记录交易
+        transaction_id = op['id'] if 'id' in op else list(transactions)[op['index']]
+        if kind == 'delete':
+            return [(transactions.pop(transaction_id), None)]
+        old_row = transactions[transaction_id]
+        if op['row'].get('日期') != old_row.get('日期'):
+            # 改了日期的交易排到同一天的最后，与内存中的插入位置一致
+            del transactions[transaction_id]
+        transactions[transaction_id] = {ID_COLUMN: transaction_id, **op['row']}
+        return [(old_row, transactions[transaction_id])]
+    elif kind == 'set':
+        data[op['section']][op['key']] = op['value']
+    elif kind == 'remove':
+        data[op['section']].pop(op['key'], None)
+    return []
+
+
+class LedgerJournal:
+    """追加式账本日志：快照文件 + 逐条追加的操作日志"""
+
+    COMPACT_THRESHOLD = 500  # 日志累计多少条操作后合并为新快照
+    indexed = False  # 不支持索引查询，筛选在 DataFrame 上完成
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.snapshot_file = os.path.join(data_dir, "finance_data.json")
+        self.journal_file = os.path.join(data_dir, "journal.jsonl")
+        self.index_file = os.path.join(data_dir, "text_index.json")  # 与快照同时写入的全文索引
+        self.seq = 0  # 已应用的最后一条操作序号，即本会话数据的版本号
+        self.journal_length = 0  # 快照之后的日志条数
+        self.snapshot_signature = None  # 本会话最后一次读写快照时的 (修改时间, 大小)
+
+    def locked(self):
+        return ledger_lock(self.data_dir)
+
+    def cursor(self):
+        """本会话的读取位置，其他会话复用同一份已加载数据时用 seek() 恢复"""
+        return self.seq, self.journal_length, self.snapshot_signature
+
+    def seek(self, cursor):
+        self.seq, self.journal_length, self.snapshot_signature = cursor
+
+    def file_signature(self, path):
+        try:
+            stat = os.stat(path)
+            return stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        """读取快照并重放日志尾部，返回 (数据, 重放的交易变更列表)"""
+        data = {'transactions': [], 'bank_accounts': {}, 'debts': {}, 'budgets': {}, 'saved_filters': {}}
+        self.snapshot_signature = self.file_signature(self.snapshot_file)
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                data.update(json.load(f))
+
+        self.seq = data.pop('journal_seq', 0)
+        self.journal_length = 0
+        data['text_index'] = self.load_text_index(data.pop('text_index_id', None))
+        changes = []
+
+        # 转为按交易ID索引；没有ID的旧数据在此补发，由调用方写回新快照
+        transactions = {}
+        for row in data['transactions']:
+            if ID_COLUMN not in row:
+                row = {ID_COLUMN: new_transaction_id(), **row}
+                data['ids_assigned'] = True
+            transactions[row[ID_COLUMN]] = row
+        data['transactions'] = transactions
+
+        if os.path.exists(self.journal_file):
+            valid_bytes = 0
+            with open(self.journal_file, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # 写入中断留下的半行
+                    try:
+                        op = json.loads(line.decode('utf-8'))
+                    except (UnicodeDecodeError, json.JSONDecodeError):
+                        break
+                    valid_bytes += len(line)
+
+                    # 快照合并后、截断日志前崩溃时，跳过已包含在快照中的操作
+                    if op['seq'] <= self.seq:
+                        continue
+                    changes.extend(apply_ledger_op(data, op))
+                    self.seq = op['seq']
+                    self.journal_length += ledger_op_size(op)
+
+            # 截掉损坏的尾部，避免后续追加的记录接在半行后面
+            if valid_bytes < os.path.getsize(self.journal_file):
+                with open(self.journal_file, 'r+b') as f:
+                    f.truncate(valid_bytes)
+
+        data['transactions'] = list(data['transactions'].values())
+        return data, changes
+
+    def load_text_index(self, index_id):
+        """读取与快照同批写入的全文索引 {二元组: [交易ID, ...]}；不存在或与快照不对应时返回 None"""
+        if index_id is None or not os.path.exists(self.index_file):
+            return None
+        with open(self.index_file, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        return index['postings'] if index.get('id') == index_id else None
+
+    def read_new_ops(self):
+        """读取其他会话在本会话版本之后追加的操作；快照已被其他会话合并改写、无法增量读取时返回 None"""
+        if self.file_signature(self.snapshot_file) != self.snapshot_signature:
+            return None
+        if not os.path.exists(self.journal_file):
+            return []
+
+        ops = []
+        with open(self.journal_file, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                op = json.loads(line.decode('utf-8'))
+                if op['seq'] <= self.seq:
+                    continue
+                if op['op'] in ('update', 'delete') and 'id' not in op:
+                    return None  # 早期按位置记录的操作只能整体重放
+                ops.append(op)
+
+        if ops:
+            self.seq = ops[-1]['seq']
+            self.journal_length += sum(ledger_op_size(op) for op in ops)
+        return ops
+
+    def append(self, ops):
+        """把操作逐条追加到日志末尾"""
+        if not ops:
+            return
+        lines = []
+        for op in ops:
+            self.seq += 1
+            lines.append(json.dumps({'seq': self.seq, **op}, ensure_ascii=False, separators=(',', ':')))
+
+        with open(self.journal_file, 'a', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        self.journal_length += sum(ledger_op_size(op) for op in ops)
+
+    def signature(self):
+        """快照和日志文件的 (修改时间, 大小)，用于判断磁盘数据是否变化"""
+        return self.file_signature(self.snapshot_file), self.file_signature(self.journal_file)
+
+    def needs_compaction(self, pending=0):
+        """日志（加上即将写入的 pending 笔变更）是否已长到需要合并"""
+        return self.journal_length + pending >= self.COMPACT_THRESHOLD
+
+    def compact(self, data):
+        """将当前完整数据写为新快照并清空日志；全文索引先写入单独的文件，快照记下其编号"""
+        snapshot = dict(data, journal_seq=self.seq)
+        postings = snapshot.pop('text_index', None)
+        if postings is not None:
+            snapshot['text_index_id'] = secrets.token_hex(8)
+            tmp_file = self.index_file + ".tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'id': snapshot['text_index_id'], 'postings': postings},
+                                   ensure_ascii=False, separators=(',', ':')))
+            os.replace(tmp_file, self.index_file)
+
+        # json.dump 逐段写入时用纯 Python 编码器，整体 dumps 用 C 编码器，大快照快数倍
+        tmp_file = self.snapshot_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')))
+
+        os.replace(tmp_file, self.snapshot_file)
+        self.snapshot_signature = self.file_signature(self.snapshot_file)
+
+        with open(self.journal_file, 'w', encoding='utf-8'):
+            pass
+        self.journal_length = 0
+
+
+class SQLiteLedgerStore:
+    """SQLite 账本存储：逐条执行日志操作，交易按日期、类型、类别、支付方式、币种建索引"""
+
+    indexed = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, 交易ID TEXT,
+            日期 TEXT, 类型 TEXT, 类别 TEXT, 项目描述 TEXT, 金额 REAL,
+            币种 TEXT, 支付方式 TEXT, 对方账户 TEXT, 汇率 REAL, 备注 TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions(日期);
+        CREATE INDEX IF NOT EXISTS idx_transactions_type ON transactions(类型, 日期);
+        CREATE INDEX IF NOT EXISTS idx_transactions_category ON transactions(类别);
+        CREATE INDEX IF NOT EXISTS idx_transactions_payment ON transactions(支付方式);
+        CREATE INDEX IF NOT EXISTS idx_transactions_currency ON transactions(币种);
+
+        CREATE TABLE IF NOT EXISTS bank_accounts (
+            name TEXT PRIMARY KEY, 余额 REAL, 币种 TEXT, 创建时间 TEXT, 最后更新 TEXT, 期初余额 REAL
+        );
+        CREATE TABLE IF NOT EXISTS debts (
+            name TEXT PRIMARY KEY, 总额 REAL, 剩余 REAL, 状态 TEXT, 币种 TEXT, 创建时间 TEXT, 期初剩余 REAL
+        );
+        CREATE TABLE IF NOT EXISTS repayment_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, debt TEXT,
+            还款日期 TEXT, 还款金额 REAL, 还款方式 TEXT, 还款前余额 REAL, 还款后余额 REAL, 交易ID TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_repayment_records_debt ON repayment_records(debt);
+        CREATE TABLE IF NOT EXISTS budgets (
+            month TEXT, category TEXT, 预算金额 REAL, 已用金额 REAL, 币种 TEXT,
+            PRIMARY KEY (month, category)
+        );
+        CREATE TABLE IF NOT EXISTS saved_filters (name TEXT PRIMARY KEY, definition TEXT);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS ledger_ops (seq INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT);
+        CREATE TABLE IF NOT EXISTS text_index (token TEXT, 交易ID TEXT);
+        CREATE INDEX IF NOT EXISTS idx_text_index_token ON text_index(token);
+        CREATE INDEX IF NOT EXISTS idx_text_index_id ON text_index(交易ID);
+
+        CREATE TABLE IF NOT EXISTS monthly_cube (
+            年月 TEXT, 类型 TEXT, 类别 TEXT, 币种 TEXT, 支付方式 TEXT, 金额 REAL, 笔数 INTEGER,
+            PRIMARY KEY (年月, 类型, 类别, 币种, 支付方式)
+        );
+        CREATE TRIGGER IF NOT EXISTS trg_cube_insert AFTER INSERT ON transactions BEGIN
+            INSERT INTO monthly_cube VALUES (substr(NEW.日期, 1, 7), NEW.类型, NEW.类别, NEW.币种, NEW.支付方式, NEW.金额, 1)
+            ON CONFLICT DO UPDATE SET 金额 = round(金额 + excluded.金额, 2), 笔数 = 笔数 + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_cube_delete AFTER DELETE ON transactions BEGIN
+            UPDATE monthly_cube SET 金额 = round(金额 - OLD.金额, 2), 笔数 = 笔数 - 1
+            WHERE 年月 = substr(OLD.日期, 1, 7) AND 类型 IS OLD.类型 AND 类别 IS OLD.类别
+              AND 币种 IS OLD.币种 AND 支付方式 IS OLD.支付方式;
+            DELETE FROM monthly_cube WHERE 笔数 <= 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_cube_update AFTER UPDATE ON transactions BEGIN
+            UPDATE monthly_cube SET 金额 = round(金额 - OLD.金额, 2), 笔数 = 笔数 - 1
+            WHERE 年月 = substr(OLD.日期, 1, 7) AND 类型 IS OLD.类型 AND 类别 IS OLD.类别
+              AND 币种 IS OLD.币种 AND 支付方式 IS OLD.支付方式;
+            DELETE FROM monthly_cube WHERE 笔数 <= 0;
+            INSERT INTO monthly_cube VALUES (substr(NEW.日期, 1, 7), NEW.类型, NEW.类别, NEW.币种, NEW.支付方式, NEW.金额, 1)
+            ON CONFLICT DO UPDATE SET 金额 = round(金额 + excluded.金额, 2), 笔数 = 笔数 + 1;
+        END;
+    """
+
+    OPS_RETAINED = 1000  # 保留最近多少条操作，供其他会话增量同步
+    OPS_LOGGED_ROWS = 1000  # 超过此笔数的批量操作不记录内容，其他会话整体重新加载
+
+    BANK_FIELDS = ['余额', '币种', '创建时间', '最后更新', '期初余额']
+    DEBT_FIELDS = ['总额', '剩余', '状态', '币种', '创建时间', '期初剩余']
+    RECORD_FIELDS = ['还款日期', '还款金额', '还款方式', '还款前余额', '还款后余额', '交易ID']
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.db_file = os.path.join(data_dir, "finance_data.db")
+        self.seq = 0  # 已应用的最后一条操作序号，即本会话数据的版本号
+        self.data_version = None  # 本连接上次读到的 PRAGMA data_version
+        self.op_seq = 0  # 库中最后一条操作的序号，见 signature()
+        is_new = not os.path.exists(self.db_file)
+
+        # Streamlit 每次重跑可能在不同线程执行
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self.upgrade_schema()
+
+        if is_new:
+            self.migrate_from_json()
+        self.backfill_monthly_cube()
+        self.backfill_text_index()
+
+    def upgrade_schema(self):
+        """为旧版数据库补充交易ID列、期初金额列，并建立唯一索引"""
+        with self.conn:
+            for table, column, column_type in (('transactions', ID_COLUMN, 'TEXT'), ('repayment_records', ID_COLUMN, 'TEXT'),
+                                               ('bank_accounts', '期初余额', 'REAL'), ('debts', '期初剩余', 'REAL')):
+                columns = [row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")]
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+            self.conn.execute(f"UPDATE transactions SET {ID_COLUMN} = lower(hex(randomblob(8))) WHERE {ID_COLUMN} IS NULL")
+            self.conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_id ON transactions({ID_COLUMN})")
+
+    def backfill_monthly_cube(self):
+        """为触发器建立之前写入的交易补建月度汇总表"""
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'cube_built'").fetchone():
+            return
+        with self.conn:
+            self.conn.execute("DELETE FROM monthly_cube")
+            self.conn.execute(
+                "INSERT INTO monthly_cube SELECT substr(日期, 1, 7), 类型, 类别, 币种, 支付方式, round(SUM(金额), 2), COUNT(*) "
+                "FROM transactions GROUP BY 1, 2, 3, 4, 5"
+            )
+            self.conn.execute("INSERT INTO meta VALUES ('cube_built', '1')")
+
+    def backfill_text_index(self):
+        """为建立全文索引之前写入的交易补建索引表"""
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'text_index_built'").fetchone():
+            return
+        df = pd.read_sql_query(f"SELECT {ID_COLUMN}, {', '.join(TEXT_COLUMNS)} FROM transactions",
+                               self.conn, index_col=ID_COLUMN)
+        with self.conn:
+            self.conn.execute("DELETE FROM text_index")
+            self.conn.executemany("INSERT INTO text_index VALUES (?, ?)",
+                                  ((token, transaction_id) for token, ids in TextIndex.from_frame(df).postings.items()
+                                   for transaction_id in ids))
+            self.conn.execute("INSERT INTO meta VALUES ('text_index_built', '1')")
+
+    def index_rows(self, rows):
+        """把交易的全文索引写入索引表"""
+        self.conn.executemany("INSERT INTO text_index VALUES (?, ?)",
+                              ((token, row[ID_COLUMN]) for row in rows for token in TextIndex.row_tokens(row)))
+
+    def migrate_from_json(self):
+        """从已有的 finance_data.json（含追加日志）导入数据，原文件保留不动"""
+        if not os.path.exists(os.path.join(self.data_dir, "finance_data.json")):
+            return False
+
+        data, _ = LedgerJournal(self.data_dir).load()
+        columns = [ID_COLUMN] + TRANSACTION_COLUMNS
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT INTO transactions ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                ([row.get(col) for col in columns] for row in data['transactions'])
+            )
+            for section in FinanceApp.SECTIONS:
+                for key, value in data[section].items():
+                    self.apply_op({'op': 'set', 'section': section, 'key': key, 'value': value})
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('migrated_at', ?)", (datetime.now().isoformat(),))
+        return True
+
+    def locked(self):
+        return ledger_lock(self.data_dir)
+
+    def cursor(self):
+        return self.seq
+
+    def seek(self, cursor):
+        self.seq = cursor
+
+    def load(self):
+        """读取全部数据，返回 (数据, 重放的交易变更列表)"""
+        self.seq = self.last_op_seq()
+        data = {
+            'transactions': pd.read_sql_query(
+                f"SELECT {ID_COLUMN}, {', '.join(TRANSACTION_COLUMNS)} FROM transactions ORDER BY 日期, id", self.conn),
+            'bank_accounts': {},
+            'debts': {},
+            'budgets': {},
+            'saved_filters': {}
+        }
+
+        for name, *values in self.conn.execute(f"SELECT name, {', '.join(self.BANK_FIELDS)} FROM bank_accounts"):
+            data['bank_accounts'][name] = dict(zip(self.BANK_FIELDS, values))
+
+        for name, *values in self.conn.execute(f"SELECT name, {', '.join(self.DEBT_FIELDS)} FROM debts"):
+            data['debts'][name] = dict(zip(self.DEBT_FIELDS, values), 还款记录=[])
+        for debt, *values in self.conn.execute(
+                f"SELECT debt, {', '.join(self.RECORD_FIELDS)} FROM repayment_records ORDER BY id"):
+            if debt in data['debts']:
+                data['debts'][debt]['还款记录'].append(dict(zip(self.RECORD_FIELDS, values)))
+
+        for month, category, amount, used, currency in self.conn.execute(
+                "SELECT month, category, 预算金额, 已用金额, 币种 FROM budgets"):
+            data['budgets'].setdefault(month, {})[category] = {"预算金额": amount, "已用金额": used, "币种": currency}
+
+        for name, definition in self.conn.execute("SELECT name, definition FROM saved_filters"):
+            data['saved_filters'][name] = json.loads(definition)
+
+        data['monthly_cube'] = [list(row) for row in self.conn.execute("SELECT * FROM monthly_cube")]
+
+        postings = {}
+        for token, transaction_id in self.conn.execute("SELECT token, 交易ID FROM text_index"):
+            postings.setdefault(token, []).append(transaction_id)
+        data['text_index'] = postings
+        return data, []
+
+    def apply_op(self, op):
+        """在当前事务中执行一条日志操作"""
+        kind = op['op']
+
+        if kind in ('add', 'add_many'):
+            columns = [ID_COLUMN] + TRANSACTION_COLUMNS
+            self.conn.executemany(
+                f"INSERT INTO transactions ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                ([row.get(col) for col in columns] for row in (op['rows'] if kind == 'add_many' else [op['row']]))
+            )
+            self.index_rows(op['rows'] if kind == 'add_many' else [op['row']])
+        elif kind == 'update':
+            row = op['row']
+            old_date = self.conn.execute(
+                f"SELECT 日期 FROM transactions WHERE {ID_COLUMN} = ?", (op['id'],)).fetchone()
+            if old_date is not None and old_date[0] != row.get('日期'):
+                # 改了日期的交易删除后重新插入，取得新的 id，与内存中一样排到同一天的最后
+                columns = [ID_COLUMN] + TRANSACTION_COLUMNS
+                self.conn.execute(f"DELETE FROM transactions WHERE {ID_COLUMN} = ?", (op['id'],))
+                self.conn.execute(
+                    f"INSERT INTO transactions ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                    [op['id']] + [row.get(col) for col in TRANSACTION_COLUMNS]
+                )
+            else:
+                self.conn.execute(
+                    f"UPDATE transactions SET {', '.join(f'{col} = ?' for col in TRANSACTION_COLUMNS)} WHERE {ID_COLUMN} = ?",
+                    [row.get(col) for col in TRANSACTION_COLUMNS] + [op['id']]
+                )
+            self.conn.execute(f"DELETE FROM text_index WHERE {ID_COLUMN} = ?", (op['id'],))
+            self.index_rows([{ID_COLUMN: op['id'], **row}])
+        elif kind == 'delete':
+            self.conn.execute(f"DELETE FROM transactions WHERE {ID_COLUMN} = ?", (op['id'],))
+            self.conn.execute(f"DELETE FROM text_index WHERE {ID_COLUMN} = ?", (op['id'],))
+
+        elif op['section'] == 'bank_accounts':
+            self.conn.execute("DELETE FROM bank_accounts WHERE name = ?", (op['key'],))
+            if kind == 'set':
+                self.conn.execute(
+                    f"INSERT INTO bank_accounts (name, {', '.join(self.BANK_FIELDS)}) "
+                    f"VALUES ({', '.join('?' * (len(self.BANK_FIELDS) + 1))})",
+                    [op['key']] + [op['value'].get(field) for field in self.BANK_FIELDS]
+                )
+        elif op['section'] == 'debts':
+            self.conn.execute("DELETE FROM debts WHERE name = ?", (op['key'],))
+            self.conn.execute("DELETE FROM repayment_records WHERE debt = ?", (op['key'],))
+            if kind == 'set':
+                self.conn.execute(
+                    f"INSERT INTO debts (name, {', '.join(self.DEBT_FIELDS)}) "
+                    f"VALUES ({', '.join('?' * (len(self.DEBT_FIELDS) + 1))})",
+                    [op['key']] + [op['value'].get(field) for field in self.DEBT_FIELDS]
+                )
+                self.conn.executemany(
+                    f"INSERT INTO repayment_records (debt, {', '.join(self.RECORD_FIELDS)}) "
+                    f"VALUES ({', '.join('?' * (len(self.RECORD_FIELDS) + 1))})",
+                    ([op['key']] + [record.get(field) for field in self.RECORD_FIELDS]
+                     for record in op['value'].get("还款记录", []))
+                )
+        elif op['section'] == 'budgets':
+            self.conn.execute("DELETE FROM budgets WHERE month = ?", (op['key'],))
+            if kind == 'set':
+                self.conn.executemany(
+                    "INSERT INTO budgets VALUES (?, ?, ?, ?, ?)",
+                    ((op['key'], category, info.get("预算金额"), info.get("已用金额", 0), info.get("币种", "人民币"))
+                     for category, info in op['value'].items())
+                )
+        elif op['section'] == 'saved_filters':
+            self.conn.execute("DELETE FROM saved_filters WHERE name = ?", (op['key'],))
+            if kind == 'set':
+                self.conn.execute("INSERT INTO saved_filters VALUES (?, ?)",
+                                  (op['key'], json.dumps(op['value'], ensure_ascii=False)))
+
+    def read_new_ops(self):
+        """读取其他会话在本会话版本之后写入的操作；已被清理或未记录内容时返回 None"""
+        rows = self.conn.execute("SELECT seq, op FROM ledger_ops WHERE seq > ? ORDER BY seq", (self.seq,)).fetchall()
+        if not rows:
+            return [] if self.last_op_seq() <= self.seq else None
+        if rows[0][0] != self.seq + 1:
+            return None
+
+        ops = [json.loads(op) for _, op in rows]
+        if any(op['op'] == 'reload' for op in ops):
+            return None
+        self.seq = rows[-1][0]
+        return ops
+
+    def append(self, ops):
+        """在一个事务中执行本次保存的全部操作，并记录操作供其他会话增量同步"""
+        if not ops:
+            return
+        with self.conn:
+
+            for op in ops:
+                self.apply_op(op)
+                logged = op if ledger_op_size(op) <= self.OPS_LOGGED_ROWS else {'op': 'reload'}
+                seq = self.conn.execute(
+                    "INSERT INTO ledger_ops (op) VALUES (?)", (json.dumps(logged, ensure_ascii=False),)).lastrowid
+            self.conn.execute("DELETE FROM ledger_ops WHERE seq <= ?", (seq - self.OPS_RETAINED,))
+        self.seq = self.op_seq = seq
+
+    def signature(self):
+        """最后写入的操作序号：所有连接读到的值一致，可与其他会话登记的共享快照比较
+
+        PRAGMA data_version 只在同一连接内有意义（且不反映本连接自己的提交），
+        只用它判断其他连接是否写入过，有变化时才重新查询序号。
+        """
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self.data_version:
+            self.data_version = data_version
+            self.op_seq = self.last_op_seq()
+        return self.op_seq
+
+    def last_op_seq(self):
+        """最后写入的操作序号：取自增计数器，旧操作被清理后也不会退回到更早的序号"""
+        row = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'ledger_ops'").fetchone()
+        return row[0] if row else 0
+
+    def needs_compaction(self, pending=0):
+        return False
+
+    def compact(self, data):
+        pass
+
+    def query_transactions(self, transaction_filter, start_date=None, end_date=None):
+        """按筛选条件（不含关键词）和日期范围（含两端）查询交易，走索引，按日期排序（同日按录入先后）"""
+        clauses, params = [], []
+        for column, values in transaction_filter.column_sets().items():
+            if values:
+                clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params += sorted(values)
+        if transaction_filter.min_amount is not None:
+            clauses.append("金额 >= ?")
+            params.append(transaction_filter.min_amount)
+        if transaction_filter.max_amount is not None:
+            clauses.append("金额 <= ?")
+            params.append(transaction_filter.max_amount)
+        if start_date is not None:
+            clauses.append("日期 >= ?")
+            params.append(start_date.strftime("%Y-%m-%d"))
+        if end_date is not None:
+            clauses.append("日期 <= ?")
+            params.append(end_date.strftime("%Y-%m-%d"))
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return pd.read_sql_query(
+            f"SELECT {ID_COLUMN}, {', '.join(TRANSACTION_COLUMNS)} FROM transactions {where} ORDER BY 日期, id",
+            self.conn, params=params, index_col=ID_COLUMN)
+
+
+def open_ledger_store(data_dir):
+    """按配置的存储后端打开用户数据目录"""
+    return SQLiteLedgerStore(data_dir) if STORAGE_BACKEND == "sqlite" else LedgerJournal(data_dir)
+
+
+class MonthlyCube:
+    """按 (年月, 类型, 类别, 币种, 支付方式) 汇总的金额与笔数，随每次交易变更增量维护"""
+
+    DIMENSIONS = ['年月', '类型', '类别', '币种', '支付方式']
+
+    def __init__(self):
+        # 年月 -> {(类型, 类别, 币种, 支付方式): [金额合计, 笔数]}
+        self.months = {}
+
+    @staticmethod
+    def split_key(row):
+        """交易记录对应的 (年月, 单元键)；日期为 YYYY-MM-DD 字符串，直接截取无需解析"""
+        return str(row['日期'])[:7], (row['类型'], row['类别'], row['币种'], row['支付方式'])
+
+    def add_row(self, row, sign=1):
+        """计入（sign=1）或扣除（sign=-1）一条交易"""
+        month, key = self.split_key(row)
+        cells = self.months.setdefault(month, {})
+        cell = cells.setdefault(key, [0.0, 0])
+        cell[0] = round(cell[0] + sign * float(row['金额']), 2)
+        cell[1] += sign
+
+        if cell[1] <= 0:
+            del cells[key]
+            if not cells:
+                del self.months[month]
+
+    def apply_change(self, old_row, new_row):
+        """应用一次交易变更：新增、修改或删除"""
+        if old_row is not None:
+            self.add_row(old_row, -1)
+        if new_row is not None:
+            self.add_row(new_row)
+
+    @classmethod
+    def from_frame(cls, df):
+        """对整张交易表做一次分组汇总"""
+        cube = cls()
+        if df.empty:
+            return cube
+
+        grouped = df.groupby(
+            [df['日期'].dt.to_period('M').rename('年月'), '类型', '类别', '币种', '支付方式'], observed=True
+        )['金额'].agg(['sum', 'count'])
+        for (month, *key), (total, count) in zip(grouped.index, grouped.values):
+            cube.months.setdefault(str(month), {})[tuple(key)] = [from_cents(int(total)), int(count)]
+        return cube
+
+    @classmethod
+    def from_rows(cls, rows):
+        """从持久化的 [年月, 类型, 类别, 币种, 支付方式, 金额合计, 笔数] 列表恢复"""
+        cube = cls()
+        for month, *key, total, count in rows:
+            cube.months.setdefault(month, {})[tuple(key)] = [total, count]
+        return cube
+
+    def to_rows(self):
+        return [[month, *key, total, count]
+                for month, cells in self.months.items() for key, (total, count) in cells.items()]
+
+    def merge(self, other):
+        """并入另一个汇总（用于批量导入）"""
+        for month, cells in other.months.items():
+            target = self.months.setdefault(month, {})
+            for key, (total, count) in cells.items():
+                cell = target.setdefault(key, [0.0, 0])
+                cell[0] = round(cell[0] + total, 2)
+                cell[1] += count
+
+    def totals(self, by, month=None, **filters):
+        """按给定维度汇总金额，可限定月份和其他维度的取值"""
+        months = [month] if month is not None else sorted(self.months)
+        result = {}
+        for current_month in months:
+            for key, (total, count) in self.months.get(current_month, {}).items():
+                values = dict(zip(self.DIMENSIONS, (current_month, *key)))
+                if all(values[dim] == value for dim, value in filters.items()):
+                    group = tuple(values[dim] for dim in by)
+                    result[group] = round(result.get(group, 0) + total, 2)
+        return result
+
+
+class TextIndex:
+    """项目描述、对方账户、备注的倒排索引：字符二元组 -> 交易ID 集合，随每次交易变更增量维护
+
+    中文没有空格分词，按相邻两个字符切分（不区分大小写）；查询词的所有二元组都命中的交易为候选，
+    再在候选上核对原文。与其他会话共享时共用各个集合，修改某个二元组前先复制它的集合（写时复制）。
+    """
+
+    FIELDS = TEXT_COLUMNS
+
+    def __init__(self, postings=None):
+        self.postings = postings if postings is not None else {}
+        self.owned = set()  # 本对象独占、可以原地修改的二元组
+
+    @staticmethod
+    def tokens(text):
+        """文本的字符二元组集合（跨空白的不算）"""
+        if not isinstance(text, str):
+            return set()
+        text = text.lower()
+        return {text[i:i + 2] for i in range(len(text) - 1) if not (text[i].isspace() or text[i + 1].isspace())}
+
+    @classmethod
+    def row_tokens(cls, row):
+        return set().union(*(cls.tokens(row.get(field)) for field in cls.FIELDS))
+
+    def writable(self, token):
+        """可以原地修改的集合（共享的先复制一份）"""
+        if token not in self.owned:
+            self.postings[token] = set(self.postings.get(token, ()))
+            self.owned.add(token)
+        return self.postings[token]
+
+    def add_row(self, transaction_id, row, sign=1):
+        """索引（sign=1）或移除（sign=-1）一条交易"""
+        for token in self.row_tokens(row):
+            ids = self.writable(token)
+            if sign > 0:
+                ids.add(transaction_id)
+            else:
+                ids.discard(transaction_id)
+                if not ids:
+                    del self.postings[token]
+                    self.owned.discard(token)
+
+    def apply_change(self, transaction_id, old_row, new_row):
+        """应用一次交易变更：新增、修改或删除"""
+        if old_row is not None:
+            self.add_row(transaction_id, old_row, -1)
+        if new_row is not None:
+            self.add_row(transaction_id, new_row)
+
+    def add_frame(self, df):
+        """索引一批交易：相同的文本只切分一次
+
+        按文本编码排序后切出各文本的交易ID（groupby().groups 为每组构造一个索引对象，大批量导入时很慢）。
+        """
+        ids = df.index.to_numpy()
+        for field in self.FIELDS:
+            codes, texts = pd.factorize(df[field].fillna('').astype(str).str.lower())
+            order = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[order], np.arange(1, len(texts)))
+            for text, text_ids in zip(texts, np.split(ids[order], bounds)):
+                for token in self.tokens(text):
+                    self.writable(token).update(text_ids)
+
+
+    @classmethod
+    def from_frame(cls, df):
+        index = cls()
+        index.add_frame(df)
+        return index
+
+    @classmethod
+    def from_postings(cls, postings):
+        """从持久化的 {二元组: [交易ID, ...]} 恢复"""
+        index = cls({token: set(ids) for token, ids in postings.items()})
+        index.owned = set(index.postings)
+        return index
+
+    def to_postings(self):
+        return {token: list(ids) for token, ids in self.postings.items()}
+
+    def share(self):
+        """返回与本对象共用集合的副本；此后双方修改前都会先复制"""
+        self.owned = set()
+        return TextIndex(dict(self.postings))
+
+    def nbytes(self):
+        """粗略估算占用的内存（每个集合元素按 60 字节计）"""
+        return sum(len(ids) for ids in self.postings.values()) * 60
+
+    def search(self, df, keyword):
+        """在 df 中查找包含关键词中所有词（按空白分隔）的交易
+
+        两个字符以上的词先用索引求交得到候选，三个字符以上的词再在候选上核对原文；单字的词直接扫描。
+        """
+        terms = keyword.lower().split()
+        candidates = None
+        for term in terms:
+            for token in self.tokens(term):
+                ids = self.postings.get(token, set())
+                candidates = ids if candidates is None else candidates & ids
+                if not candidates:
+                    return df.iloc[:0]
+        if candidates is not None:
+            # 按位置取出候选行，保持原有顺序（交易表索引的哈希表会被缓存，比 isin 快得多）
+            positions = df.index.get_indexer(list(candidates))
+            df = df.iloc[np.sort(positions[positions >= 0])]
+
+        # 两个字符的词与二元组一一对应，索引结果已是准确的
+        for term in (term for term in terms if len(term) != 2):
+            mask = np.zeros(len(df), dtype=bool)
+            for field in self.FIELDS:
+                mask |= df[field].fillna('').astype(str).str.lower().str.contains(term, regex=False).to_numpy()
+            df = df[mask]
+        return df
+
+
+TRANSACTION_PERIODS = ["全部", "最近7天", "最近30天", "本月", "自定义"]
+FILTER_CACHE_SIZE = 8  # 每个会话保留最近用过的多少个筛选结果
+
+
+class TransactionFilter:
+    """交易筛选条件：各项之间为“且”，同一项的多个取值为“或”，空集合或 None 表示不限
+
+    类型、类别、支付方式、币种用分类编码比较，与金额范围合成一个布尔数组一次筛选；
+    日期范围在按日期排序的交易表上二分切片，关键词走全文索引。
+    对象可哈希，作为筛选结果缓存的键；to_dict / from_dict 用于保存常用筛选。
+    """
+
+    def __init__(self, types=(), categories=(), accounts=(), currencies=(), min_amount=None, max_amount=None,
+                 period="全部", start_date=None, end_date=None, keyword=''):
+        self.types = frozenset(types)
+        self.categories = frozenset(categories)
+        self.accounts = frozenset(accounts)  # 支付方式（银行卡、现金等）
+        self.currencies = frozenset(currencies)
+        self.min_amount = min_amount  # 元，按交易原币种金额比较，含两端
+        self.max_amount = max_amount
+        self.period = period
+        # 只有“自定义”时间范围使用固定的起止日期
+        self.start_date = start_date if period == "自定义" else None
+        self.end_date = end_date if period == "自定义" else None
+        self.keyword = ' '.join(keyword.split())
+
+    def column_sets(self):
+        return {'类型': self.types, '类别': self.categories, '支付方式': self.accounts, '币种': self.currencies}
+
+    def key(self):
+        return (tuple(tuple(sorted(values)) for values in self.column_sets().values()),
+                self.min_amount, self.max_amount, self.period, self.start_date, self.end_date, self.keyword)
+
+    def __eq__(self, other):
+        # 每次重跑都会重新执行本文件，会话状态里保存的是上一次运行定义的类的实例，isinstance 不成立
+        return type(other).__qualname__ == type(self).__qualname__ and self.key() == other.key()
+
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def date_bounds(self, today):
+        """起止日期（含），None 表示不限；相对时间段按 today 计算"""
+        if self.period == "最近7天":
+            return today - timedelta(days=7), None
+        if self.period == "最近30天":
+            return today - timedelta(days=30), None
+        if self.period == "本月":
+            return today.replace(day=1), None
+        return self.start_date, self.end_date
+
+    def column_mask(self, df):
+        """日期和关键词以外的条件合成的布尔数组"""
+        mask = np.ones(len(df), dtype=bool)
+        for column, values in self.column_sets().items():
+            if values:
+                # 按分类编码查表；最后一项对应缺失值的编码 -1
+                categories = df[column].cat.categories
+                selected = np.zeros(len(categories) + 1, dtype=bool)
+                selected[categories.get_indexer(list(values))] = True
+                selected[-1] = False
+                mask &= selected[df[column].cat.codes.to_numpy()]
+        amounts = df['金额'].to_numpy()
+        if self.min_amount is not None:
+            mask &= amounts >= to_cents(self.min_amount)
+        if self.max_amount is not None:
+            mask &= amounts <= to_cents(self.max_amount)
+        return mask
+
+    def apply(self, df, text_index, start_date=None, end_date=None):
+        """在按日期排序的交易表上筛选，结果保持原有顺序"""
+        if self.keyword:
+            df = text_index.search(df, self.keyword)
+        df = date_range_slice(df, start_date, end_date)
+        mask = self.column_mask(df)
+        return df if mask.all() else df[mask]
+
+    def to_dict(self):
+        return {
+            '类型': sorted(self.types), '类别': sorted(self.categories),
+            '支付方式': sorted(self.accounts), '币种': sorted(self.currencies),
+            '最小金额': self.min_amount, '最大金额': self.max_amount, '时间范围': self.period,
+            '开始日期': self.start_date.isoformat() if self.start_date else None,
+            '结束日期': self.end_date.isoformat() if self.end_date else None,
+            '关键词': self.keyword,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        def parse_date(value):
+            return datetime.strptime(value, "%Y-%m-%d").date() if value else None
+
+        return cls(data.get('类型', ()), data.get('类别', ()), data.get('支付方式', ()), data.get('币种', ()),
+                   data.get('最小金额'), data.get('最大金额'), data.get('时间范围', "全部"),
+                   parse_date(data.get('开始日期')), parse_date(data.get('结束日期')), data.get('关键词', ''))
+
+
+# 复式记账科目：银行卡和债务的余额随分录更新，外部科目只用于使每笔交易的分录借贷平衡
+BANK_ACCOUNT = "银行卡"
+DEBT_ACCOUNT = "债务"
+EXTERNAL_ACCOUNT = "外部"
+
+
+def transaction_postings(row, bank_names, debt_names):
+    """一笔交易（金额为元）的复式分录 [(科目, 金额分), ...]，各分录金额之和为 0
+
+    银行卡科目金额为正表示余额增加；债务科目金额为正表示剩余欠款减少。
+    只有转出方是本人银行卡时，转入的银行卡才按汇率入账。
+    """
+    cents = to_cents(row['金额'])
+    transaction_type = row['类型']
+    payment_method = row['支付方式']
+    target = row['对方账户']
+    from_bank = payment_method in bank_names
+    source = f"{BANK_ACCOUNT if from_bank else EXTERNAL_ACCOUNT}:{payment_method}"
+
+    if transaction_type == "收入":
+        return [(source, cents), (f"{EXTERNAL_ACCOUNT}:收入/{row['类别']}", -cents)]
+    if transaction_type == "支出":
+        if row['类别'] == '还款' and target in debt_names:
+            return [(source, -cents), (f"{DEBT_ACCOUNT}:{target}", cents)]
+        return [(source, -cents), (f"{EXTERNAL_ACCOUNT}:支出/{row['类别']}", cents)]
+    if transaction_type == "转账":
+        if from_bank and target in bank_names:
+            credited = int(round(cents * float(row['汇率'])))
+            return [(source, -cents), (f"{BANK_ACCOUNT}:{target}", credited),
+                    (f"{EXTERNAL_ACCOUNT}:汇兑差额", cents - credited)]
+        return [(source, -cents), (f"{EXTERNAL_ACCOUNT}:转出/{target}", cents)]
+    return []
+
+
+def postings_frame(df, bank_names, debt_names):
+    """交易表（金额为整数分）全部交易的分录，列为 交易ID、日期、科目、金额，规则与 transaction_postings 相同"""
+    bank_names, debt_names = list(bank_names), list(debt_names)
+    types = df['类型'].astype(str)
+    payment = df['支付方式'].astype(str)
+    target = df['对方账户'].astype(str)
+    cents = df['金额'].astype('int64')
+
+    from_bank = payment.isin(bank_names)
+    source = (BANK_ACCOUNT + ':' + payment).where(from_bank, EXTERNAL_ACCOUNT + ':' + payment)
+    source_amount = cents * types.map({"收入": 1, "支出": -1, "转账": -1}).fillna(0).astype('int64')
+
+    transfer = types == "转账"
+    repayment = (types == "支出") & (df['类别'].astype(str) == '还款') & target.isin(debt_names)
+    self_transfer = transfer & from_bank & target.isin(bank_names)
+    credited = (cents * df['汇率']).round().astype('int64')
+
+    counter = (EXTERNAL_ACCOUNT + ':' + types + '/' + df['类别'].astype(str))
+    counter = counter.mask(repayment, DEBT_ACCOUNT + ':' + target)
+    counter = counter.mask(transfer, EXTERNAL_ACCOUNT + ':转出/' + target)
+    counter = counter.mask(self_transfer, BANK_ACCOUNT + ':' + target)
+    counter_amount = (-source_amount).mask(self_transfer, credited)
+
+    ids = df.index.to_numpy()
+    dates = df['日期'].to_numpy()
+    fx = self_transfer.to_numpy()
+    postings = pd.concat([
+        pd.DataFrame({ID_COLUMN: ids, '日期': dates, '科目': source.to_numpy(), '金额': source_amount.to_numpy()}),
+        pd.DataFrame({ID_COLUMN: ids, '日期': dates, '科目': counter.to_numpy(), '金额': counter_amount.to_numpy()}),
+        pd.DataFrame({ID_COLUMN: ids[fx], '日期': dates[fx], '科目': f"{EXTERNAL_ACCOUNT}:汇兑差额",
+                      '金额': (cents - credited)[self_transfer].to_numpy()}),
+    ], ignore_index=True)
+    return postings[postings['金额'] != 0]
+
+
+# 核对的科目 -> (数据分区, 当前金额字段, 期初金额字段, 分录方向)；债务剩余 = 期初剩余 - 债务分录之和
+RECONCILE_ACCOUNTS = {
+    BANK_ACCOUNT: ('bank_accounts', '余额', '期初余额', 1),
+    DEBT_ACCOUNT: ('debts', '剩余', '期初剩余', -1),
+}
+
+
+def reconcile_ledger(transactions, data):
+    """按交易历史重算每张银行卡余额和每笔债务剩余
+
+    transactions 为交易表（金额为整数分），data 含 bank_accounts 和 debts。
+    未指明债务的旧还款按日期顺序记到第一笔仍有欠款的债务上（与当时的记账规则一致）。
+    返回 (差异列表, {交易ID: 补记的债务名})；差异项为 {'科目', '名称', '当前', '重算', '期初'}，
+    缺少期初金额的账户 '重算' 为 None，'期初' 为由当前金额倒推出的期初金额。
+    """
+    debts = data['debts']
+    repayments = transactions[(transactions['类型'] == '支出') & (transactions['类别'] == '还款')]
+    untargeted = ~repayments['对方账户'].isin(list(debts))
+
+    assigned = {}
+    if untargeted.any():
+        remaining = {name: to_cents(info['总额'] if info.get('期初剩余') is None else info['期初剩余'])
+                     for name, info in debts.items()}
+        order = repayments['日期'].to_numpy().argsort(kind='stable')
+        for transaction_id, target, cents, is_untargeted in zip(
+                repayments.index[order], repayments['对方账户'].iloc[order],
+                repayments['金额'].iloc[order], untargeted.iloc[order]):
+            if not is_untargeted:
+                remaining[target] -= int(cents)
+                continue
+            debt_name = next((name for name, left in remaining.items() if left > 0), None)
+            if debt_name:
+                remaining[debt_name] -= int(cents)
+                assigned[transaction_id] = debt_name
+        if assigned:
+            transactions = transactions.copy()
+            transactions.loc[list(assigned), '对方账户'] = list(assigned.values())
+
+    totals = postings_frame(transactions, data['bank_accounts'], debts).groupby('科目')['金额'].sum()
+
+    differences = []
+    for kind, (section, balance_field, opening_field, direction) in RECONCILE_ACCOUNTS.items():
+        for name, info in data[section].items():
+            current = to_cents(info[balance_field])
+            posted = direction * int(totals.get(f"{kind}:{name}", 0))
+            if info.get(opening_field) is None:
+                differences.append({'科目': kind, '名称': name, '当前': from_cents(current),
+                                    '重算': None, '期初': from_cents(current - posted)})
+            elif to_cents(info[opening_field]) + posted != current:
+                differences.append({'科目': kind, '名称': name, '当前': from_cents(current),
+                                    '重算': from_cents(to_cents(info[opening_field]) + posted), '期初': info[opening_field]})
+    return differences, assigned
+
+
+def apply_reconciliation(data, differences):
+    """按核对结果修正余额和债务剩余；缺少期初金额的账户只补记期初金额，当前金额不变"""
+    for difference in differences:
+        section, balance_field, opening_field, _ = RECONCILE_ACCOUNTS[difference['科目']]
+        info = data[section][difference['名称']]
+        info[opening_field] = difference['期初']
+        if difference['重算'] is not None:
+            info[balance_field] = difference['重算']
+            if difference['科目'] == DEBT_ACCOUNT:
+                info["状态"] = "已还清" if info["剩余"] <= 0 else "还款中"
+
+
+class BalanceHistory:
+    """银行卡和债务科目按日期累计的分录金额（整数分），用于查询任意日期的余额和净资产走势
+
+    每个科目保存升序的日期数组和截至各日期（含当天）的累计分录金额：
+    某日的余额 = 当前余额 - 该日之后的分录之和，按日期查询用二分查找。
+    记账时只对该日期及之后的累计值整体加减，不必重建。
+    """
+
+    def __init__(self, bank_names=(), debt_names=()):
+        self.names = (frozenset(bank_names), frozenset(debt_names))  # 构建时的账户集合，变化后需重建
+        self.dates = {}  # 科目 -> datetime64[D] 数组
+        self.totals = {}  # 科目 -> int64 累计金额数组
+
+    @classmethod
+    def from_frame(cls, df, bank_names, debt_names):
+        """由交易表（金额为整数分）一次性构建"""
+        history = cls(bank_names, debt_names)
+        postings = postings_frame(df, bank_names, debt_names)
+        postings = postings[~postings['科目'].str.startswith(EXTERNAL_ACCOUNT + ':')]
+        daily = postings.groupby(['科目', postings['日期'].to_numpy().astype('datetime64[D]')])['金额'].sum()
+        for account, series in daily.groupby(level=0):
+            history.dates[account] = series.index.get_level_values(1).to_numpy().astype('datetime64[D]')
+            history.totals[account] = series.to_numpy().astype('int64').cumsum()
+        return history
+
+    def add(self, account, date, cents):
+        """记入一条分录：该日期及之后的累计值加上 cents（外部科目忽略）"""
+        if account.startswith(EXTERNAL_ACCOUNT + ':') or not cents:
+            return
+        day = np.datetime64(pd.Timestamp(date).date(), 'D')
+        dates = self.dates.get(account, np.array([], dtype='datetime64[D]'))
+        totals = self.totals.get(account, np.array([], dtype='int64'))
+
+        i = int(np.searchsorted(dates, day))
+        if i == len(dates) or dates[i] != day:
+            dates = np.insert(dates, i, day)
+            totals = np.insert(totals, i, totals[i - 1] if i else 0)
+        totals[i:] += cents
+        self.dates[account] = dates
+        self.totals[account] = totals
+
+    def values_as_of(self, account, current, days):
+        """科目在各日期（当天结束时）的金额（元）；current 为当前余额或剩余（元）"""
+        kind = account.split(':', 1)[0]
+        direction = RECONCILE_ACCOUNTS[kind][3]
+        days = np.asarray(days, dtype='datetime64[D]')
+        if account not in self.dates:
+            return np.full(len(days), to_cents(current)) / 100
+
+        totals = self.totals[account]
+        i = np.searchsorted(self.dates[account], days, side='right')
+        after = totals[-1] - np.where(i > 0, totals[i - 1], 0)
+        return (to_cents(current) - direction * after) / 100
+
+    def net_worth(self, bank_accounts, debts, days, convert=None):
+        """各日期的 总资产、总债务、净资产（元）
+
+        convert(金额数组, 币种) 把账户各日期的金额折算为同一币种后再相加；不传时直接相加。
+        """
+        days = np.asarray(days, dtype='datetime64[D]')
+
+        def values(kind, name, info, field):
+            result = self.values_as_of(f"{kind}:{name}", info[field], days)
+            return convert(result, info.get("币种", "人民币")) if convert else result
+
+        assets = sum((values(BANK_ACCOUNT, name, info, "余额") for name, info in bank_accounts.items()),
+                     np.zeros(len(days)))
+        liabilities = sum((values(DEBT_ACCOUNT, name, info, "剩余") for name, info in debts.items()),
+                          np.zeros(len(days)))
+        return pd.DataFrame({'总资产': assets, '总债务': liabilities, '净资产': assets - liabilities},
+                            index=pd.DatetimeIndex(days, name='日期')).round(2)
+
+
+BUDGET_THRESHOLDS = (80, 100, 120)  # 预算使用率（%）提醒阈值
+
+
+def budget_crossings(used_before, used_after, amount):
+    """已用金额从 used_before 变为 used_after 时向上越过的提醒阈值"""
+    if amount <= 0:
+        return []
+    before, after = used_before / amount * 100, used_after / amount * 100
+    return [threshold for threshold in BUDGET_THRESHOLDS if before < threshold <= after]
+
+
+class BudgetAlertInbox:
+    """用户的预算提醒收件箱：提醒只追加写入 budget_alerts.jsonl，已读和已发邮件的位置记在 budget_alerts.json
+
+    写入、标记已读和发送邮件汇总时需持有账本锁。
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.alerts_file = os.path.join(data_dir, "budget_alerts.jsonl")
+        self.state_file = os.path.join(data_dir, "budget_alerts.json")
+
+    def state(self):
+        """{'total': 提醒条数, 'read': 已读条数, 'emailed': 已发邮件条数, 'digest': 是否发送每日邮件汇总}"""
+        state = {'total': 0, 'read': 0, 'emailed': 0, 'digest': False}
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                state.update(json.load(f))
+        return state
+
+    def save_state(self, state):
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.state_file)
+
+    def append(self, alerts):
+        """追加提醒（调用方需持有账本锁）"""
+        if not alerts:
+            return
+        with open(self.alerts_file, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(alert, ensure_ascii=False) + '\n' for alert in alerts)
+        state = self.state()
+        state['total'] += len(alerts)
+        self.save_state(state)
+
+    def alerts(self, start=0):
+        """第 start 条起的提醒（按时间先后）"""
+        if not os.path.exists(self.alerts_file):
+            return []
+        with open(self.alerts_file, 'r', encoding='utf-8') as f:
+            return [json.loads(line) for line in itertools.islice(f, start, None) if line.endswith('\n')]
+
+    def update_state(self, **changes):
+        """在账本锁内修改已读位置、邮件汇总开关等"""
+        with ledger_lock(self.data_dir):
+            state = self.state()
+            state.update(changes)
+            self.save_state(state)
+
+    def mark_read(self):
+        with ledger_lock(self.data_dir):
+            state = self.state()
+            state['read'] = state['total']
+            self.save_state(state)
+
+    def mark_emailed(self, count):
+        """邮件汇总发送成功后记下已发条数；发送期间位置可能已被重置（关闭再开启汇总），只向前移动"""
+        with ledger_lock(self.data_dir):
+            state = self.state()
+            state['emailed'] = max(state['emailed'], count)
+            self.save_state(state)
+
+
+CURRENCY_SYMBOLS = {"人民币": "¥", "马币": "RM"}
+
+
+def currency_prefix(currency):
+    return CURRENCY_SYMBOLS.get(currency, f"{currency} ")
+
+
+class FxRateTable:
+    """本地汇率表 fx_rates.csv（日期, 币种, 汇率），供所有会话共享
+
+    汇率为 1 单位该币种折合多少人民币，人民币固定为 1；任意两种币种之间经人民币换算。
+    按日期做 as-of 查找：取当天或之前最近的一条汇率，早于第一条记录时取最早的一条。
+    """
+    PIVOT = "人民币"
+    COLUMNS = ['日期', '币种', '汇率']
+
+    def __init__(self, rates_file="fx_rates.csv"):
+        self.rates_file = rates_file
+        self.lock = threading.Lock()
+        self.rates = self.parse(io.StringIO(','.join(self.COLUMNS)))
+        self.earliest = pd.Series(dtype='float64')  # 币种 -> 最早的汇率
+        self.signature = None
+
+    def file_signature(self):
+        try:
+            stat = os.stat(self.rates_file)
+            return stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def parse(cls, source):
+        """读取汇率 CSV，去掉无效行，按日期排序"""
+        df = pd.read_csv(source, dtype=str, encoding='utf-8-sig')
+        missing = [column for column in cls.COLUMNS if column not in df.columns]
+        if missing:
+            raise ValueError(f"汇率文件缺少列: {', '.join(missing)}")
+
+        df = pd.DataFrame({
+            '日期': pd.to_datetime(df['日期'], errors='coerce').astype('datetime64[ns]'),
+            '币种': df['币种'].str.strip(),
+            '汇率': pd.to_numeric(df['汇率'], errors='coerce'),
+        }).dropna()
+        df = df[(df['汇率'] > 0) & (df['币种'] != cls.PIVOT)]
+        return df.drop_duplicates(['日期', '币种'], keep='last').sort_values('日期', kind='stable').reset_index(drop=True)
+
+    def refresh(self):
+        """汇率文件被改动过时重新加载（调用方需持有锁）"""
+        signature = self.file_signature()
+        if signature == self.signature:
+            return
+        rates = self.parse(self.rates_file) if signature is not None else self.rates.iloc[:0]
+        self.rates = rates
+        self.earliest = rates.groupby('币种')['汇率'].first()
+        self.signature = signature
+
+    def version(self):
+        """汇率文件的版本，用于页面缓存"""
+        with self.lock:
+            self.refresh()
+            return self.signature
+
+    def currencies(self):
+        with self.lock:
+            self.refresh()
+            return [self.PIVOT] + sorted(self.earliest.index)
+
+    def latest(self):
+        """各币种最新的一条汇率"""
+        with self.lock:
+            self.refresh()
+            return self.rates.groupby('币种').tail(1).sort_values('币种').reset_index(drop=True)
+
+    def merge(self, rates):
+        """并入新的汇率（同一日期同一币种以新的为准）并写回文件"""
+        with self.lock:
+            self.refresh()
+            merged = pd.concat([self.rates, rates], ignore_index=True)
+            merged = merged.drop_duplicates(['日期', '币种'], keep='last').sort_values(['日期', '币种'])
+            output = merged.assign(日期=merged['日期'].dt.strftime('%Y-%m-%d'))
+
+            tmp_file = self.rates_file + '.tmp'
+            output.to_csv(tmp_file, index=False, encoding='utf-8')
+            os.replace(tmp_file, self.rates_file)
+            self.refresh()
+
+    def import_csv(self, source):
+        """导入汇率 CSV，返回有效的汇率条数"""
+        rates = self.parse(source)
+        if not rates.empty:
+            self.merge(rates)
+        return len(rates)
+
+    def rates_as_of(self, currencies, dates):
+        """各 (币种, 日期) 折合人民币的汇率数组；人民币为 1，没有任何汇率的币种为 NaN"""
+        query = pd.DataFrame({
+            '日期': pd.to_datetime(pd.Series(dates)).astype('datetime64[ns]').to_numpy(),
+            '币种': np.asarray(currencies, dtype=object),
+        })
+        with self.lock:
+            self.refresh()
+            rates, earliest = self.rates, self.earliest
+
+        order = np.argsort(query['日期'].to_numpy(), kind='stable')
+        matched = pd.merge_asof(query.iloc[order], rates, on='日期', by='币种', direction='backward')
+        result = np.empty(len(query))
+        result[order] = matched['汇率'].fillna(matched['币种'].map(earliest)).to_numpy(dtype='float64')
+        result[query['币种'].to_numpy() == self.PIVOT] = 1.0
+        return result
+
+    def convert(self, amounts, currencies, dates, base):
+        """把各自币种的金额按当日汇率折算为 base 币种（单个币种，或与金额等长的币种数组）
+
+        返回 (折算后的金额数组, 缺少汇率的币种集合)；缺少汇率的币种按 1:1 折算。
+        """
+        amounts = np.asarray(amounts, dtype='float64')
+        currencies = np.asarray(currencies, dtype=object)
+        if len(amounts) == 0:
+            return amounts, set()
+        if isinstance(dates, (str, datetime, pd.Timestamp)):
+            dates = [dates] * len(amounts)
+
+        bases = np.array(np.broadcast_to(np.asarray(base, dtype=object), amounts.shape))
+        to_pivot = self.rates_as_of(currencies, dates)
+        base_rates = self.rates_as_of(bases, dates)
+        missing = set(currencies[np.isnan(to_pivot)]) | set(bases[np.isnan(base_rates)])
+
+        factor = np.nan_to_num(to_pivot, nan=1.0) / np.nan_to_num(base_rates, nan=1.0)
+        factor[currencies == bases] = 1.0
+        return (amounts * factor).round(2), missing
+
+
+@st.cache_resource
+def get_fx_rates():
+    """进程内共享的汇率表"""
+    return FxRateTable()
+
+
+class LedgerRegistry:
+    """进程内按用户名共享的账本快照：同一用户的多个会话共用一份交易表
+
+    会话拿到的是共享交易表的浅拷贝，修改时 pandas 只复制被改动的列，共享快照本身不变。
+    总内存超过上限时，按最近使用顺序淘汰没有活跃会话引用的账本。
+    """
+    SESSION_IDLE = 1800  # 秒；超过此时间没有重跑的会话不再计为引用
+
+    def __init__(self, max_bytes=LEDGER_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # 用户名 -> 快照，最近使用的在末尾
+        self.refs = {}  # 用户名 -> {会话ID: 最后活动时间}
+
+    @staticmethod
+    def session_id():
+        ctx = get_script_run_ctx()
+        return ctx.session_id if ctx else None
+
+    def touch(self, username):
+        """登记当前会话正在使用该用户的账本"""
+        with self.lock:
+            self.refs.setdefault(username, {})[self.session_id()] = time.monotonic()
+            if username in self.entries:
+                self.entries.move_to_end(username)
+
+    def release(self, username):
+        with self.lock:
+            self.refs.get(username, {}).pop(self.session_id(), None)
+
+    def active_refs(self, username):
+        """仍在活动的会话数（调用方需持有锁）"""
+        deadline = time.monotonic() - self.SESSION_IDLE
+        sessions = self.refs.get(username, {})
+        for session, last_seen in list(sessions.items()):
+            if last_seen < deadline:
+                del sessions[session]
+        return len(sessions)
+
+    def checkout(self, username, signature):
+        """返回与磁盘签名一致的共享快照，没有时返回 None"""
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None or entry['signature'] != signature:
+                return None
+            self.entries.move_to_end(username)
+            return entry
+
+    def publish(self, username, signature, cursor, transactions, sections, cube_rows, text_index):
+        """登记与磁盘签名一致的最新数据为该用户的共享快照"""
+        entry = {
+            'signature': signature,
+            'cursor': cursor,
+            'transactions': transactions.copy(deep=False),
+            'sections': copy.deepcopy(sections),
+            'monthly_cube': cube_rows,
+            'text_index': text_index,
+            'nbytes': int(transactions.memory_usage(deep=True).sum()) + text_index.nbytes(),
+        }
+        with self.lock:
+            self.entries[username] = entry
+            self.entries.move_to_end(username)
+            self.evict()
+
+    def evict(self):
+        """按最近使用顺序淘汰空闲账本，直到总内存不超过上限（调用方需持有锁）"""
+        total = sum(entry['nbytes'] for entry in self.entries.values())
+        for username in list(self.entries):
+            if total <= self.max_bytes:
+                break
+            if self.active_refs(username):
+                continue
+            total -= self.entries.pop(username)['nbytes']
+
+
+@st.cache_resource
+def get_ledger_registry():
+    """进程内共享的账本快照表"""
+    return LedgerRegistry()
 
 
 class FinanceApp:
+    SECTIONS = ('bank_accounts', 'debts', 'budgets', 'saved_filters')  # 以字典形式保存的数据分区
+    PAGES = {  # 导航标签 -> 页面方法，每次只运行当前页面
+        "💰 添加交易": 'add_transaction_form',
+        "📊 交易记录": 'show_transactions',
+        "🏦 银行卡": 'show_bank_accounts',
+        "📋 债务管理": 'show_debts',
+        "💰 预算管理": 'show_budgets',
+        "📈 财务分析": 'show_analytics',
+    }
+    ALERTS_SHOWN = 20  # 侧边栏显示最近的预算提醒条数
+
     def __init__(self, username):
         self.username = username
         self.data_file = f"user_data/{username}/finance_data.json"
         self.setup_session_state()
-        self.load_data()
+
+        # 存储对象在会话内复用；只有磁盘数据确实变化时才重新加载
+        cache = st.session_state.ledger_cache
+        self.registry = get_ledger_registry()
+        self.fx = get_fx_rates()
+        if cache.get('username') != username:
+            if cache.get('username'):
+                self.registry.release(cache['username'])
+            data_dir = os.path.dirname(self.data_file)
+            cache.clear()
+            cache['username'] = username
+            cache['store'] = open_ledger_store(data_dir)
+            cache['signature'] = None
+        self.store = cache['store']
+        self.registry.touch(username)
+        self.alerts = BudgetAlertInbox(os.path.dirname(self.data_file))
+        self.live_views = []  # (占位容器, 绘制函数)，编辑器局部重跑时重画
+        self.live_views_drawn = False
+        self.refresh_ledger()
+
+    def refresh_ledger(self):
+        """首次使用时加载账本，磁盘数据被其他会话修改过时同步"""
+        cache = st.session_state.ledger_cache
+        if cache['signature'] is None:
+            self.load_data()
+        elif self.store.signature() != cache['signature']:
+            self.sync_data()
+        # 预算已用金额保持最新，记账时才能增量检查预算提醒
+        self.refresh_budget_usage()
 
     def setup_session_state(self):
         """初始化会话状态"""
         if 'transactions' not in st.session_state:
-            st.session_state.transactions = pd.DataFrame(columns=[
-                '日期', '类型', '类别', '项目描述', '金额', '币种', '支付方式', '对方账户', '汇率', '备注'
-            ])
+            st.session_state.transactions = transaction_frame()
 
         if 'bank_accounts' not in st.session_state:
             st.session_state.bank_accounts = {}
@@ -354,54 +2384,526 @@ class FinanceApp:
         if 'budgets' not in st.session_state:
             st.session_state.budgets = {}
 
+        # 常用筛选：名称 -> 筛选条件
+        if 'saved_filters' not in st.session_state:
+            st.session_state.saved_filters = {}
+
         # 交易编辑状态
         if 'editing_transaction_index' not in st.session_state:
             st.session_state.editing_transaction_index = None
 
+        # 尚未写入日志的交易操作，以及上次保存时各字典数据的副本（用于比较变更）
+        if 'pending_ops' not in st.session_state:
+            st.session_state.pending_ops = []
+
+        # 尚未保存的修改记入银行卡/债务的分录金额（科目 -> 分），以及被修改交易在修改前的记录（新增的为 None），
+        # 保存时与其他会话的修改合并用
+        if 'pending_postings' not in st.session_state:
+            st.session_state.pending_postings = {}
+
+        if 'pending_bases' not in st.session_state:
+            st.session_state.pending_bases = {}
+
+        if 'persisted_sections' not in st.session_state:
+            st.session_state.persisted_sections = {section: {} for section in self.SECTIONS}
+
+        if 'monthly_cube' not in st.session_state:
+            st.session_state.monthly_cube = MonthlyCube()
+
+        if 'text_index' not in st.session_state:
+            st.session_state.text_index = TextIndex()
+
+        # 会话级账本缓存：当前用户、存储对象和已加载数据的磁盘签名
+        if 'ledger_cache' not in st.session_state:
+            st.session_state.ledger_cache = {}
+
+        # 账本版本号：内存数据每次变化时递增，各页面的计算结果按版本缓存
+        if 'ledger_version' not in st.session_state:
+            st.session_state.ledger_version = 0
+
+        if 'section_cache' not in st.session_state:
+            st.session_state.section_cache = {'version': None, 'results': {}}
+
+        # 交易筛选结果：(筛选条件, 起止日期, 账本版本) -> 结果，最近用过的在末尾
+        if 'filter_cache' not in st.session_state:
+            st.session_state.filter_cache = collections.OrderedDict()
+
+        # 按日期累计的余额历史，首次使用时构建，之后随记账增量更新
+        if 'balance_history' not in st.session_state:
+            st.session_state.balance_history = None
+
+        # 预算已用金额对应的 (汇率表版本, 预算设置)；为 None 时需要整体重算
+        if 'budget_usage' not in st.session_state:
+            st.session_state.budget_usage = None
+
+        # 本次修改触发、保存成功后写入收件箱的预算提醒
+        if 'budget_alerts_pending' not in st.session_state:
+            st.session_state.budget_alerts_pending = []
+
+        # 本会话修改前各预算 (月份, 类别) 的已用金额，与其他会话的修改合并后据此重新检查提醒
+        if 'pending_budget_bases' not in st.session_state:
+            st.session_state.pending_budget_bases = {}
+
     def load_data(self):
-        """从文件加载数据"""
+        """从快照和日志加载数据"""
         try:
-            if os.path.exists(self.data_file):
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-
-                if 'transactions' in data and data['transactions']:
-                    st.session_state.transactions = pd.DataFrame(data['transactions'])
-                if 'bank_accounts' in data:
-                    st.session_state.bank_accounts = data['bank_accounts']
-                if 'debts' in data:
-                    st.session_state.debts = data['debts']
-                if 'budgets' in data:
-                    st.session_state.budgets = data['budgets']
+            with self.store.locked():
+                self.load_store_data()
+        except Exception as e:
+            st.error(f"加载数据失败: {e}")
+
+    def load_store_data(self):
+        """整体重新加载（调用方需持有账本锁）；磁盘数据未变时直接使用其他会话已加载的共享快照"""
+        shared = self.registry.checkout(self.username, self.store.signature())
+        if shared is not None:
+            self.store.seek(shared['cursor'])
+            st.session_state.transactions = shared['transactions'].copy(deep=False)
+            st.session_state.monthly_cube = MonthlyCube.from_rows(shared['monthly_cube'])
+            st.session_state.text_index = shared['text_index'].share()
+            data = copy.deepcopy(shared['sections'])
+        else:
+            data, changes = self.store.load()
+
+            st.session_state.transactions = sort_transactions(transaction_frame(data['transactions']))
 
+            # 月度汇总：持久化的结果加上日志尾部的变更；旧数据没有汇总时整体重建一次
+            if data.get('monthly_cube') is not None:
+                cube = MonthlyCube.from_rows(data['monthly_cube'])
+                for old_row, new_row in changes:
+                    cube.apply_change(old_row, new_row)
+            else:
+                cube = MonthlyCube.from_frame(st.session_state.transactions)
+            st.session_state.monthly_cube = cube
+
+            # 全文索引同理：持久化的索引加上日志尾部的变更，没有时整体重建
+            if data.get('text_index') is not None:
+                index = TextIndex.from_postings(data['text_index'])
+                for old_row, new_row in changes:
+                    index.apply_change((new_row or old_row)[ID_COLUMN], old_row, new_row)
+            else:
+                index = TextIndex.from_frame(st.session_state.transactions)
+            st.session_state.text_index = index
+
+        for section in self.SECTIONS:
+            setattr(st.session_state, section, data[section])
+
+        st.session_state.pending_ops = []
+        st.session_state.pending_postings = {}
+        st.session_state.pending_bases = {}
+        st.session_state.persisted_sections = copy.deepcopy({s: data[s] for s in self.SECTIONS})
+        st.session_state.balance_history = None
+        st.session_state.budget_usage = None
+        st.session_state.budget_alerts_pending = []
+        st.session_state.pending_budget_bases = {}
+
+        # 旧数据刚补发了交易ID，立即写回快照使ID固定下来
+        if data.get('ids_assigned'):
+            self.store.compact(self.snapshot_data())
+        st.session_state.ledger_cache['signature'] = self.store.signature()
+        st.session_state.ledger_version += 1
+        if shared is None:
+            self.publish_ledger()
+
+    def publish_ledger(self):
+        """把与磁盘一致的当前数据登记为共享快照，供同一用户的其他会话直接使用"""
+        self.registry.publish(
+            self.username, st.session_state.ledger_cache['signature'], self.store.cursor(),
+            st.session_state.transactions, {s: getattr(st.session_state, s) for s in self.SECTIONS},
+            st.session_state.monthly_cube.to_rows(), st.session_state.text_index.share())
+
+    def sync_data(self):
+        """其他会话修改了数据：只应用新增的操作，无法增量同步时整体重新加载"""
+        try:
+            with self.store.locked():
+                ops = self.store.read_new_ops()
+                if ops is None or not self.apply_remote_ops(ops):
+                    self.load_store_data()
+                    return
+                st.session_state.ledger_cache['signature'] = self.store.signature()
+                st.session_state.ledger_version += 1
+                self.publish_ledger()
         except Exception as e:
             st.error(f"加载数据失败: {e}")
 
+    def apply_remote_ops(self, ops):
+        """把其他会话写入的操作应用到内存数据（不记入待写日志），内存数据与操作对不上时返回 False"""
+        for is_add, group in itertools.groupby(ops, key=lambda op: op['op'] in ('add', 'add_many')):
+            if is_add:
+                rows = [row for op in group for row in (op['rows'] if op['op'] == 'add_many' else [op['row']])]
+                st.session_state.transactions = insert_transactions(st.session_state.transactions, transaction_frame(rows))
+                for row in rows:
+                    self.apply_ledger_change(row[ID_COLUMN], None, row, notify=False)
+                continue
+
+            for op in group:
+                kind = op['op']
+                if kind in ('update', 'delete') and op['id'] not in st.session_state.transactions.index:
+                    return False
+                if kind == 'update':
+                    self.update_transaction_row(op['id'], op['row'], log=False)
+                elif kind == 'delete':
+                    self.delete_transaction_rows([op['id']], log=False)
+                elif kind == 'set':
+                    getattr(st.session_state, op['section'])[op['key']] = op['value']
+                    st.session_state.persisted_sections[op['section']][op['key']] = copy.deepcopy(op['value'])
+                    if op['section'] == 'budgets':
+                        st.session_state.budget_usage = None  # 写入的已用金额可能已过时
+                elif kind == 'remove':
+                    getattr(st.session_state, op['section']).pop(op['key'], None)
+                    st.session_state.persisted_sections[op['section']].pop(op['key'], None)
+        st.session_state.balance_history = None
+        return True
+
     def save_data(self):
-        """保存数据到文件"""
+        """把本次的变更追加到日志，日志过长时合并为新快照
+
+        写入前在账本锁内检查版本号：其他会话已写入的修改与本次修改不涉及同一对象时先合并再写入。
+        银行卡余额、债务剩余随记账分录变化的部分不算冲突，合并后在其他会话写入的值上重新记入本次的分录；
+        无法增量同步时整体重新加载，再把本次的修改重新应用上去。
+        涉及同一笔交易、同一张银行卡的设置等时放弃本次修改，重新加载并提示冲突。
+        """
+        st.session_state.ledger_version += 1
         try:
-            data = {
-                'transactions': st.session_state.transactions.to_dict('records'),
-                'bank_accounts': st.session_state.bank_accounts,
-                'debts': st.session_state.debts,
-                'budgets': st.session_state.budgets
-            }
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            ops = st.session_state.pending_ops + self.diff_sections()
+            with self.store.locked():
+                remote_ops = self.store.read_new_ops()
+                if remote_ops:
+                    posted = self.posting_only_keys(
+                        ops, st.session_state.persisted_sections, st.session_state.pending_postings)
+                    local_keys = set().union(*map(ledger_op_keys, ops)) - posted
+                    remote_keys = set().union(*map(ledger_op_keys, remote_ops))
+                    removed = {(op['section'], op['key']) for op in remote_ops if op['op'] == 'remove'}
+                    if local_keys & remote_keys or posted & removed:
+                        self.load_store_data()
+                        st.session_state.conflict_message = "数据已在其他窗口中被修改，本次修改未保存，已加载最新数据，请重新操作"
+                        return
+                    local = self.local_changes()
+                    used_local = {key: self.budget_used(key) for key in st.session_state.pending_budget_bases
+                                  if key[1] in st.session_state.budgets.get(key[0], {})}
+                    if self.apply_remote_ops(remote_ops):
+                        for section, name in posted & remote_keys:
+                            accounts = getattr(st.session_state, section)
+                            accounts[name] = self.rebase_account(
+                                section, name, accounts[name], local['sections'][section][name], local['postings'])
+                        self.recheck_budget_alerts(used_local)
+                    elif not self.replay_local_changes(local):
+                        return
+                    ops = st.session_state.pending_ops + self.diff_sections()
+                elif remote_ops is None:
+                    if not self.replay_local_changes(self.local_changes()):
+                        return
+                    ops = st.session_state.pending_ops + self.diff_sections()
+
+                if self.store.needs_compaction(sum(ledger_op_size(op) for op in ops)):
+                    # 本次变更加上已有日志足以触发合并时，直接写新快照，不再逐条追加
+                    self.store.compact(self.snapshot_data())
+                elif ops:
+                    self.store.append(ops)
+                st.session_state.pending_ops = []
+                st.session_state.pending_postings = {}
+                st.session_state.pending_bases = {}
+                self.alerts.append(st.session_state.budget_alerts_pending)
+                st.session_state.budget_alerts_new = st.session_state.budget_alerts_pending
+                st.session_state.budget_alerts_pending = []
+                st.session_state.pending_budget_bases = {}
+                st.session_state.persisted_sections = copy.deepcopy(
+                    {section: getattr(st.session_state, section) for section in self.SECTIONS})
+
+                # 自己写入的数据无需在下次重跑时重新加载
+                st.session_state.ledger_cache['signature'] = self.store.signature()
+                self.publish_ledger()
         except Exception as e:
             st.error(f"保存数据失败: {e}")
 
-    def get_currency_statistics(self, df):
-        """获取币种统计信息"""
+    POSTED_FIELDS = {'bank_accounts': ('余额', '最后更新'), 'debts': ('剩余', '状态')}  # 随记账分录变化的字段
+
+    def posting_only_keys(self, section_ops, persisted, postings):
+        """只因记账分录而变化的银行卡和债务 (分区, 名称)：其余字段都没变，金额的变化正好等于未保存的分录"""
+        keys = set()
+        for op in section_ops:
+            if op['op'] != 'set' or op['section'] not in self.POSTED_FIELDS:
+                continue
+            base = persisted[op['section']].get(op['key'])
+            if base is not None and self.rebase_account(
+                    op['section'], op['key'], base, op['value'], postings) == op['value']:
+                keys.add((op['section'], op['key']))
+        return keys
+
+    @staticmethod
+    def rebase_account(section, name, base, local, postings):
+        """在 base（已保存的或其他会话写入的账户）上重新记入未保存的分录，最后更新时间取本会话的"""
+        kind = next(kind for kind, spec in RECONCILE_ACCOUNTS.items() if spec[0] == section)
+        _, balance_field, _, direction = RECONCILE_ACCOUNTS[kind]
+        cents = postings.get(f"{kind}:{name}", 0)
+        value = copy.deepcopy(base)
+        value[balance_field] = from_cents(to_cents(base[balance_field]) + direction * cents)
+        if kind == BANK_ACCOUNT:
+            if "最后更新" in local:
+                value["最后更新"] = local["最后更新"]
+        elif value["剩余"] <= 0:
+            value["状态"] = "已还清"
+        elif value["状态"] == "已还清":
+            value["状态"] = "还款中"
+        return value
+
+    def local_changes(self):
+        """本会话尚未保存的全部修改，整体重新加载后用 replay_local_changes 重新应用"""
+        return {
+            'ops': list(st.session_state.pending_ops),
+            'postings': dict(st.session_state.pending_postings),
+            'bases': dict(st.session_state.pending_bases),
+            'sections': copy.deepcopy({section: getattr(st.session_state, section) for section in self.SECTIONS}),
+            'persisted': copy.deepcopy(st.session_state.persisted_sections),
+            'section_ops': self.diff_sections(),
+        }
+
+    def replay_local_changes(self, local):
+        """整体重新加载（调用方需持有账本锁），再把本会话的修改应用到最新数据上
+
+        本次修改或删除的交易、手动修改的银行卡/债务/预算等已被其他会话改过时视为冲突，
+        保留最新数据并提示，返回 False。
+        """
+        self.load_store_data()
+        self.refresh_budget_usage()
+        transactions = st.session_state.transactions
+        persisted = st.session_state.persisted_sections
+        posted = self.posting_only_keys(local['section_ops'], local['persisted'], local['postings'])
+
+        conflict = False
+        for op in local['ops']:
+            if op['op'] in ('update', 'delete'):
+                base = local['bases'].get(op['id'])
+                if base is not None and (op['id'] not in transactions.index or
+                                         transaction_records(transactions.loc[[op['id']]])[0] != base):
+                    conflict = True
+        for op in local['section_ops']:
+            key = (op['section'], op['key'])
+            if key in posted:
+                conflict |= op['key'] not in persisted[op['section']]
+            elif (self.stored_value(op['section'], persisted[op['section']].get(op['key'])) !=
+                  self.stored_value(op['section'], local['persisted'][op['section']].get(op['key']))):
+                conflict = True
+        if conflict:
+            st.session_state.conflict_message = "数据已在其他窗口中被修改，本次修改未保存，已加载最新数据，请重新操作"
+            return False
+
+        for op in local['ops']:
+            if op['op'] in ('add', 'add_many'):
+                rows = op['rows'] if op['op'] == 'add_many' else [op['row']]
+                st.session_state.transactions = insert_transactions(
+                    st.session_state.transactions, transaction_frame(rows))
+                for row in rows:
+                    self.apply_ledger_change(row[ID_COLUMN], None, row)
+                st.session_state.pending_ops.append(op)
+            elif op['op'] == 'update':
+                self.update_transaction_row(op['id'], op['row'])
+            elif op['op'] == 'delete':
+                self.delete_transaction_rows([op['id']])
+
+        st.session_state.pending_postings = local['postings']
+        for op in local['section_ops']:
+            section, key = op['section'], op['key']
+            if (section, key) in posted:
+                accounts = getattr(st.session_state, section)
+                accounts[key] = self.rebase_account(
+                    section, key, accounts[key], local['sections'][section][key], local['postings'])
+            elif op['op'] == 'set':
+                getattr(st.session_state, section)[key] = copy.deepcopy(op['value'])
+            else:
+                getattr(st.session_state, section).pop(key, None)
+        st.session_state.balance_history = None
+        return True
+
+    def rerun(self, message=None, scope="app"):
+        """重跑整页或当前局部；message 会在重跑后显示"""
+        if message and 'conflict_message' not in st.session_state:
+            st.session_state.flash_message = message
+        try:
+            st.rerun(scope=scope)
+        except st.errors.StreamlitAPIException:
+            # 局部重跑只能在局部重跑过程中发起；整页运行时退回整页重跑
+            st.rerun()
+
+    def show_flash_message(self):
+        """显示并清除上次重跑前留下的提示"""
+        message = st.session_state.pop('flash_message', None)
+        if message:
+            st.success(message)
+        conflict = st.session_state.pop('conflict_message', None)
+        if conflict:
+            st.warning(conflict)
+        for alert in st.session_state.pop('budget_alerts_new', []):
+            st.toast(f"🔔 {alert['月份']} {alert['类别']} 预算已用 {alert['阈值']}%："
+                     f"{alert['已用金额']:,.2f} / {alert['预算金额']:,.2f}")
+
+    def section_cache(self, key, build):
+        """返回 build() 的结果，账本版本不变时直接复用上次的结果"""
+        cache = st.session_state.section_cache
+        if cache['version'] != st.session_state.ledger_version:
+            cache['version'] = st.session_state.ledger_version
+            cache['results'] = {}
+        if key not in cache['results']:
+            cache['results'][key] = build()
+        return cache['results'][key]
+
+    def snapshot_data(self):
+        """当前完整数据，用于写快照"""
+        return {
+            'transactions': transaction_records(st.session_state.transactions),
+            'bank_accounts': st.session_state.bank_accounts,
+            'debts': st.session_state.debts,
+            'budgets': st.session_state.budgets,
+            'saved_filters': st.session_state.saved_filters,
+            'monthly_cube': st.session_state.monthly_cube.to_rows(),
+            'text_index': st.session_state.text_index.to_postings()
+        }
+
+    def diff_sections(self):
+        """比较银行卡、债务、预算与上次保存时的差异，生成日志操作"""
+        ops = []
+        for section in self.SECTIONS:
+            current = getattr(st.session_state, section)
+            persisted = st.session_state.persisted_sections[section]
+
+            for key, value in current.items():
+                if key not in persisted or self.stored_value(section, persisted[key]) != self.stored_value(section, value):
+                    ops.append({'op': 'set', 'section': section, 'key': key, 'value': value})
+            for key in persisted:
+                if key not in current:
+                    ops.append({'op': 'remove', 'section': section, 'key': key})
+        return ops
+
+    @staticmethod
+    def stored_value(section, value):
+        """比较是否需要写入时使用的内容：预算的已用金额由交易推算，只有它变化时不写入"""
+        if section == 'budgets':
+            return {category: {k: v for k, v in info.items() if k != "已用金额"} for category, info in value.items()}
+        return value
+
+    def apply_ledger_change(self, transaction_id, old_row, new_row, notify=True):
+        """单笔交易新增、修改或删除后，增量更新月度汇总、全文索引和预算已用金额
+
+        notify=True 时检查受影响的预算是否越过提醒阈值（其他会话写入的变更由该会话提醒）。
+        """
+        st.session_state.monthly_cube.apply_change(old_row, new_row)
+        st.session_state.text_index.apply_change(transaction_id, old_row, new_row)
+        if notify:
+            # 本会话的修改：记下该交易最早的已保存状态，整体重新加载后据此判断是否被其他会话改过
+            st.session_state.pending_bases.setdefault(transaction_id, old_row)
+        changes = [(self.tracked_budget(row), row, sign)
+                   for row, sign in ((old_row, -1), (new_row, 1)) if row is not None]
+        changes = [change for change in changes if change[0] is not None]
+        used_before = {key: self.budget_used(key) for key, _, _ in changes}
+        for key, row, sign in changes:
+            self.track_budget_usage(key, row, sign)
+        if notify:
+            self.check_budget_alerts(used_before)
+
+    def append_transaction_row(self, row):
+        """在账本末尾追加一条交易记录并分配交易ID（不处理余额），返回交易ID"""
+        row = {ID_COLUMN: new_transaction_id(), **row}
+        st.session_state.transactions = insert_transactions(st.session_state.transactions, transaction_frame([row]))
+        self.apply_ledger_change(row[ID_COLUMN], None, row)
+        st.session_state.pending_ops.append({'op': 'add', 'row': row})
+        return row[ID_COLUMN]
+
+    def update_transaction_row(self, transaction_id, row, log=True):
+        """按交易ID替换交易记录（不处理余额）；log=False 时不记入待写日志"""
+        transactions = st.session_state.transactions
+        old_row = transaction_records(transactions.loc[[transaction_id]])[0]
+        self.apply_ledger_change(transaction_id, old_row, row, notify=log)
+
+        new_values = transaction_frame([{ID_COLUMN: transaction_id, **row}])
+        if new_values.at[transaction_id, '日期'] != transactions.at[transaction_id, '日期']:
+            # 日期变了：移到新日期的位置，保持交易表按日期有序
+            st.session_state.transactions = insert_transactions(transactions.drop(transaction_id), new_values)
+            if log:
+                st.session_state.pending_ops.append({'op': 'update', 'id': transaction_id, 'row': row})
+            return
+        for column in CATEGORY_COLUMNS:
+            if row[column] not in transactions[column].cat.categories:
+                transactions[column] = transactions[column].cat.add_categories([row[column]])
+        for column in TRANSACTION_COLUMNS:
+            transactions.at[transaction_id, column] = new_values.at[transaction_id, column]
+        if log:
+            st.session_state.pending_ops.append({'op': 'update', 'id': transaction_id, 'row': row})
+
+    def delete_transaction_rows(self, transaction_ids, log=True):
+        """按交易ID删除交易记录（不处理余额）；log=False 时不记入待写日志"""
+        for old_row in transaction_records(st.session_state.transactions.loc[transaction_ids]):
+            self.apply_ledger_change(old_row[ID_COLUMN], old_row, None, notify=log)
+        st.session_state.transactions = st.session_state.transactions.drop(transaction_ids)
+        if log:
+            for transaction_id in transaction_ids:
+                st.session_state.pending_ops.append({'op': 'delete', 'id': transaction_id})
+
+    def add_transactions(self, batch):
+        """批量添加交易（batch 为带交易ID的交易表），一次拼接并按账户汇总更新余额，返回添加的笔数"""
+        if batch.empty:
+            return 0
+
+        # 未指明债务的还款按原顺序逐笔分配债务，与单笔添加的规则一致
+        repayments = (batch['类型'] == '支出') & (batch['类别'] == '还款') & ~batch['对方账户'].isin(list(st.session_state.debts))
+        if repayments.any():
+            batch = batch.copy()
+            batch.loc[repayments, '对方账户'] = self.next_repayment_debts(batch.loc[repayments, '金额'])
+
+        st.session_state.transactions = insert_transactions(st.session_state.transactions, batch)
+        st.session_state.monthly_cube.merge(MonthlyCube.from_frame(batch))
+        st.session_state.text_index.add_frame(batch)
+        st.session_state.pending_ops.append({'op': 'add_many', 'rows': transaction_records(batch)})
+
+        # 批量添加后整体重算一次预算已用金额，再按前后差异检查提醒
+        used_before = {(month, category): info.get("已用金额", 0)
+                       for month, budgets in st.session_state.budgets.items() for category, info in budgets.items()}
+        st.session_state.budget_usage = None
+        self.refresh_budget_usage()
+        self.check_budget_alerts(used_before)
+
+        self.post_batch(batch)
+        return len(batch)
+
+    def import_transactions(self, source, chunksize=50_000):
+        """批量导入交易：CSV（路径或文件对象）按块流式读取，也可直接传入记录列表
+
+        返回 (导入笔数, 无效数据行号列表)；缺少必需列时抛出 ValueError。
+        """
+        if isinstance(source, (list, tuple)):
+            chunks = (pd.DataFrame(source[i:i + chunksize]) for i in range(0, len(source), chunksize))
+        else:
+            chunks = pd.read_csv(source, chunksize=chunksize, dtype=str, keep_default_na=False,
+                                 encoding='utf-8-sig')
+
+        batches = []
+        rejected = []
+        offset = 0
+        for chunk in chunks:
+            batch, invalid_rows = prepare_import_chunk(chunk)
+            rejected.extend(offset + i + 1 for i in invalid_rows)
+            offset += len(chunk)
+            if not batch.empty:
+                batches.append(batch)
+
+        imported = self.add_transactions(concat_transactions(batches)) if batches else 0
+        return imported, rejected
+
+    def get_currency_statistics(self, df=None):
+        """获取币种统计信息，未传入筛选结果时直接读取月度汇总"""
         currency_stats = {}
 
-        income_by_currency = df[df['类型'] == '收入'].groupby('币种')['金额'].sum()
+        if df is None:
+            cube = st.session_state.monthly_cube
+            income_by_currency = {currency: amount for (currency,), amount in cube.totals(['币种'], 类型='收入').items()}
+            expense_by_currency = {currency: amount for (currency,), amount in cube.totals(['币种'], 类型='支出').items()}
+        else:
+            income_by_currency = df[df['类型'] == '收入'].groupby('币种', observed=True)['金额'].sum() / 100
+            expense_by_currency = df[df['类型'] == '支出'].groupby('币种', observed=True)['金额'].sum() / 100
+
         for currency, amount in income_by_currency.items():
             if currency not in currency_stats:
                 currency_stats[currency] = {'收入': 0, '支出': 0}
             currency_stats[currency]['收入'] = amount
 
-        expense_by_currency = df[df['类型'] == '支出'].groupby('币种')['金额'].sum()
         for currency, amount in expense_by_currency.items():
             if currency not in currency_stats:
                 currency_stats[currency] = {'收入': 0, '支出': 0}
@@ -414,40 +2916,194 @@ class FinanceApp:
 
         return currency_stats
 
+    def base_currency(self):
+        """合计、分析和净资产走势统一折算成的本位币"""
+        return st.session_state.get("base_currency", FxRateTable.PIVOT)
+
+    def base_currency_options(self):
+        """可选的本位币：汇率表中的币种和账户、债务、预算用到的币种"""
+        currencies = dict.fromkeys(["人民币", "马币"] + self.fx.currencies())
+        for section in (st.session_state.bank_accounts, st.session_state.debts):
+            currencies.update(dict.fromkeys(info.get("币种", "人民币") for info in section.values()))
+        return list(currencies)
+
+    def fx_key(self, key):
+        """页面缓存键：折算结果随本位币和汇率表变化"""
+        return key, self.base_currency(), self.fx.version()
+
+    def to_base(self, amounts, currencies, dates=None, container=st):
+        """把各自币种的金额按汇率表折算为本位币（默认按今天的汇率），缺少汇率时给出提示"""
+        if dates is None:
+            dates = datetime.now().strftime('%Y-%m-%d')
+        converted, missing = self.fx.convert(amounts, currencies, dates, self.base_currency())
+        self.show_missing_rates(missing, container)
+        return converted
+
+    @staticmethod
+    def show_missing_rates(missing, container=st):
+        if missing:
+            container.caption(f"⚠️ 汇率表中没有 {'、'.join(sorted(missing))} 的汇率，已按 1:1 折算")
+
+    def cube_frame(self, by, **filters):
+        """月度汇总按 年月 和给定维度展开成表格，日期列为月末，用于按月末汇率折算"""
+        totals = st.session_state.monthly_cube.totals(['年月', *by], **filters)
+        frame = pd.DataFrame([(*key, amount) for key, amount in totals.items()], columns=['年月', *by, '金额'])
+        frame['日期'] = pd.PeriodIndex(frame['年月'], freq='M').to_timestamp(how='end').normalize()
+        return frame
+
+    def base_currency_statistics(self, df=None):
+        """收入、支出、结余折算为本位币后的合计：传入筛选结果时按各笔交易当天的汇率，否则按月末汇率"""
+        if df is None:
+            frame = self.cube_frame(['类型', '币种'])
+        else:
+            rows = df[df['类型'].isin(['收入', '支出'])]
+            frame = pd.DataFrame({'类型': rows['类型'].astype(str).to_numpy(), '币种': rows['币种'].astype(str).to_numpy(),
+                                  '日期': rows['日期'].to_numpy(), '金额': rows['金额'].to_numpy() / 100})
+        frame['金额'] = self.to_base(frame['金额'], frame['币种'], frame['日期'])
+
+        totals = frame.groupby('类型')['金额'].sum()
+        stats = {transaction_type: round(float(totals.get(transaction_type, 0)), 2) for transaction_type in ('收入', '支出')}
+        stats['结余'] = round(stats['收入'] - stats['支出'], 2)
+        return stats
+
+    def account_totals(self, *columns, container=st):
+        """各 (数据项, 字段) 列按今天的汇率折算为本位币后的合计，例如 ('bank_accounts', '余额')"""
+        amounts, currencies, sizes = [], [], []
+        for section, field in columns:
+            infos = list(getattr(st.session_state, section).values())
+            amounts += [info[field] for info in infos]
+            currencies += [info.get("币种", "人民币") for info in infos]
+            sizes.append(len(infos))
+
+        converted = self.to_base(amounts, currencies, container=container)
+        bounds = np.cumsum([0] + sizes)
+        return [round(float(converted[start:end].sum()), 2) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def show_fx_rates(self):
+        """侧边栏的汇率表：查看最新汇率、导入 CSV 或录入单条汇率"""
+        with st.sidebar.expander("💱 汇率表"):
+            latest = self.fx.latest()
+            if latest.empty:
+                st.caption("暂无汇率，不同币种按 1:1 合计")
+            else:
+                st.dataframe(latest.assign(日期=latest['日期'].dt.strftime('%Y-%m-%d')),
+                             use_container_width=True, hide_index=True)
+            st.caption("汇率为 1 单位该币种折合多少人民币")
+
+            uploaded = st.file_uploader("导入汇率 CSV（列：日期, 币种, 汇率）", type=['csv'], key="fx_rates_file")
+            if uploaded is not None and st.button("导入汇率", key="import_fx_rates"):
+                try:
+                    count = self.fx.import_csv(uploaded)
+                except (ValueError, UnicodeDecodeError, pd.errors.ParserError) as e:
+                    st.error(f"❌ 导入失败：{e}")
+                else:
+                    self.rerun(f"✅ 已导入 {count} 条汇率")
+
+            with st.form("fx_rate_form", clear_on_submit=True):
+                rate_date = st.date_input("日期", value=datetime.now().date())
+                currency = st.text_input("币种", placeholder="例如：马币")
+                rate = st.number_input("汇率", min_value=0.0, value=0.0, step=0.0001, format="%.4f")
+                if st.form_submit_button("保存汇率"):
+                    if currency.strip() and currency.strip() != FxRateTable.PIVOT and rate > 0:
+                        self.fx.merge(pd.DataFrame({'日期': [pd.Timestamp(rate_date)], '币种': [currency.strip()],
+                                                    '汇率': [rate]}).astype({'日期': 'datetime64[ns]'}))
+                        self.rerun(f"✅ 已保存 {rate_date} {currency.strip()} 的汇率")
+                    else:
+                        st.error("❌ 请输入人民币以外的币种和大于0的汇率")
+
+    def show_budget_alerts(self):
+        """侧边栏的预算提醒收件箱，以及每日邮件汇总开关"""
+        state = self.alerts.state()
+        unread = state['total'] - state['read']
+        with st.sidebar.expander(f"🔔 预算提醒（{unread} 条未读）" if unread else "🔔 预算提醒"):
+            start = max(0, state['total'] - self.ALERTS_SHOWN)
+            alerts = self.alerts.alerts(start)
+            if not alerts:
+                st.caption("暂无提醒")
+            for index, alert in reversed(list(enumerate(alerts, start))):
+                mark = "🆕 " if index >= state['read'] else ""
+                st.markdown(f"{mark}**{alert['月份']} {alert['类别']}** 已用 {alert['阈值']}%："
+                            f"{alert['已用金额']:,.2f} / {alert['预算金额']:,.2f} {alert['币种']}")
+                st.caption(alert['时间'])
+
+            if unread and st.button("全部标为已读", key="mark_alerts_read"):
+                self.alerts.mark_read()
+                st.rerun()
+
+            digest = st.checkbox("每天发送邮件汇总", value=state['digest'],
+                                 help="由定时任务 python App.py digest 发送到注册邮箱")
+            if digest != state['digest']:
+                # 开启时只汇总之后的新提醒
+                self.alerts.update_state(digest=digest, emailed=state['total'])
+                st.rerun()
+
     def sidebar(self):
         """侧边栏"""
         st.sidebar.title(f"💼 {self.username}的记账本")
         st.sidebar.markdown("---")
 
-        # 快速统计
-        total_assets = sum(account["余额"] for account in st.session_state.bank_accounts.values())
-        total_debts = sum(debt["剩余"] for debt in st.session_state.debts.values())
-        net_worth = total_assets - total_debts
-
-        st.sidebar.metric("💰 总资产", f"¥{total_assets:,.2f}")
-        st.sidebar.metric("📋 总债务", f"¥{total_debts:,.2f}")
-        st.sidebar.metric("🏆 净资产", f"¥{net_worth:,.2f}")
+        # 快速统计和银行卡余额在记账后由编辑器局部重画，不必整页重跑
+        st.sidebar.selectbox("💱 本位币", self.base_currency_options(), key="base_currency")
+        self.live_view(self.show_sidebar_totals, st.sidebar)
+        self.show_fx_rates()
+        self.show_budget_alerts()
 
         st.sidebar.markdown("---")
-
-        # 银行卡快速查看
-        st.sidebar.subheader("🏦 银行卡余额")
-        for account, info in st.session_state.bank_accounts.items():
-            currency_symbol = "¥" if info["币种"] == "人民币" else "RM"
-            st.sidebar.write(f"**{account}**: {currency_symbol}{info['余额']:,.2f}")
-
+        self.live_view(self.show_sidebar_balances, st.sidebar)
         st.sidebar.markdown("---")
 
         # 退出登录按钮
         if st.sidebar.button("🚪 退出登录", use_container_width=True):
+            self.registry.release(self.username)
             st.session_state.logged_in = False
             st.session_state.current_user = None
             st.rerun()
 
         st.sidebar.info("💡 提示：数据自动保存，仅您本人可见")
 
+    def show_sidebar_totals(self):
+        """总资产、总债务和净资产（各币种按今天的汇率折算为本位币）"""
+        symbol = currency_prefix(self.base_currency())
+        total_assets, total_debts = self.account_totals(('bank_accounts', "余额"), ('debts', "剩余"))
+        net_worth = round(total_assets - total_debts, 2)
+
+        st.metric("💰 总资产", f"{symbol}{total_assets:,.2f}")
+        st.metric("📋 总债务", f"{symbol}{total_debts:,.2f}")
+        st.metric("🏆 净资产", f"{symbol}{net_worth:,.2f}")
+
+    def show_sidebar_balances(self):
+        """银行卡快速查看"""
+        st.subheader("🏦 银行卡余额")
+        for account, info in st.session_state.bank_accounts.items():
+            currency_symbol = "¥" if info["币种"] == "人民币" else "RM"
+            st.write(f"**{account}**: {currency_symbol}{info['余额']:,.2f}")
+
+    def live_view(self, render, container=st):
+        """在 container 中为 render() 占一个位置，登记为实时视图
+
+        页面上有编辑器时由编辑器绘制（begin_fragment），保存后局部重跑时在同一位置重画；
+        局部重跑只能写入整页运行时由它写过的外部位置，实时视图须在编辑器之前登记。
+        没有编辑器绘制时，页面运行完后由 run_app 绘制。
+        """
+        self.live_views.append((container.empty(), render))
+
+    def draw_live_views(self):
+        for placeholder, render in self.live_views:
+            with placeholder.container():
+                render()
+        self.live_views_drawn = True
+
+    def begin_fragment(self):
+        """编辑器（局部重跑）开始时调用：局部重跑不会执行 __init__，先同步其他会话写入的数据，
+        再显示上次保存留下的提示并重画实时视图"""
+        self.refresh_ledger()
+        self.show_flash_message()
+        self.draw_live_views()
+
+    @st.fragment
     def add_transaction_form(self):
-        """添加交易表单"""
+        """添加交易表单（局部重跑：填写表单、添加和导入交易都不会重跑整个页面）"""
+        self.begin_fragment()
         st.header("➕ 添加新交易")
 
         with st.form("transaction_form", clear_on_submit=True):
@@ -505,8 +3161,26 @@ class FinanceApp:
                         '汇率': exchange_rate,
                         '备注': notes
                     })
-                    st.success("✅ 交易添加成功！")
                     self.save_data()
+                    self.rerun("✅ 交易添加成功！", scope="fragment")
+
+        # 批量导入
+        with st.expander("📥 批量导入交易（CSV）"):
+            st.caption("必需列：日期、类型、金额、支付方式；可选列：类别、项目描述、币种、对方账户、汇率、备注")
+            uploaded_file = st.file_uploader("选择CSV文件", type=["csv"], key="import_file")
+
+            if uploaded_file is not None and st.button("✅ 开始导入", use_container_width=True, key="import_button"):
+                try:
+                    imported, rejected = self.import_transactions(uploaded_file)
+                except ValueError as e:
+                    st.error(f"❌ 导入失败: {e}")
+                else:
+                    self.save_data()
+                    message = f"✅ 成功导入 {imported} 笔交易"
+                    if rejected:
+                        shown = ', '.join(str(row) for row in rejected[:20])
+                        message += f"；{len(rejected)} 行数据无效已跳过（数据行: {shown}{' 等' if len(rejected) > 20 else ''}）"
+                    self.rerun(message, scope="fragment")
 
     def get_categories(self, transaction_type):
         """根据交易类型返回类别"""
@@ -522,101 +3196,194 @@ class FinanceApp:
             return [""]
 
     def add_transaction(self, transaction_data):
-        """添加交易到数据"""
-        new_transaction = pd.DataFrame([transaction_data])
-        st.session_state.transactions = pd.concat([st.session_state.transactions, new_transaction], ignore_index=True)
-
-        self.update_bank_balance(transaction_data)
-
-        if transaction_data['类型'] == '支出' and transaction_data['类别'] == '还款':
-            self.update_debt(transaction_data['金额'])
-
-    def update_bank_balance(self, transaction):
-        """更新银行卡余额"""
-        payment_method = transaction['支付方式']
-        amount = transaction['金额']
-        transaction_type = transaction['类型']
-
-        if payment_method in st.session_state.bank_accounts:
-            if transaction_type == "收入":
-                st.session_state.bank_accounts[payment_method]["余额"] += amount
-            elif transaction_type == "支出":
-                st.session_state.bank_accounts[payment_method]["余额"] -= amount
-            elif transaction_type == "转账":
-                target_account = transaction['对方账户']
-                exchange_rate = transaction['汇率']
-
-                is_self_transfer = (payment_method in st.session_state.bank_accounts and
-                                    target_account in st.session_state.bank_accounts)
-
-                if is_self_transfer:
-                    st.session_state.bank_accounts[payment_method]["余额"] -= amount
-                    st.session_state.bank_accounts[target_account]["余额"] += amount * exchange_rate
-                else:
-                    st.session_state.bank_accounts[payment_method]["余额"] -= amount
-
-    def update_debt(self, amount):
-        """更新债务"""
-        for debt_name in st.session_state.debts:
-            if st.session_state.debts[debt_name]["状态"] == "还款中":
-                remaining = st.session_state.debts[debt_name]["剩余"]
-                if remaining > 0:
-                    new_remaining = max(0, remaining - amount)
-                    st.session_state.debts[debt_name]["剩余"] = new_remaining
-                    if new_remaining == 0:
-                        st.session_state.debts[debt_name]["状态"] = "已还清"
-                    break
+        """添加交易到数据，返回交易ID"""
+        transaction_data = self.assign_repayment_debt(transaction_data)
+        transaction_id = self.append_transaction_row(transaction_data)
+        self.post_transaction(transaction_data)
+        return transaction_id
+
+    def post_transaction(self, transaction, sign=1):
+        """把一笔交易的分录记入银行卡余额、债务剩余和余额历史；sign=-1 时冲回"""
+        history = st.session_state.balance_history
+        for account, cents in transaction_postings(transaction, st.session_state.bank_accounts, st.session_state.debts):
+            self.apply_posting(account, sign * cents)
+            if history is not None:
+                history.add(account, transaction['日期'], sign * cents)
+
+    def post_batch(self, batch):
+        """一批交易的分录按科目汇总后记入，每张银行卡、每笔债务只更新一次；余额历史下次使用时重建"""
+        postings = postings_frame(batch, st.session_state.bank_accounts, st.session_state.debts)
+        for account, cents in postings.groupby('科目')['金额'].sum().items():
+            self.apply_posting(account, int(cents))
+        st.session_state.balance_history = None
+
+    def balance_history(self):
+        """当前账户集合下的余额历史；银行卡或债务增删后重建（交易的记账科目随之变化）"""
+        history = st.session_state.balance_history
+        names = (frozenset(st.session_state.bank_accounts), frozenset(st.session_state.debts))
+        if history is None or history.names != names:
+            history = BalanceHistory.from_frame(
+                st.session_state.transactions, st.session_state.bank_accounts, st.session_state.debts)
+            st.session_state.balance_history = history
+        return history
+
+    def apply_posting(self, account, cents):
+        """把一条分录记入对应的银行卡余额或债务剩余（外部科目不记余额）"""
+        kind, name = account.split(':', 1)
+        if kind in (BANK_ACCOUNT, DEBT_ACCOUNT):
+            st.session_state.pending_postings[account] = st.session_state.pending_postings.get(account, 0) + cents
+        if kind == BANK_ACCOUNT:
+            info = st.session_state.bank_accounts[name]
+            info["余额"] = from_cents(to_cents(info["余额"]) + cents)
+        elif kind == DEBT_ACCOUNT:
+            info = st.session_state.debts[name]
+            info["剩余"] = from_cents(to_cents(info["剩余"]) - cents)
+            if info["剩余"] <= 0:
+                info["状态"] = "已还清"
+            elif info["状态"] == "已还清":
+                info["状态"] = "还款中"
+
+    def next_repayment_debts(self, amounts):
+        """为未指明债务的还款（金额为整数分）依次选择第一笔仍有欠款的还款中债务，返回债务名列表"""
+        remaining = {name: to_cents(info["剩余"]) for name, info in st.session_state.debts.items()
+                     if info["状态"] == "还款中"}
+        debts = []
+        for cents in amounts:
+            debt_name = next((name for name, left in remaining.items() if left > 0), "")
+            if debt_name:
+                remaining[debt_name] -= int(cents)
+            debts.append(debt_name)
+        return debts
+
+    def assign_repayment_debt(self, transaction):
+        """未指明债务的还款支出记到选中的债务上，并写入对方账户，冲回时能找到同一笔债务"""
+        if (transaction['类型'] == '支出' and transaction['类别'] == '还款'
+                and transaction['对方账户'] not in st.session_state.debts):
+            debt_name = self.next_repayment_debts([to_cents(transaction['金额'])])[0]
+            if debt_name:
+                return dict(transaction, 对方账户=debt_name)
+        return transaction
 
     def show_transactions(self):
         """显示交易记录 - 增强版（带编辑和删除功能）"""
         st.header("📊 交易记录")
 
         if not st.session_state.transactions.empty:
-            # 筛选功能
+            transactions = st.session_state.transactions
+            # 常用筛选：选中后填入下方各筛选条件
+            saved_names = sorted(st.session_state.saved_filters)
+            st.selectbox("⭐ 常用筛选", ["（当前条件）"] + saved_names, key="saved_filter_choice",
+                         on_change=self.load_saved_filter)
+
+            # 筛选功能：不选表示不限，同一项选多个时满足其一即可
             col1, col2, col3, col4 = st.columns(4)
             with col1:
-                filter_type = st.selectbox("筛选类型", ["全部", "收入", "支出", "转账"])
+                filter_types = st.multiselect("筛选类型", self.filter_options("filter_types", ["收入", "支出", "转账"]),
+                                              key="filter_types", placeholder="全部")
             with col2:
-                filter_category = st.selectbox("筛选类别",
-                                               ["全部"] + list(st.session_state.transactions['类别'].unique()))
+                filter_categories = st.multiselect(
+                    "筛选类别", self.filter_options("filter_categories", transactions['类别'].unique()),
+                    key="filter_categories", placeholder="全部")
             with col3:
                 bank_options = list(st.session_state.bank_accounts.keys()) + ["现金", "微信支付", "支付宝"]
-                filter_bank = st.selectbox("筛选支付方式", ["全部"] + bank_options)
+                filter_accounts = st.multiselect("筛选支付方式", self.filter_options("filter_accounts", bank_options),
+                                                 key="filter_accounts", placeholder="全部")
             with col4:
-                date_range = st.selectbox("时间范围", ["全部", "最近7天", "最近30天", "本月"])
-
-            filtered_df = st.session_state.transactions.copy()
-
-            if filter_type != "全部":
-                filtered_df = filtered_df[filtered_df['类型'] == filter_type]
-            if filter_category != "全部":
-                filtered_df = filtered_df[filtered_df['类别'] == filter_category]
-            if filter_bank != "全部":
-                filtered_df = filtered_df[filtered_df['支付方式'] == filter_bank]
-
-            if date_range != "全部":
-                today = datetime.now().date()
-                if date_range == "最近7天":
-                    start_date = today - timedelta(days=7)
-                elif date_range == "最近30天":
-                    start_date = today - timedelta(days=30)
-                elif date_range == "本月":
-                    start_date = today.replace(day=1)
-
-                filtered_df['日期'] = pd.to_datetime(filtered_df['日期'])
-                filtered_df = filtered_df[filtered_df['日期'] >= pd.Timestamp(start_date)]
-                filtered_df['日期'] = filtered_df['日期'].dt.strftime('%Y-%m-%d')
+                filter_currencies = st.multiselect(
+                    "筛选币种", self.filter_options("filter_currencies", ["人民币", "马币"]),
+                    key="filter_currencies", placeholder="全部")
+
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                min_amount = st.number_input("最小金额", min_value=0.0, step=100.0, value=None, format="%.2f",
+                                             key="filter_min_amount", placeholder="不限")
+            with col2:
+                max_amount = st.number_input("最大金额", min_value=0.0, step=100.0, value=None, format="%.2f",
+                                             key="filter_max_amount", placeholder="不限")
+            with col3:
+                date_range = st.selectbox("时间范围", TRANSACTION_PERIODS, key="filter_period")
+            custom_range = ()
+            if date_range == "自定义":
+                if "transaction_date_range" not in st.session_state:
+                    st.session_state.transaction_date_range = (transactions['日期'].iloc[0].date(),
+                                                               datetime.now().date())
+                custom_range = st.date_input("起止日期", key="transaction_date_range")
+            keyword = st.text_input("🔍 搜索", placeholder="项目描述 / 对方账户 / 备注，多个词用空格分隔", key="transaction_search")
+
+            # 只选了开始日期时不限结束日期
+            start_date, end_date = (tuple(custom_range) + (None, None))[:2]
+            transaction_filter = TransactionFilter(filter_types, filter_categories, filter_accounts, filter_currencies,
+                                                   min_amount, max_amount, date_range, start_date, end_date, keyword)
+
+            col1, col2, col3 = st.columns([2, 1, 1])
+            with col1:
+                filter_name = st.text_input("常用筛选名称", placeholder="例如：本月餐饮", key="saved_filter_name",
+                                            label_visibility="collapsed")
+            with col2:
+                if st.button("💾 保存为常用筛选", use_container_width=True, key="save_filter"):
+                    if filter_name.strip():
+                        st.session_state.saved_filters[filter_name.strip()] = transaction_filter.to_dict()
+                        self.save_data()
+                        self.rerun(f"✅ 已保存常用筛选：{filter_name.strip()}")
+                    else:
+                        st.error("❌ 请输入常用筛选名称")
+            with col3:
+                selected_saved = st.session_state.saved_filter_choice
+                if st.button("🗑️ 删除常用筛选", use_container_width=True, key="delete_filter",
+                             disabled=selected_saved not in st.session_state.saved_filters):
+                    del st.session_state.saved_filters[selected_saved]
+                    self.save_data()
+                    self.rerun(f"✅ 已删除常用筛选：{selected_saved}")
+
+            filtered_df = self.filter_transactions(transaction_filter)
+
+            # 分页：只格式化并发送当前页
+            col1, col2, col3 = st.columns([1, 1, 2])
+            with col1:
+                page_size = st.selectbox("每页条数", TRANSACTION_PAGE_SIZES, key="transaction_page_size")
+            total_pages = max(1, -(-len(filtered_df) // page_size))
+            # 筛选条件变化时回到第一页
+            view = (transaction_filter, page_size)
+            if st.session_state.get("transaction_view") != view:
+                st.session_state.transaction_view = view
+                st.session_state.transaction_page = 1
+            elif st.session_state.get("transaction_page", 1) > total_pages:
+                st.session_state.transaction_page = total_pages
+            with col2:
+                page = st.number_input("页码", min_value=1, max_value=total_pages, step=1, key="transaction_page")
+            with col3:
+                st.caption(f"共 {len(filtered_df)} 条记录，第 {page}/{total_pages} 页（按日期倒序）")
+
+            page_df = self.transaction_page(filtered_df, page, page_size)
+            shown_df = display_frame(page_df)
 
             # 显示交易记录表格
             st.dataframe(
-                filtered_df.style.format({
-                    '金额': '{:,.2f}',
-                    '汇率': '{:.2f}'
-                }),
+                shown_df,
                 use_container_width=True,
-                height=400
+                height=400,
+                hide_index=True
             )
 
+            # 导出
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                export_scope = st.radio("导出范围", ["当前筛选结果", "全部交易"], horizontal=True, key="export_scope")
+            with col2:
+                export_format = st.radio("导出格式", list(EXPORT_FORMATS), horizontal=True, key="export_format",
+                                         format_func=str.upper)
+            with col3:
+                export_df = filtered_df if export_scope == "当前筛选结果" else st.session_state.transactions
+                # 点击时才生成文件
+                st.download_button(
+                    "📤 导出交易记录",
+                    data=functools.partial(export_transactions, export_df, export_format),
+                    file_name=f"transactions_{datetime.now().strftime('%Y%m%d')}.{export_format}",
+                    mime=EXPORT_FORMATS[export_format],
+                    use_container_width=True,
+                    key="export_button"
+                )
+
             # 交易编辑和删除功能
             st.subheader("✏️ 编辑和删除交易记录")
 
@@ -624,31 +3391,35 @@ class FinanceApp:
             col_edit1, col_edit2 = st.columns([2, 1])
 
             with col_edit1:
-                transaction_options = []
-                for idx, row in st.session_state.transactions.iterrows():
-                    transaction_options.append(
-                        f"{idx + 1}. {row['日期']} - {row['类型']} - {row['项目描述']} - ¥{row['金额']:,.2f}")
+                # 只列出当前页的交易，可先用上方搜索/筛选缩小范围
+                transaction_options = {}
+                rows = zip(shown_df.index, shown_df['日期'], shown_df['类型'], shown_df['项目描述'], shown_df['金额'])
+                for number, (transaction_id, date, transaction_type, description, amount) in enumerate(
+                        rows, start=(page - 1) * page_size + 1):
+                    transaction_options[transaction_id] = (
+                        f"{number}. {date} - {transaction_type} - {description} - ¥{amount}")
 
                 selected_transaction = st.selectbox(
                     "选择要编辑的交易记录",
-                    transaction_options,
+                    list(transaction_options),
+                    format_func=transaction_options.get,
                     key="transaction_selector"
                 )
 
             if selected_transaction:
-                transaction_index = int(selected_transaction.split(".")[0]) - 1
-                original_transaction = st.session_state.transactions.iloc[transaction_index].copy()
+                transaction_id = selected_transaction
+                original_transaction = transaction_records(st.session_state.transactions.loc[[transaction_id]])[0]
 
                 with col_edit2:
                     action = st.radio(
                         "选择操作",
                         ["编辑交易", "删除交易"],
-                        key=f"transaction_action_{transaction_index}"
+                        key=f"transaction_action_{transaction_id}"
                     )
 
                 if action == "编辑交易":
                     # 编辑交易表单
-                    with st.form(f"edit_transaction_form_{transaction_index}"):
+                    with st.form(f"edit_transaction_form_{transaction_id}"):
                         st.subheader("📝 编辑交易")
 
                         col1, col2 = st.columns(2)
@@ -657,25 +3428,25 @@ class FinanceApp:
                             edit_date = st.date_input(
                                 "📅 日期",
                                 datetime.strptime(original_transaction['日期'], "%Y-%m-%d"),
-                                key=f"edit_date_{transaction_index}"
+                                key=f"edit_date_{transaction_id}"
                             )
                             edit_type = st.selectbox(
                                 "🔸 类型",
                                 ["收入", "支出", "转账"],
                                 index=["收入", "支出", "转账"].index(original_transaction['类型']),
-                                key=f"edit_type_{transaction_index}"
+                                key=f"edit_type_{transaction_id}"
                             )
                             edit_category = st.selectbox(
                                 "📂 类别",
                                 self.get_categories(edit_type),
                                 index=self.get_categories(edit_type).index(original_transaction['类别']) if
                                 original_transaction['类别'] in self.get_categories(edit_type) else 0,
-                                key=f"edit_category_{transaction_index}"
+                                key=f"edit_category_{transaction_id}"
                             )
                             edit_description = st.text_input(
                                 "📝 项目描述",
                                 value=original_transaction['项目描述'],
-                                key=f"edit_description_{transaction_index}"
+                                key=f"edit_description_{transaction_id}"
                             )
                             edit_amount = st.number_input(
                                 "💰 金额",
@@ -683,7 +3454,7 @@ class FinanceApp:
                                 step=0.01,
                                 value=float(original_transaction['金额']),
                                 format="%.2f",
-                                key=f"edit_amount_{transaction_index}"
+                                key=f"edit_amount_{transaction_id}"
                             )
 
                         with col2:
@@ -691,7 +3462,7 @@ class FinanceApp:
                                 "🌐 币种",
                                 ["人民币", "马币"],
                                 index=0 if original_transaction['币种'] == "人民币" else 1,
-                                key=f"edit_currency_{transaction_index}"
+                                key=f"edit_currency_{transaction_id}"
                             )
 
                             payment_options = list(st.session_state.bank_accounts.keys()) + ["现金", "微信支付",
@@ -701,7 +3472,7 @@ class FinanceApp:
                                 payment_options,
                                 index=payment_options.index(original_transaction['支付方式']) if original_transaction[
                                                                                                      '支付方式'] in payment_options else 0,
-                                key=f"edit_payment_{transaction_index}"
+                                key=f"edit_payment_{transaction_id}"
                             )
 
                             if edit_type == "转账":
@@ -712,7 +3483,7 @@ class FinanceApp:
                                     target_options,
                                     index=target_options.index(original_transaction['对方账户']) if
                                     original_transaction['对方账户'] in target_options else 0,
-                                    key=f"edit_target_{transaction_index}"
+                                    key=f"edit_target_{transaction_id}"
                                 )
                                 edit_exchange_rate = st.number_input(
                                     "🔁 汇率",
@@ -720,7 +3491,7 @@ class FinanceApp:
                                     step=0.01,
                                     value=float(original_transaction['汇率']),
                                     format="%.2f",
-                                    key=f"edit_rate_{transaction_index}"
+                                    key=f"edit_rate_{transaction_id}"
                                 )
                             else:
                                 edit_target_account = original_transaction['对方账户']
@@ -729,15 +3500,15 @@ class FinanceApp:
                             edit_notes = st.text_input(
                                 "📋 备注",
                                 value=original_transaction['备注'],
-                                key=f"edit_notes_{transaction_index}"
+                                key=f"edit_notes_{transaction_id}"
                             )
 
                         col_btn1, col_btn2 = st.columns(2)
 
                         with col_btn1:
                             if st.form_submit_button("✅ 更新交易", use_container_width=True):
-                                # 恢复原始交易对余额的影响
-                                self.reverse_transaction_effect(original_transaction)
+                                # 冲回原始交易的分录
+                                self.post_transaction(original_transaction, -1)
 
                                 # 创建更新后的交易数据
                                 updated_transaction = {
@@ -753,14 +3524,10 @@ class FinanceApp:
                                     '备注': edit_notes
                                 }
 
-                                # 更新交易记录
-                                st.session_state.transactions.iloc[transaction_index] = updated_transaction
-
-                                # 应用新交易对余额的影响
-                                self.update_bank_balance(updated_transaction)
-
-                                if updated_transaction['类型'] == '支出' and updated_transaction['类别'] == '还款':
-                                    self.update_debt(updated_transaction['金额'])
+                                # 更新交易记录并记入新交易的分录
+                                updated_transaction = self.assign_repayment_debt(updated_transaction)
+                                self.update_transaction_row(transaction_id, updated_transaction)
+                                self.post_transaction(updated_transaction)
 
                                 st.success("✅ 交易记录更新成功！")
                                 self.save_data()
@@ -775,7 +3542,7 @@ class FinanceApp:
 
                     delete_confirmed = st.checkbox(
                         f"确认删除该交易记录",
-                        key=f"confirm_delete_transaction_{transaction_index}"
+                        key=f"confirm_delete_transaction_{transaction_id}"
                     )
 
                     if st.button(
@@ -783,14 +3550,13 @@ class FinanceApp:
                             use_container_width=True,
                             type="secondary",
                             disabled=not delete_confirmed,
-                            key=f"delete_transaction_{transaction_index}"
+                            key=f"delete_transaction_{transaction_id}"
                     ):
-                        # 恢复交易对余额的影响
-                        self.reverse_transaction_effect(original_transaction)
+                        # 冲回交易的分录
+                        self.post_transaction(original_transaction, -1)
 
                         # 删除交易记录
-                        st.session_state.transactions = st.session_state.transactions.drop(
-                            transaction_index).reset_index(drop=True)
+                        self.delete_transaction_rows([transaction_id])
 
                         st.success("✅ 交易记录删除成功！")
                         self.save_data()
@@ -798,10 +3564,13 @@ class FinanceApp:
 
             # 币种统计
             st.subheader("💰 币种统计")
-            currency_stats = self.get_currency_statistics(filtered_df)
+            stats_df = None if transaction_filter == TransactionFilter() else filtered_df
+            currency_stats = self.get_currency_statistics(stats_df)
 
             if currency_stats:
-                cols = st.columns(len(currency_stats))
+                base = self.base_currency()
+                show_base = len(currency_stats) > 1 or base not in currency_stats
+                cols = st.columns(len(currency_stats) + show_base)
                 for i, (currency, stats) in enumerate(currency_stats.items()):
                     with cols[i]:
                         currency_symbol = "¥" if currency == "人民币" else "RM"
@@ -809,42 +3578,69 @@ class FinanceApp:
                         st.metric(f"{currency}支出", f"{currency_symbol}{stats['支出']:,.2f}")
                         st.metric(f"{currency}结余", f"{currency_symbol}{stats['结余']:,.2f}")
 
+                if show_base:
+                    with cols[-1]:
+                        stats = self.base_currency_statistics(stats_df)
+                        symbol = currency_prefix(base)
+                        st.metric(f"折合{base}收入", f"{symbol}{stats['收入']:,.2f}")
+                        st.metric(f"折合{base}支出", f"{symbol}{stats['支出']:,.2f}")
+                        st.metric(f"折合{base}结余", f"{symbol}{stats['结余']:,.2f}")
+
         else:
             st.info("📝 暂无交易记录，请添加第一笔交易")
 
-    def reverse_transaction_effect(self, transaction):
-        """反转交易对余额的影响"""
-        payment_method = transaction['支付方式']
-        amount = transaction['金额']
-        transaction_type = transaction['类型']
-
-        if payment_method in st.session_state.bank_accounts:
-            if transaction_type == "收入":
-                st.session_state.bank_accounts[payment_method]["余额"] -= amount
-            elif transaction_type == "支出":
-                st.session_state.bank_accounts[payment_method]["余额"] += amount
-            elif transaction_type == "转账":
-                target_account = transaction['对方账户']
-                exchange_rate = transaction['汇率']
-
-                is_self_transfer = (payment_method in st.session_state.bank_accounts and
-                                    target_account in st.session_state.bank_accounts)
-
-                if is_self_transfer:
-                    st.session_state.bank_accounts[payment_method]["余额"] += amount
-                    st.session_state.bank_accounts[target_account]["余额"] -= amount * exchange_rate
-                else:
-                    st.session_state.bank_accounts[payment_method]["余额"] += amount
-
-        # 如果是还款交易，恢复债务余额
-        if transaction_type == '支出' and transaction['类别'] == '还款':
-            for debt_name in st.session_state.debts:
-                if st.session_state.debts[debt_name]["状态"] == "已还清" or st.session_state.debts[debt_name][
-                    "状态"] == "还款中":
-                    st.session_state.debts[debt_name]["剩余"] += amount
-                    if st.session_state.debts[debt_name]["剩余"] > 0:
-                        st.session_state.debts[debt_name]["状态"] = "还款中"
-                    break
+    def filter_transactions(self, transaction_filter):
+        """按筛选条件取交易，结果仍按日期排序
+
+        结果按 (筛选条件, 起止日期, 账本版本) 缓存，保留最近用过的 FILTER_CACHE_SIZE 个，
+        在常用筛选之间切换时不必重新计算；账本变化后旧版本的结果直接丢弃。
+        """
+        start_date, end_date = transaction_filter.date_bounds(datetime.now().date())
+        key = (transaction_filter, start_date, end_date, st.session_state.ledger_version)
+        cache = st.session_state.filter_cache
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        if self.store.indexed and not transaction_filter.keyword:
+            result = transaction_frame(
+                self.store.query_transactions(transaction_filter, start_date, end_date).reset_index())
+        else:
+            result = transaction_filter.apply(
+                st.session_state.transactions, st.session_state.text_index, start_date, end_date)
+
+        for stale in [k for k in cache if k[-1] != st.session_state.ledger_version]:
+            del cache[stale]
+        cache[key] = result
+        while len(cache) > FILTER_CACHE_SIZE:
+            cache.popitem(last=False)
+        return result
+
+    def load_saved_filter(self):
+        """选中常用筛选时，把它的条件填入各筛选控件"""
+        name = st.session_state.saved_filter_choice
+        if name not in st.session_state.saved_filters:
+            return
+        saved = TransactionFilter.from_dict(st.session_state.saved_filters[name])
+        st.session_state.filter_types = sorted(saved.types)
+        st.session_state.filter_categories = sorted(saved.categories)
+        st.session_state.filter_accounts = sorted(saved.accounts)
+        st.session_state.filter_currencies = sorted(saved.currencies)
+        st.session_state.filter_min_amount = saved.min_amount
+        st.session_state.filter_max_amount = saved.max_amount
+        st.session_state.filter_period = saved.period
+        if saved.period == "自定义":
+            st.session_state.transaction_date_range = tuple(d for d in (saved.start_date, saved.end_date) if d)
+        st.session_state.transaction_search = saved.keyword
+
+    def filter_options(self, key, options):
+        """多选框的选项：已选中的值（可能来自常用筛选）不在选项里时补上"""
+        return list(dict.fromkeys(list(options) + list(st.session_state.get(key, []))))
+
+    def transaction_page(self, df, page, page_size):
+        """按日期倒序（同日新录入的在前）取第 page 页：交易表已按日期排序，从末尾按位置切出该页"""
+        end = max(0, len(df) - (page - 1) * page_size)
+        return df.iloc[max(0, end - page_size):end].iloc[::-1]
 
     def show_bank_accounts(self):
         """显示银行卡信息 - 增强版（带余额修改功能）"""
@@ -871,7 +3667,8 @@ class FinanceApp:
                             "余额": initial_balance,
                             "币种": bank_currency,
                             "创建时间": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                            "最后更新": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                            "最后更新": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            "期初余额": initial_balance
                         }
                         st.success(f"✅ 成功添加银行卡: {bank_name}")
                         self.save_data()
@@ -885,247 +3682,13 @@ class FinanceApp:
 
         # 显示银行卡列表和余额修改功能
         if st.session_state.bank_accounts:
-            st.subheader("💳 银行卡列表")
-
-            # 银行卡统计数据
-            total_balance = sum(account["余额"] for account in st.session_state.bank_accounts.values())
-            total_accounts = len(st.session_state.bank_accounts)
-
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                st.metric("银行卡数量", total_accounts)
-            with col2:
-                st.metric("总余额", f"¥{total_balance:,.2f}")
-            with col3:
-                avg_balance = total_balance / total_accounts if total_accounts > 0 else 0
-                st.metric("平均余额", f"¥{avg_balance:,.2f}")
-
-            # 银行卡数据表格
-            bank_data = []
-            for account, info in st.session_state.bank_accounts.items():
-                currency_symbol = "¥" if info["币种"] == "人民币" else "RM"
-                bank_data.append({
-                    "银行卡": account,
-                    "币种": info["币种"],
-                    "当前余额": info["余额"],
-                    "格式化余额": f"{currency_symbol}{info['余额']:,.2f}",
-                    "创建时间": info.get("创建时间", "未知"),
-                    "最后更新": info.get("最后更新", "未知")
-                })
-
-            bank_df = pd.DataFrame(bank_data)
-
-            # 显示银行卡表格
-            st.dataframe(
-                bank_df[["银行卡", "币种", "格式化余额", "创建时间", "最后更新"]],
-                use_container_width=True
-            )
+            # 统计和列表在调整余额后由编辑器局部重画
+            self.live_view(self.show_bank_list)
 
             st.markdown("---")
 
             # 银行卡余额修改功能
-            st.subheader("✏️ 修改银行卡余额")
-            col_edit1, col_edit2 = st.columns([2, 1])
-
-            with col_edit1:
-                edit_banks = list(st.session_state.bank_accounts.keys())
-                selected_bank = st.selectbox("选择要修改余额的银行卡", edit_banks, key="bank_selector")
-
-            if selected_bank:
-                bank_info = st.session_state.bank_accounts[selected_bank]
-                current_balance = bank_info["余额"]
-                currency_symbol = "¥" if bank_info["币种"] == "人民币" else "RM"
-
-                with col_edit2:
-                    st.info(f"当前余额: **{currency_symbol}{current_balance:,.2f}**")
-
-                # 余额修改选项
-                st.subheader("💰 余额调整方式")
-                adjustment_method = st.radio(
-                    "选择调整方式",
-                    ["直接设置新余额", "增加金额", "减少金额", "转账调整"],
-                    key=f"adjust_method_{selected_bank}"
-                )
-
-                if adjustment_method == "直接设置新余额":
-                    new_balance = st.number_input(
-                        "新余额",
-                        min_value=0.0,
-                        step=100.0,
-                        value=float(current_balance),
-                        format="%.2f",
-                        key=f"new_balance_{selected_bank}"
-                    )
-
-                    adjustment_amount = new_balance - current_balance
-                    adjustment_type = "增加" if adjustment_amount > 0 else "减少" if adjustment_amount < 0 else "不变"
-
-                elif adjustment_method == "增加金额":
-                    increase_amount = st.number_input(
-                        "增加金额",
-                        min_value=0.0,
-                        step=100.0,
-                        value=0.0,
-                        format="%.2f",
-                        key=f"increase_{selected_bank}"
-                    )
-                    new_balance = current_balance + increase_amount
-                    adjustment_amount = increase_amount
-                    adjustment_type = "增加"
-
-                elif adjustment_method == "减少金额":
-                    decrease_amount = st.number_input(
-                        "减少金额",
-                        min_value=0.0,
-                        max_value=float(current_balance),
-                        step=100.0,
-                        value=0.0,
-                        format="%.2f",
-                        key=f"decrease_{selected_bank}"
-                    )
-                    new_balance = current_balance - decrease_amount
-                    adjustment_amount = -decrease_amount
-                    adjustment_type = "减少"
-
-                else:  # 转账调整
-                    col_transfer1, col_transfer2 = st.columns(2)
-
-                    with col_transfer1:
-                        # 选择转出银行卡（不能是当前选中的银行卡）
-                        from_banks = [bank for bank in st.session_state.bank_accounts.keys() if bank != selected_bank]
-                        if from_banks:
-                            from_bank = st.selectbox("从哪个银行卡转出", from_banks, key=f"from_bank_{selected_bank}")
-                            from_bank_balance = st.session_state.bank_accounts[from_bank]["余额"]
-                            from_currency_symbol = "¥" if st.session_state.bank_accounts[from_bank][
-                                                              "币种"] == "人民币" else "RM"
-                            st.info(f"**{from_bank}** 当前余额: {from_currency_symbol}{from_bank_balance:,.2f}")
-                        else:
-                            st.warning("⚠️ 没有其他银行卡可用于转账")
-                            from_bank = None
-
-                    with col_transfer2:
-                        if from_bank:
-                            transfer_amount = st.number_input(
-                                "转账金额",
-                                min_value=0.0,
-                                max_value=float(from_bank_balance),
-                                step=100.0,
-                                value=min(500.0, float(from_bank_balance)),
-                                format="%.2f",
-                                key=f"transfer_{selected_bank}"
-                            )
-
-                            # 检查币种是否一致
-                            from_currency = st.session_state.bank_accounts[from_bank]["币种"]
-                            to_currency = bank_info["币种"]
-
-                            if from_currency != to_currency:
-                                st.warning(
-                                    f"⚠️ 币种不同: {from_bank}({from_currency}) → {selected_bank}({to_currency})")
-                                exchange_rate = st.number_input(
-                                    "汇率",
-                                    min_value=0.0,
-                                    step=0.01,
-                                    value=1.0,
-                                    format="%.2f",
-                                    key=f"exchange_{selected_bank}"
-                                )
-                                actual_transfer_amount = transfer_amount * exchange_rate
-                            else:
-                                exchange_rate = 1.0
-                                actual_transfer_amount = transfer_amount
-
-                            new_balance = current_balance + actual_transfer_amount
-                            adjustment_amount = actual_transfer_amount
-                            adjustment_type = "转账转入"
-
-                # 显示调整摘要
-                if adjustment_method != "转账调整" or (adjustment_method == "转账调整" and from_bank):
-                    st.markdown("---")
-                    st.subheader("📋 调整摘要")
-
-                    col_sum1, col_sum2, col_sum3 = st.columns(3)
-
-                    with col_sum1:
-                        st.metric("当前余额", f"{currency_symbol}{current_balance:,.2f}")
-                    with col_sum2:
-                        if adjustment_type == "转账转入":
-                            st.metric("转账金额", f"{currency_symbol}{adjustment_amount:,.2f}")
-                        else:
-                            st.metric("调整金额", f"{currency_symbol}{abs(adjustment_amount):,.2f}")
-                    with col_sum3:
-                        st.metric("新余额", f"{currency_symbol}{new_balance:,.2f}")
-
-                    # 调整原因
-                    adjustment_reason = st.text_input(
-                        "调整原因（可选）",
-                        placeholder="例如：工资到账、现金存入、转账等",
-                        key=f"reason_{selected_bank}"
-                    )
-
-                    # 执行调整按钮
-                    col_btn1, col_btn2 = st.columns(2)
-
-                    with col_btn1:
-                        if st.button("✅ 确认调整", use_container_width=True, key=f"confirm_adjust_{selected_bank}"):
-                            # 更新银行卡余额
-                            old_balance = st.session_state.bank_accounts[selected_bank]["余额"]
-                            st.session_state.bank_accounts[selected_bank]["余额"] = new_balance
-                            st.session_state.bank_accounts[selected_bank]["最后更新"] = datetime.now().strftime(
-                                "%Y-%m-%d %H:%M:%S")
-
-                            # 如果是转账调整，同时更新转出银行卡
-                            if adjustment_method == "转账调整" and from_bank:
-                                st.session_state.bank_accounts[from_bank]["余额"] -= transfer_amount
-                                st.session_state.bank_accounts[from_bank]["最后更新"] = datetime.now().strftime(
-                                    "%Y-%m-%d %H:%M:%S")
-
-                                # 记录转账交易
-                                transfer_transaction = {
-                                    '日期': datetime.now().strftime("%Y-%m-%d"),
-                                    '类型': '转账',
-                                    '类别': '账户转账',
-                                    '项目描述': f"银行卡间转账 {from_bank} → {selected_bank}",
-                                    '金额': transfer_amount,
-                                    '币种': st.session_state.bank_accounts[from_bank]["币种"],
-                                    '支付方式': from_bank,
-                                    '对方账户': selected_bank,
-                                    '汇率': exchange_rate,
-                                    '备注': f"余额调整转账 - {adjustment_reason}" if adjustment_reason else "余额调整转账"
-                                }
-                                new_transaction = pd.DataFrame([transfer_transaction])
-                                st.session_state.transactions = pd.concat(
-                                    [st.session_state.transactions, new_transaction], ignore_index=True)
-
-                            else:
-                                # 记录余额调整交易
-                                transaction_type = "收入" if adjustment_amount > 0 else "支出"
-                                transaction_category = "余额调整" + ("收入" if adjustment_amount > 0 else "支出")
-
-                                adjustment_transaction = {
-                                    '日期': datetime.now().strftime("%Y-%m-%d"),
-                                    '类型': transaction_type,
-                                    '类别': transaction_category,
-                                    '项目描述': f"银行卡余额调整 - {adjustment_type}",
-                                    '金额': abs(adjustment_amount),
-                                    '币种': bank_info["币种"],
-                                    '支付方式': selected_bank,
-                                    '对方账户': "",
-                                    '汇率': 1.0,
-                                    '备注': adjustment_reason if adjustment_reason else f"余额调整 - {adjustment_type}"
-                                }
-                                new_transaction = pd.DataFrame([adjustment_transaction])
-                                st.session_state.transactions = pd.concat(
-                                    [st.session_state.transactions, new_transaction], ignore_index=True)
-
-                            st.success(
-                                f"✅ 成功调整 {selected_bank} 的余额: {currency_symbol}{old_balance:,.2f} → {currency_symbol}{new_balance:,.2f}")
-                            self.save_data()
-                            st.rerun()
-
-                    with col_btn2:
-                        if st.button("❌ 取消调整", use_container_width=True, key=f"cancel_adjust_{selected_bank}"):
-                            st.rerun()
+            self.bank_balance_editor()
 
             st.markdown("---")
 
@@ -1182,30 +3745,316 @@ class FinanceApp:
             # 余额图表
             st.markdown("---")
             st.subheader("📊 银行卡余额分布")
-            chart_data = []
-            for account, info in st.session_state.bank_accounts.items():
-                chart_data.append({
-                    "银行卡": account,
-                    "余额": info["余额"],
-                    "币种": info["币种"]
-                })
-
-            chart_df = pd.DataFrame(chart_data)
-
-            # 条形图
-            fig_bar = px.bar(chart_df, x='银行卡', y='余额', title='银行卡余额分布', color='银行卡')
-            fig_bar.update_layout(showlegend=False)
+            fig_bar, fig_pie = self.section_cache('bank_charts', self.build_bank_charts)
             st.plotly_chart(fig_bar, use_container_width=True)
 
             # 饼图（如果有多张卡）
-            if len(chart_df) > 1:
-                fig_pie = px.pie(chart_df, values='余额', names='银行卡', title='银行卡余额占比')
-                fig_pie.update_traces(textposition='inside', textinfo='percent+label')
+            if fig_pie is not None:
                 st.plotly_chart(fig_pie, use_container_width=True)
 
+            st.markdown("---")
+            self.show_reconciliation()
+
         else:
             st.info("🏦 暂无银行卡数据，请先添加银行卡")
 
+    def show_reconciliation(self):
+        """余额核对：按交易记录重算银行卡余额和债务剩余，列出不一致之处并可一键修正"""
+        if not st.toggle("🔍 核对余额（按交易记录重算银行卡余额和债务剩余）", key="show_reconciliation"):
+            return
+
+        differences, assigned = self.section_cache('reconciliation', lambda: reconcile_ledger(
+            st.session_state.transactions,
+            {'bank_accounts': st.session_state.bank_accounts, 'debts': st.session_state.debts}))
+        if not differences and not assigned:
+            st.success("✅ 所有银行卡余额和债务剩余都与交易记录一致")
+            return
+
+        if differences:
+            st.dataframe(pd.DataFrame([{
+                "科目": difference['科目'],
+                "名称": difference['名称'],
+                "当前金额": f"{difference['当前']:,.2f}",
+                "按交易重算": "缺少期初金额" if difference['重算'] is None else f"{difference['重算']:,.2f}",
+                "差额": "" if difference['重算'] is None else f"{difference['重算'] - difference['当前']:+,.2f}"
+            } for difference in differences]), use_container_width=True, hide_index=True)
+        if assigned:
+            st.info(f"💡 有 {len(assigned)} 笔还款没有指明债务，修正时将按日期顺序记到对应的债务上")
+
+        if st.button("🛠️ 按交易记录修正", key="apply_reconciliation"):
+            for transaction_id, debt_name in assigned.items():
+                row = transaction_records(st.session_state.transactions.loc[[transaction_id]])[0]
+                self.update_transaction_row(transaction_id, dict(row, 对方账户=debt_name))
+            apply_reconciliation({'bank_accounts': st.session_state.bank_accounts, 'debts': st.session_state.debts},
+                                 differences)
+            st.session_state.balance_history = None
+            self.save_data()
+            self.rerun(f"✅ 已按交易记录修正 {len(differences)} 个账户")
+
+    def show_bank_list(self):
+        """银行卡统计（折算为本位币）和银行卡列表"""
+        st.subheader("💳 银行卡列表")
+
+        # 银行卡统计数据（折算为本位币）
+        symbol = currency_prefix(self.base_currency())
+        total_balance, = self.account_totals(('bank_accounts', "余额"))
+        total_accounts = len(st.session_state.bank_accounts)
+
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("银行卡数量", total_accounts)
+        with col2:
+            st.metric("总余额", f"{symbol}{total_balance:,.2f}")
+        with col3:
+            avg_balance = total_balance / total_accounts if total_accounts > 0 else 0
+            st.metric("平均余额", f"{symbol}{avg_balance:,.2f}")
+
+        # 银行卡数据表格
+        bank_data = []
+        for account, info in st.session_state.bank_accounts.items():
+            currency_symbol = "¥" if info["币种"] == "人民币" else "RM"
+            bank_data.append({
+                "银行卡": account,
+                "币种": info["币种"],
+                "当前余额": info["余额"],
+                "格式化余额": f"{currency_symbol}{info['余额']:,.2f}",
+                "创建时间": info.get("创建时间", "未知"),
+                "最后更新": info.get("最后更新", "未知")
+            })
+
+        bank_df = pd.DataFrame(bank_data)
+
+        # 显示银行卡表格
+        st.dataframe(
+            bank_df[["银行卡", "币种", "格式化余额", "创建时间", "最后更新"]],
+            use_container_width=True
+        )
+
+    @st.fragment
+    def bank_balance_editor(self):
+        """银行卡余额修改（局部重跑；确认调整后同时重画银行卡列表和侧边栏）"""
+        self.begin_fragment()
+        st.subheader("✏️ 修改银行卡余额")
+        col_edit1, col_edit2 = st.columns([2, 1])
+
+        with col_edit1:
+            edit_banks = list(st.session_state.bank_accounts.keys())
+            selected_bank = st.selectbox("选择要修改余额的银行卡", edit_banks, key="bank_selector")
+
+        if selected_bank:
+            bank_info = st.session_state.bank_accounts[selected_bank]
+            current_balance = bank_info["余额"]
+            currency_symbol = "¥" if bank_info["币种"] == "人民币" else "RM"
+
+            with col_edit2:
+                st.info(f"当前余额: **{currency_symbol}{current_balance:,.2f}**")
+
+            # 余额修改选项
+            st.subheader("💰 余额调整方式")
+            adjustment_method = st.radio(
+                "选择调整方式",
+                ["直接设置新余额", "增加金额", "减少金额", "转账调整"],
+                key=f"adjust_method_{selected_bank}"
+            )
+
+            if adjustment_method == "直接设置新余额":
+                # 透支的银行卡余额为负，下限不能高于当前余额
+                new_balance = st.number_input(
+                    "新余额",
+                    min_value=min(0.0, float(current_balance)),
+                    step=100.0,
+                    value=float(current_balance),
+                    format="%.2f",
+                    key=f"new_balance_{selected_bank}"
+                )
+
+                adjustment_amount = new_balance - current_balance
+                adjustment_type = "增加" if adjustment_amount > 0 else "减少" if adjustment_amount < 0 else "不变"
+
+            elif adjustment_method == "增加金额":
+                increase_amount = st.number_input(
+                    "增加金额",
+                    min_value=0.0,
+                    step=100.0,
+                    value=0.0,
+                    format="%.2f",
+                    key=f"increase_{selected_bank}"
+                )
+                new_balance = current_balance + increase_amount
+                adjustment_amount = increase_amount
+                adjustment_type = "增加"
+
+            elif adjustment_method == "减少金额":
+                decrease_amount = st.number_input(
+                    "减少金额",
+                    min_value=0.0,
+                    max_value=max(0.0, float(current_balance)),
+
+                    step=100.0,
+                    value=0.0,
+                    format="%.2f",
+                    key=f"decrease_{selected_bank}"
+                )
+                new_balance = current_balance - decrease_amount
+                adjustment_amount = -decrease_amount
+                adjustment_type = "减少"
+
+            else:  # 转账调整
+                col_transfer1, col_transfer2 = st.columns(2)
+
+                with col_transfer1:
+                    # 选择转出银行卡（不能是当前选中的银行卡）
+                    from_banks = [bank for bank in st.session_state.bank_accounts.keys() if bank != selected_bank]
+                    if from_banks:
+                        from_bank = st.selectbox("从哪个银行卡转出", from_banks, key=f"from_bank_{selected_bank}")
+                        from_bank_balance = st.session_state.bank_accounts[from_bank]["余额"]
+                        from_currency_symbol = "¥" if st.session_state.bank_accounts[from_bank][
+                                                          "币种"] == "人民币" else "RM"
+                        st.info(f"**{from_bank}** 当前余额: {from_currency_symbol}{from_bank_balance:,.2f}")
+                    else:
+                        st.warning("⚠️ 没有其他银行卡可用于转账")
+                        from_bank = None
+
+                with col_transfer2:
+                    if from_bank:
+                        transfer_amount = st.number_input(
+                            "转账金额",
+                            min_value=0.0,
+                            max_value=float(from_bank_balance),
+                            step=100.0,
+                            value=min(500.0, float(from_bank_balance)),
+                            format="%.2f",
+                            key=f"transfer_{selected_bank}"
+                        )
+
+                        # 检查币种是否一致
+                        from_currency = st.session_state.bank_accounts[from_bank]["币种"]
+                        to_currency = bank_info["币种"]
+
+                        if from_currency != to_currency:
+                            st.warning(
+                                f"⚠️ 币种不同: {from_bank}({from_currency}) → {selected_bank}({to_currency})")
+                            exchange_rate = st.number_input(
+                                "汇率",
+                                min_value=0.0,
+                                step=0.01,
+                                value=1.0,
+                                format="%.2f",
+                                key=f"exchange_{selected_bank}"
+                            )
+                            actual_transfer_amount = transfer_amount * exchange_rate
+                        else:
+                            exchange_rate = 1.0
+                            actual_transfer_amount = transfer_amount
+
+                        new_balance = current_balance + actual_transfer_amount
+                        adjustment_amount = actual_transfer_amount
+                        adjustment_type = "转账转入"
+
+            # 显示调整摘要
+            if adjustment_method != "转账调整" or (adjustment_method == "转账调整" and from_bank):
+                st.markdown("---")
+                st.subheader("📋 调整摘要")
+
+                col_sum1, col_sum2, col_sum3 = st.columns(3)
+
+                with col_sum1:
+                    st.metric("当前余额", f"{currency_symbol}{current_balance:,.2f}")
+                with col_sum2:
+                    if adjustment_type == "转账转入":
+                        st.metric("转账金额", f"{currency_symbol}{adjustment_amount:,.2f}")
+                    else:
+                        st.metric("调整金额", f"{currency_symbol}{abs(adjustment_amount):,.2f}")
+                with col_sum3:
+                    st.metric("新余额", f"{currency_symbol}{new_balance:,.2f}")
+
+                # 调整原因
+                adjustment_reason = st.text_input(
+                    "调整原因（可选）",
+                    placeholder="例如：工资到账、现金存入、转账等",
+                    key=f"reason_{selected_bank}"
+                )
+
+                # 执行调整按钮
+                col_btn1, col_btn2 = st.columns(2)
+
+                with col_btn1:
+                    if st.button("✅ 确认调整", use_container_width=True, key=f"confirm_adjust_{selected_bank}"):
+                        # 余额变化通过记录的调整交易（或转账交易）记入
+                        old_balance = st.session_state.bank_accounts[selected_bank]["余额"]
+                        st.session_state.bank_accounts[selected_bank]["最后更新"] = datetime.now().strftime(
+                            "%Y-%m-%d %H:%M:%S")
+
+                        # 如果是转账调整，同时更新转出银行卡
+                        if adjustment_method == "转账调整" and from_bank:
+                            st.session_state.bank_accounts[from_bank]["最后更新"] = datetime.now().strftime(
+                                "%Y-%m-%d %H:%M:%S")
+
+                            # 记录转账交易
+                            transfer_transaction = {
+                                '日期': datetime.now().strftime("%Y-%m-%d"),
+                                '类型': '转账',
+                                '类别': '账户转账',
+                                '项目描述': f"银行卡间转账 {from_bank} → {selected_bank}",
+                                '金额': transfer_amount,
+                                '币种': st.session_state.bank_accounts[from_bank]["币种"],
+                                '支付方式': from_bank,
+                                '对方账户': selected_bank,
+                                '汇率': exchange_rate,
+                                '备注': f"余额调整转账 - {adjustment_reason}" if adjustment_reason else "余额调整转账"
+                            }
+                            self.add_transaction(transfer_transaction)
+
+                        else:
+                            # 记录余额调整交易
+                            transaction_type = "收入" if adjustment_amount > 0 else "支出"
+                            transaction_category = "余额调整" + ("收入" if adjustment_amount > 0 else "支出")
+
+                            adjustment_transaction = {
+                                '日期': datetime.now().strftime("%Y-%m-%d"),
+                                '类型': transaction_type,
+                                '类别': transaction_category,
+                                '项目描述': f"银行卡余额调整 - {adjustment_type}",
+                                '金额': abs(adjustment_amount),
+                                '币种': bank_info["币种"],
+                                '支付方式': selected_bank,
+                                '对方账户': "",
+                                '汇率': 1.0,
+                                '备注': adjustment_reason if adjustment_reason else f"余额调整 - {adjustment_type}"
+                            }
+                            self.add_transaction(adjustment_transaction)
+
+                        self.save_data()
+                        self.rerun(
+                            f"✅ 成功调整 {selected_bank} 的余额: {currency_symbol}{old_balance:,.2f} → {currency_symbol}{new_balance:,.2f}",
+                            scope="fragment")
+
+                with col_btn2:
+                    if st.button("❌ 取消调整", use_container_width=True, key=f"cancel_adjust_{selected_bank}"):
+                        self.rerun(scope="fragment")
+
+    def build_bank_charts(self):
+        """生成银行卡余额条形图和占比饼图（只有一张卡时不生成饼图）"""
+        chart_data = []
+        for account, info in st.session_state.bank_accounts.items():
+            chart_data.append({
+                "银行卡": account,
+                "余额": info["余额"],
+                "币种": info["币种"]
+            })
+
+        chart_df = pd.DataFrame(chart_data)
+
+        # 条形图
+        fig_bar = px.bar(chart_df, x='银行卡', y='余额', title='银行卡余额分布', color='银行卡')
+        fig_bar.update_layout(showlegend=False)
+
+        fig_pie = None
+        if len(chart_df) > 1:
+            fig_pie = px.pie(chart_df, values='余额', names='银行卡', title='银行卡余额占比')
+            fig_pie.update_traces(textposition='inside', textinfo='percent+label')
+        return fig_bar, fig_pie
+
     def get_available_banks_for_repayment(self, debt_currency):
         """获取可用于还款的银行卡列表"""
         available_banks = []
@@ -1220,26 +4069,36 @@ class FinanceApp:
         try:
             # 记录还款前的余额
             current_remaining = st.session_state.debts[debt_name]["剩余"]
-            new_remaining = current_remaining - payment_amount
+            new_remaining = add_amount(current_remaining, -payment_amount)
 
             if new_remaining < 0:
                 st.error("❌ 还款金额不能超过剩余债务金额")
                 return False
 
-            # 更新债务信息
-            st.session_state.debts[debt_name]["剩余"] = new_remaining
+            # 记录还款交易，其分录同时减少银行卡余额和债务剩余
+            repayment_transaction = {
+                '日期': datetime.now().strftime("%Y-%m-%d"),
+                '类型': '支出',
+                '类别': '还款',
+                '项目描述': f"还款 {debt_name}",
+                '金额': payment_amount,
+                '币种': st.session_state.debts[debt_name].get("币种", "人民币"),
+                '支付方式': bank_name,
+                '对方账户': debt_name,
+                '汇率': 1.0,
+                '备注': f"债务还款 - {debt_name}"
+            }
 
-            # 更新债务状态
-            if new_remaining == 0:
-                st.session_state.debts[debt_name]["状态"] = "已还清"
+            transaction_id = self.add_transaction(repayment_transaction)
 
-            # 记录还款记录
+            # 记录还款记录，并关联对应的交易ID
             repayment_record = {
                 "还款日期": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                 "还款金额": payment_amount,
                 "还款方式": bank_name,
                 "还款前余额": current_remaining,
-                "还款后余额": new_remaining
+                "还款后余额": new_remaining,
+                "交易ID": transaction_id
             }
 
             # 初始化还款记录列表（如果不存在）
@@ -1249,28 +4108,6 @@ class FinanceApp:
             # 添加还款记录
             st.session_state.debts[debt_name]["还款记录"].append(repayment_record)
 
-            # 更新银行卡余额
-            if bank_name in st.session_state.bank_accounts:
-                st.session_state.bank_accounts[bank_name]["余额"] -= payment_amount
-
-            # 记录还款交易
-            repayment_transaction = {
-                '日期': datetime.now().strftime("%Y-%m-%d"),
-                '类型': '支出',
-                '类别': '还款',
-                '项目描述': f"还款 {debt_name}",
-                '金额': payment_amount,
-                '币种': st.session_state.debts[debt_name].get("币种", "人民币"),
-                '支付方式': bank_name,
-                '对方账户': debt_name,
-                '汇率': 1.0,
-                '备注': f"债务还款 - {debt_name}"
-            }
-
-            new_transaction = pd.DataFrame([repayment_transaction])
-            st.session_state.transactions = pd.concat([st.session_state.transactions, new_transaction],
-                                                      ignore_index=True)
-
             return True
 
         except Exception as e:
@@ -1286,25 +4123,24 @@ class FinanceApp:
                 if 0 <= record_index < len(repayment_records):
                     # 获取要删除的记录信息
                     record_to_delete = repayment_records[record_index]
-                    repayment_amount = record_to_delete.get("还款金额", 0)
-                    repayment_bank = record_to_delete.get("还款方式", "")
-
-                    # 恢复债务余额
-                    st.session_state.debts[debt_name]["剩余"] += repayment_amount
-
-                    # 更新债务状态
-                    if st.session_state.debts[debt_name]["剩余"] > 0:
-                        st.session_state.debts[debt_name]["状态"] = "还款中"
 
-                    # 恢复银行卡余额
-                    if repayment_bank in st.session_state.bank_accounts:
-                        st.session_state.bank_accounts[repayment_bank]["余额"] += repayment_amount
+                    # 冲回还款交易的分录，恢复债务剩余和银行卡余额；找不到关联交易的旧记录按记录内容冲回
+                    transaction_id = record_to_delete.get("交易ID")
+                    if transaction_id in st.session_state.transactions.index:
+                        repayment_transaction = transaction_records(st.session_state.transactions.loc[[transaction_id]])[0]
+                    else:
+                        repayment_transaction = {
+                            '日期': record_to_delete.get("还款日期", datetime.now().strftime("%Y-%m-%d"))[:10],
+                            '类型': '支出', '类别': '还款', '金额': record_to_delete.get("还款金额", 0),
+                            '支付方式': record_to_delete.get("还款方式", ""), '对方账户': debt_name, '汇率': 1.0
+                        }
+                    self.post_transaction(repayment_transaction, -1)
 
                     # 删除还款记录
                     st.session_state.debts[debt_name]["还款记录"].pop(record_index)
 
                     # 删除对应的交易记录
-                    self.delete_repayment_transaction(debt_name, record_to_delete.get("还款日期", ""))
+                    self.delete_repayment_transaction(debt_name, record_to_delete)
 
                     return True
                 else:
@@ -1318,21 +4154,176 @@ class FinanceApp:
             st.error(f"❌ 删除还款记录失败: {str(e)}")
             return False
 
-    def delete_repayment_transaction(self, debt_name, repayment_date):
+    def delete_repayment_transaction(self, debt_name, repayment_record):
         """删除还款对应的交易记录"""
         try:
-            if not st.session_state.transactions.empty:
-                # 查找对应的还款交易记录
-                df = st.session_state.transactions.copy()
-                mask = (df['项目描述'] == f"还款 {debt_name}") & (df['日期'] == repayment_date.split(' ')[0])
+            transaction_id = repayment_record.get("交易ID")
+            if transaction_id is not None:
+                if transaction_id in st.session_state.transactions.index:
+                    self.delete_transaction_rows([transaction_id])
+
+            elif not st.session_state.transactions.empty:
+                # 没有关联交易ID的旧还款记录，按描述和日期查找
+                df = st.session_state.transactions
+                repayment_date = repayment_record.get("还款日期", "")
+                mask = (df['项目描述'] == f"还款 {debt_name}") & (df['日期'] == pd.Timestamp(repayment_date.split(' ')[0]))
 
                 if mask.any():
                     # 删除对应的交易记录
-                    st.session_state.transactions = st.session_state.transactions[~mask].reset_index(drop=True)
+                    self.delete_transaction_rows(list(df.index[mask]))
 
         except Exception as e:
             st.error(f"❌ 删除还款交易记录失败: {str(e)}")
 
+    def build_debt_chart(self):
+        """生成未还清债务的剩余金额饼图，没有未还清债务时返回 None"""
+        chart_data = []
+        for debt_name, info in st.session_state.debts.items():
+            if info["状态"] == "还款中":  # 只显示未还清的债务
+                chart_data.append({
+                    "债务名称": debt_name,
+                    "剩余金额": info["剩余"],
+                    "币种": info.get("币种", "人民币")
+                })
+
+        if not chart_data:
+            return None
+
+        chart_df = pd.DataFrame(chart_data)
+        fig = px.pie(
+            chart_df,
+            values='剩余金额',
+            names='债务名称',
+            title='剩余债务分布',
+            hover_data=['币种']
+        )
+        fig.update_traces(textposition='inside', textinfo='percent+label')
+        return fig
+
+    @st.fragment
+    def debt_repayment_panel(self, debt_name):
+        """快速还款（局部重跑；还款成功后同时重画债务概览和侧边栏）"""
+        self.begin_fragment()
+        debt_info = st.session_state.debts.get(debt_name)  # 可能刚被其他会话删除
+        if debt_info and debt_info["状态"] == "还款中":
+            st.subheader("💳 快速还款")
+
+            # 获取可用的银行卡
+            available_banks = self.get_available_banks_for_repayment(debt_info.get("币种", "人民币"))
+
+            if not available_banks:
+                st.warning("⚠️ 没有可用的银行卡进行还款，请先添加银行卡")
+            else:
+                # 还款金额输入
+                quick_payment = st.number_input(
+                    "还款金额",
+                    min_value=0.0,
+                    max_value=float(debt_info["剩余"]),
+                    step=100.0,
+                    value=min(500.0, float(debt_info["剩余"])),
+                    format="%.2f",
+                    key="quick_payment"
+                )
+
+                # 银行卡选择
+                selected_bank = st.selectbox(
+                    "选择还款银行卡",
+                    available_banks,
+                    key="repayment_bank"
+                )
+
+                # 显示银行卡余额信息
+                if selected_bank in st.session_state.bank_accounts:
+                    bank_balance = st.session_state.bank_accounts[selected_bank]["余额"]
+                    bank_currency = st.session_state.bank_accounts[selected_bank]["币种"]
+                    currency_symbol = "¥" if bank_currency == "人民币" else "RM"
+                    st.info(f"**{selected_bank}** 当前余额: {currency_symbol}{bank_balance:,.2f}")
+
+                    # 检查余额是否足够
+                    if quick_payment > bank_balance:
+                        st.error("❌ 银行卡余额不足，无法完成还款")
+                    else:
+                        if st.button("💳 确认还款", use_container_width=True, key="quick_repay"):
+                            # 执行还款操作
+                            success = self.process_repayment(
+                                debt_name,
+                                quick_payment,
+                                selected_bank
+                            )
+                            if success:
+                                self.save_data()
+                                self.rerun(f"✅ 成功从 {selected_bank} 还款 {quick_payment:,.2f} 元", scope="fragment")
+
+    def debt_frame(self):
+        """各笔债务的总额、剩余、已还金额和还款进度"""
+        debt_data = []
+        for debt_name, debt_info in st.session_state.debts.items():
+            total = debt_info["总额"]
+            remaining = debt_info["剩余"]
+            paid = total - remaining
+            progress = (paid / total * 100) if total > 0 else 0
+            currency_symbol = "¥" if debt_info.get("币种", "人民币") == "人民币" else "RM"
+
+            debt_data.append({
+                "债务名称": debt_name,
+                "币种": debt_info.get("币种", "人民币"),
+                "借款总额": total,
+                "剩余金额": remaining,
+                "已还金额": paid,
+                "还款进度": progress,
+                "状态": debt_info["状态"],
+                "创建时间": debt_info.get("创建时间", "未知")
+            })
+
+        return pd.DataFrame(debt_data)
+
+    def show_debt_overview(self):
+        """债务概览（折算为本位币的合计）和债务详情表"""
+        st.subheader("📊 债务概览")
+
+        # 债务统计数据（折算为本位币）
+        symbol = currency_prefix(self.base_currency())
+        total_debt, remaining_debt = self.account_totals(('debts', "总额"), ('debts', "剩余"))
+        paid_debt = round(total_debt - remaining_debt, 2)
+        overall_progress = (paid_debt / total_debt * 100) if total_debt > 0 else 0
+
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.metric("总债务金额", f"{symbol}{total_debt:,.2f}")
+        with col2:
+            st.metric("剩余债务", f"{symbol}{remaining_debt:,.2f}")
+        with col3:
+            st.metric("已还金额", f"{symbol}{paid_debt:,.2f}")
+        with col4:
+            st.metric("总还款进度", f"{overall_progress:.1f}%")
+
+        st.markdown("---")
+
+        # 债务详细列表
+        st.subheader("📝 债务详情")
+
+        debt_df = self.debt_frame()
+        if not debt_df.empty:
+            # 格式化显示用的DataFrame
+            display_df = debt_df.copy()
+            display_df["借款总额"] = display_df.apply(
+                lambda x: f"{'¥' if x['币种'] == '人民币' else 'RM'}{x['借款总额']:,.2f}", axis=1
+            )
+            display_df["剩余金额"] = display_df.apply(
+                lambda x: f"{'¥' if x['币种'] == '人民币' else 'RM'}{x['剩余金额']:,.2f}", axis=1
+            )
+            display_df["已还金额"] = display_df.apply(
+                lambda x: f"{'¥' if x['币种'] == '人民币' else 'RM'}{x['已还金额']:,.2f}", axis=1
+            )
+            display_df["还款进度"] = display_df["还款进度"].apply(lambda x: f"{x:.1f}%")
+
+            st.dataframe(
+                display_df[
+                    ["债务名称", "币种", "借款总额", "剩余金额", "已还金额", "还款进度", "状态", "创建时间"]],
+                use_container_width=True,
+                height=400
+            )
+
     def show_debts(self):
         """显示债务管理 - 完整版（带还款记录管理）"""
         st.header("📋 债务管理")
@@ -1363,6 +4354,7 @@ class FinanceApp:
                             "状态": status,
                             "币种": debt_currency,
                             "创建时间": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            "期初剩余": debt_remaining,
                             "还款记录": []  # 初始化还款记录
                         }
                         st.success(f"✅ 成功添加债务: {debt_name}")
@@ -1377,72 +4369,11 @@ class FinanceApp:
 
         # 显示债务列表和编辑功能
         if st.session_state.debts:
-            st.subheader("📊 债务概览")
-
-            # 债务统计数据
-            total_debt = sum(debt["总额"] for debt in st.session_state.debts.values())
-            remaining_debt = sum(debt["剩余"] for debt in st.session_state.debts.values())
-            paid_debt = total_debt - remaining_debt
-            overall_progress = (paid_debt / total_debt * 100) if total_debt > 0 else 0
-
-            col1, col2, col3, col4 = st.columns(4)
-            with col1:
-                st.metric("总债务金额", f"¥{total_debt:,.2f}")
-            with col2:
-                st.metric("剩余债务", f"¥{remaining_debt:,.2f}")
-            with col3:
-                st.metric("已还金额", f"¥{paid_debt:,.2f}")
-            with col4:
-                st.metric("总还款进度", f"{overall_progress:.1f}%")
-
-            st.markdown("---")
-
-            # 债务详细列表
-            st.subheader("📝 债务详情")
-
-            # 创建债务数据表格
-            debt_data = []
-            for debt_name, debt_info in st.session_state.debts.items():
-                total = debt_info["总额"]
-                remaining = debt_info["剩余"]
-                paid = total - remaining
-                progress = (paid / total * 100) if total > 0 else 0
-                currency_symbol = "¥" if debt_info.get("币种", "人民币") == "人民币" else "RM"
-
-                debt_data.append({
-                    "债务名称": debt_name,
-                    "币种": debt_info.get("币种", "人民币"),
-                    "借款总额": total,
-                    "剩余金额": remaining,
-                    "已还金额": paid,
-                    "还款进度": progress,
-                    "状态": debt_info["状态"],
-                    "创建时间": debt_info.get("创建时间", "未知")
-                })
-
-            debt_df = pd.DataFrame(debt_data)
+            # 概览和详情表在快速还款后由编辑器局部重画
+            self.live_view(self.show_debt_overview)
+            debt_df = self.debt_frame()
 
             if not debt_df.empty:
-                # 格式化显示用的DataFrame
-                display_df = debt_df.copy()
-                display_df["借款总额"] = display_df.apply(
-                    lambda x: f"{'¥' if x['币种'] == '人民币' else 'RM'}{x['借款总额']:,.2f}", axis=1
-                )
-                display_df["剩余金额"] = display_df.apply(
-                    lambda x: f"{'¥' if x['币种'] == '人民币' else 'RM'}{x['剩余金额']:,.2f}", axis=1
-                )
-                display_df["已还金额"] = display_df.apply(
-                    lambda x: f"{'¥' if x['币种'] == '人民币' else 'RM'}{x['已还金额']:,.2f}", axis=1
-                )
-                display_df["还款进度"] = display_df["还款进度"].apply(lambda x: f"{x:.1f}%")
-
-                st.dataframe(
-                    display_df[
-                        ["债务名称", "币种", "借款总额", "剩余金额", "已还金额", "还款进度", "状态", "创建时间"]],
-                    use_container_width=True,
-                    height=400
-                )
-
                 # 债务编辑功能
                 st.subheader("✏️ 编辑债务")
                 col1, col2, col3 = st.columns([2, 1, 1])
@@ -1493,6 +4424,10 @@ class FinanceApp:
                             if new_debt_remaining > new_debt_total:
                                 st.error("❌ 剩余金额不能大于借款总额")
                             else:
+                                # 手动修改剩余金额视为期初调整，核对时不算作差异
+                                if debt_info.get("期初剩余") is not None:
+                                    debt_info["期初剩余"] = add_amount(
+                                        debt_info["期初剩余"], new_debt_remaining - debt_info["剩余"])
                                 st.session_state.debts[selected_debt]["总额"] = new_debt_total
                                 st.session_state.debts[selected_debt]["剩余"] = new_debt_remaining
                                 st.session_state.debts[selected_debt]["币种"] = new_debt_currency
@@ -1507,55 +4442,7 @@ class FinanceApp:
 
                     with col6:
                         # 快速还款功能 - 增强版（带银行卡选择）
-                        if debt_info["状态"] == "还款中":
-                            st.subheader("💳 快速还款")
-
-                            # 获取可用的银行卡
-                            available_banks = self.get_available_banks_for_repayment(debt_info.get("币种", "人民币"))
-
-                            if not available_banks:
-                                st.warning("⚠️ 没有可用的银行卡进行还款，请先添加银行卡")
-                            else:
-                                # 还款金额输入
-                                quick_payment = st.number_input(
-                                    "还款金额",
-                                    min_value=0.0,
-                                    max_value=float(debt_info["剩余"]),
-                                    step=100.0,
-                                    value=min(500.0, float(debt_info["剩余"])),
-                                    format="%.2f",
-                                    key="quick_payment"
-                                )
-
-                                # 银行卡选择
-                                selected_bank = st.selectbox(
-                                    "选择还款银行卡",
-                                    available_banks,
-                                    key="repayment_bank"
-                                )
-
-                                # 显示银行卡余额信息
-                                if selected_bank in st.session_state.bank_accounts:
-                                    bank_balance = st.session_state.bank_accounts[selected_bank]["余额"]
-                                    bank_currency = st.session_state.bank_accounts[selected_bank]["币种"]
-                                    currency_symbol = "¥" if bank_currency == "人民币" else "RM"
-                                    st.info(f"**{selected_bank}** 当前余额: {currency_symbol}{bank_balance:,.2f}")
-
-                                    # 检查余额是否足够
-                                    if quick_payment > bank_balance:
-                                        st.error("❌ 银行卡余额不足，无法完成还款")
-                                    else:
-                                        if st.button("💳 确认还款", use_container_width=True, key="quick_repay"):
-                                            # 执行还款操作
-                                            success = self.process_repayment(
-                                                selected_debt,
-                                                quick_payment,
-                                                selected_bank
-                                            )
-                                            if success:
-                                                st.success(f"✅ 成功从 {selected_bank} 还款 {quick_payment:,.2f} 元")
-                                                self.save_data()
-                                                st.rerun()
+                        self.debt_repayment_panel(selected_debt)
 
                     with col7:
                         # 删除功能
@@ -1695,25 +4582,8 @@ class FinanceApp:
                     # 债务分布饼图
                     if len(debt_df) > 1:
                         st.subheader("🥧 债务分布")
-                        chart_data = []
-                        for debt_name, info in st.session_state.debts.items():
-                            if info["状态"] == "还款中":  # 只显示未还清的债务
-                                chart_data.append({
-                                    "债务名称": debt_name,
-                                    "剩余金额": info["剩余"],
-                                    "币种": info.get("币种", "人民币")
-                                })
-
-                        if chart_data:
-                            chart_df = pd.DataFrame(chart_data)
-                            fig = px.pie(
-                                chart_df,
-                                values='剩余金额',
-                                names='债务名称',
-                                title='剩余债务分布',
-                                hover_data=['币种']
-                            )
-                            fig.update_traces(textposition='inside', textinfo='percent+label')
+                        fig = self.section_cache('debt_chart', self.build_debt_chart)
+                        if fig is not None:
                             st.plotly_chart(fig, use_container_width=True)
 
         else:
@@ -1726,30 +4596,103 @@ class FinanceApp:
         else:
             return f"{year}-{str(month - 1).zfill(2)}"
 
-    def calculate_monthly_budget_usage(self, year, month):
-        """计算指定月份的实际预算使用情况"""
-        month_key = f"{year}-{str(month).zfill(2)}"
-
-        if month_key not in st.session_state.budgets:
+    def budget_layout(self):
+        """当前设置了预算的 (月份, 类别, 币种)，变化后需要整体重算已用金额"""
+        return frozenset((month, category, info.get("币种", "人民币"))
+                         for month, budgets in st.session_state.budgets.items() for category, info in budgets.items())
+
+    def refresh_budget_usage(self):
+        """确保所有预算月份的已用金额是最新的：账本整体重新加载、汇率表或预算设置变化后才重算"""
+        key = (self.fx.version(), self.budget_layout())
+        if st.session_state.budget_usage != key:
+            self.calculate_budget_usage()
+            st.session_state.budget_usage = key
+
+    def calculate_budget_usage(self):
+        """一次汇总计算所有预算月份的已用金额，其他币种的支出按月末汇率折算为预算的币种"""
+        budgets = st.session_state.budgets
+        for month_budgets in budgets.values():
+            for info in month_budgets.values():
+                info["已用金额"] = 0
+
+        expenses = self.cube_frame(['类别', '币种'], 类型='支出')
+        expenses = expenses[[category in budgets.get(month, {})
+                             for month, category in zip(expenses['年月'], expenses['类别'])]]
+        if expenses.empty:
             return
 
-        # 重置所有类别的已用金额
-        for category in st.session_state.budgets[month_key]:
-            st.session_state.budgets[month_key][category]["已用金额"] = 0
+        targets = [budgets[month][category].get("币种", "人民币")
+                   for month, category in zip(expenses['年月'], expenses['类别'])]
+        expenses['金额'], _ = self.fx.convert(expenses['金额'], expenses['币种'], expenses['日期'], targets)
+        for (month, category), amount in expenses.groupby(['年月', '类别'])['金额'].sum().items():
+            budgets[month][category]["已用金额"] = round(float(amount), 2)
 
-        # 计算实际支出
-        if not st.session_state.transactions.empty:
-            df = st.session_state.transactions.copy()
-            df['日期'] = pd.to_datetime(df['日期'])
-            df['年月'] = df['日期'].dt.strftime('%Y-%m')
-
-            monthly_expenses = df[(df['类型'] == '支出') & (df['年月'] == month_key)]
+    def tracked_budget(self, row):
+        """交易计入的预算 (月份, 类别)；已用金额尚未计算、不是支出或该月没有此类别预算时为 None"""
+        if st.session_state.budget_usage is None or row['类型'] != '支出':
+            return None
+        key = (str(row['日期'])[:7], row['类别'])
+        return key if key[1] in st.session_state.budgets.get(key[0], {}) else None
+
+    def budget_used(self, key):
+        month, category = key
+        return st.session_state.budgets[month][category].get("已用金额", 0)
+
+    def track_budget_usage(self, key, row, sign):
+        """单笔支出计入（sign=1）或扣除（sign=-1）时原地增减预算 key 的已用金额"""
+        month, category = key
+        budget = st.session_state.budgets[month][category]
+        month_end = pd.Period(month, freq='M').end_time.normalize()
+        converted, _ = self.fx.convert([float(row['金额'])], [row['币种']], month_end, budget.get("币种", "人民币"))
+        budget["已用金额"] = round(budget.get("已用金额", 0) + sign * float(converted[0]), 2)
+
+    def check_budget_alerts(self, used_before):
+        """比较预算变化前后的已用金额，越过提醒阈值时记下一条提醒（只记越过的最高阈值）"""
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for (month, category), used in used_before.items():
+            st.session_state.pending_budget_bases.setdefault((month, category), used)
+            budget = st.session_state.budgets[month][category]
+            crossed = budget_crossings(used, budget.get("已用金额", 0), budget["预算金额"])
+            if crossed:
+                st.session_state.budget_alerts_pending.append({
+                    "时间": now, "月份": month, "类别": category, "阈值": crossed[-1],
+                    "已用金额": budget["已用金额"], "预算金额": budget["预算金额"], "币种": budget.get("币种", "人民币")
+                })
 
-            for category, group in monthly_expenses.groupby('类别'):
-                if category in st.session_state.budgets[month_key]:
-                    budget_currency = st.session_state.budgets[month_key][category].get("币种", "人民币")
-                    category_expenses = group[group['币种'] == budget_currency]
-                    st.session_state.budgets[month_key][category]["已用金额"] = category_expenses['金额'].sum()
+    def recheck_budget_alerts(self, used_local):
+        """合并其他会话的修改后重新检查本会话的预算提醒
+
+        used_local 为合并前本会话的已用金额。本会话的增量（相对修改前）叠加在合并后的已用金额上，
+        从“合并后减去本会话增量”到“合并后”越过的阈值才是本次修改触发的，之前的由其他会话提醒。
+        """
+        self.refresh_budget_usage()  # 其他会话改了预算设置时已用金额需要整体重算
+        bases = st.session_state.pending_budget_bases
+        st.session_state.budget_alerts_pending = []
+        self.check_budget_alerts({key: self.budget_used(key) - (used - bases[key])
+                                  for key, used in used_local.items()
+                                  if key[1] in st.session_state.budgets.get(key[0], {})})
+
+
+    def build_budget_chart(self, month_key, title):
+        """生成指定月份的预算分布饼图"""
+        chart_data = []
+        for category, info in st.session_state.budgets[month_key].items():
+            chart_data.append({
+                "类别": category,
+                "预算金额": info["预算金额"],
+                "币种": info.get("币种", "人民币")
+            })
+
+        chart_df = pd.DataFrame(chart_data)
+        fig = px.pie(
+            chart_df,
+            values='预算金额',
+            names='类别',
+            title=title,
+            hover_data=['币种']
+        )
+        fig.update_traces(textposition='inside', textinfo='percent+label')
+        return fig
 
     def show_budgets(self):
         """显示预算管理 - 按月设置版本"""
@@ -1781,6 +4724,18 @@ class FinanceApp:
         if month_key not in st.session_state.budgets:
             st.session_state.budgets[month_key] = {}
 
+        # 预算的增删改不影响其他页面和侧边栏，只需局部重跑
+        self.budget_editor(selected_year, selected_month, month_key)
+
+    @st.fragment
+    def budget_editor(self, selected_year, selected_month, month_key):
+        """指定月份的预算添加、复制、执行情况和编辑（局部重跑）"""
+        self.begin_fragment()
+        st.session_state.budgets.setdefault(month_key, {})  # 同步后重新加载的数据可能还没有该月
+
+
+        month_names = ["1月", "2月", "3月", "4月", "5月", "6月", "7月", "8月", "9月", "10月", "11月", "12月"]
+
         # 添加新预算
         st.subheader("➕ 添加新预算")
         with st.form("add_budget_form"):
@@ -1803,9 +4758,8 @@ class FinanceApp:
                             "已用金额": 0,
                             "币种": new_currency
                         }
-                        st.success(f"✅ 成功为 {month_key} 添加预算类别: {new_category}")
                         self.save_data()
-                        st.rerun()
+                        self.rerun(f"✅ 成功为 {month_key} 添加预算类别: {new_category}", scope="fragment")
                     else:
                         st.error(f"❌ {selected_month} 中该预算类别已存在")
                 else:
@@ -1827,9 +4781,8 @@ class FinanceApp:
                             "已用金额": 0,  # 重置已用金额
                             "币种": budget_info["币种"]
                         }
-                    st.success(f"✅ 已从 {prev_month} 复制预算设置到 {month_key}")
                     self.save_data()
-                    st.rerun()
+                    self.rerun(f"✅ 已从 {prev_month} 复制预算设置到 {month_key}", scope="fragment")
                 else:
                     st.warning(f"⚠️ {prev_month} 没有可复制的预算数据")
 
@@ -1837,8 +4790,8 @@ class FinanceApp:
         if st.session_state.budgets[month_key]:
             st.subheader("📊 预算执行情况")
 
-            # 计算该月的实际支出
-            self.calculate_monthly_budget_usage(selected_year, month_names.index(selected_month) + 1)
+            # 各月的实际支出：只在账本整体变化后重算一次，单笔交易变化时已增量更新
+            self.refresh_budget_usage()
 
             # 创建预算数据的副本用于显示和编辑
             budget_data = []
@@ -1944,9 +4897,8 @@ class FinanceApp:
                                      key=f"update_{month_key}_{selected_category}"):
                             st.session_state.budgets[month_key][selected_category]["预算金额"] = new_budget_amount
                             st.session_state.budgets[month_key][selected_category]["币种"] = new_budget_currency
-                            st.success(f"✅ 成功更新 {selected_category} 的预算")
                             self.save_data()
-                            st.rerun()
+                            self.rerun(f"✅ 成功更新 {selected_category} 的预算", scope="fragment")
 
                     with col5:
                         # 删除功能
@@ -1968,9 +4920,8 @@ class FinanceApp:
 
                             # 执行删除
                             del st.session_state.budgets[month_key][selected_category]
-                            st.success(f"✅ 成功删除预算类别: {selected_category}")
                             self.save_data()
-                            st.rerun()
+                            self.rerun(f"✅ 成功删除预算类别: {selected_category}", scope="fragment")
 
                 # 预算使用情况图表
                 st.subheader("📈 预算执行情况图表")
@@ -2011,25 +4962,9 @@ class FinanceApp:
                 # 预算分布饼图
                 if len(st.session_state.budgets[month_key]) > 0:
                     st.subheader("🥧 预算分布")
-                    chart_data = []
-                    for category, info in st.session_state.budgets[month_key].items():
-                        chart_data.append({
-                            "类别": category,
-                            "预算金额": info["预算金额"],
-                            "币种": info.get("币种", "人民币")
-                        })
-
-                    if chart_data:
-                        chart_df = pd.DataFrame(chart_data)
-                        fig = px.pie(
-                            chart_df,
-                            values='预算金额',
-                            names='类别',
-                            title=f'{selected_year}年{selected_month} 预算分布',
-                            hover_data=['币种']
-                        )
-                        fig.update_traces(textposition='inside', textinfo='percent+label')
-                        st.plotly_chart(fig, use_container_width=True)
+                    fig = self.section_cache(('budget_chart', month_key), functools.partial(
+                        self.build_budget_chart, month_key, f'{selected_year}年{selected_month} 预算分布'))
+                    st.plotly_chart(fig, use_container_width=True)
 
             else:
                 st.info("📝 本月暂无预算数据")
@@ -2037,86 +4972,119 @@ class FinanceApp:
         else:
             st.info("📝 本月暂无预算数据，请先添加预算")
 
+    def build_analytics_charts(self):
+        """生成收入/支出币种分布饼图（无数据时为 None）和月度收支趋势图，金额按月末汇率折算为本位币"""
+        base = self.base_currency()
+        frame = self.cube_frame(['类型', '币种'])
+        frame['金额'], missing = self.fx.convert(frame['金额'], frame['币种'], frame['日期'], base)
+        figures = {'缺少汇率': missing}
+
+        for transaction_type in ('收入', '支出'):
+            chart_df = frame[frame['类型'] == transaction_type].groupby('币种', as_index=False)['金额'].sum()
+            chart_df = chart_df[chart_df['金额'] > 0]
+
+            figures[transaction_type] = None
+            if not chart_df.empty:
+                figures[transaction_type] = px.pie(chart_df, values='金额', names='币种',
+                                                   title=f'{transaction_type}币种分布（折合{base}）')
+
+        monthly_data = frame.groupby(['年月', '类型'], as_index=False)['金额'].sum()
+
+        # 创建月度趋势图
+        fig_trend = px.line(
+            monthly_data,
+            x='年月',
+            y='金额',
+            color='类型',
+            title=f'月度收支趋势（折合{base}）',
+            markers=True
+        )
+        fig_trend.update_layout(xaxis_title='月份', yaxis_title='金额')
+        figures['趋势'] = fig_trend
+        return figures
+
     def show_analytics(self):
         """显示分析图表"""
         st.header("📈 财务分析")
 
         if not st.session_state.transactions.empty:
+            figures = self.section_cache(self.fx_key('analytics'), self.build_analytics_charts)
+            self.show_missing_rates(figures['缺少汇率'])
+
             # 收支分析
             st.subheader("💰 收支分析")
-            currency_stats = self.get_currency_statistics(st.session_state.transactions)
-
-            if currency_stats:
+            if figures['收入'] is not None or figures['支出'] is not None:
                 col1, col2 = st.columns(2)
 
                 with col1:
                     # 收入饼图
-                    income_data = []
-                    for currency, stats in currency_stats.items():
-                        if stats['收入'] > 0:
-                            income_data.append({'币种': currency, '金额': stats['收入']})
-
-                    if income_data:
-                        income_df = pd.DataFrame(income_data)
-                        fig_income = px.pie(income_df, values='金额', names='币种', title='收入币种分布')
-                        st.plotly_chart(fig_income, use_container_width=True)
+                    if figures['收入'] is not None:
+                        st.plotly_chart(figures['收入'], use_container_width=True)
 
                 with col2:
                     # 支出饼图
-                    expense_data = []
-                    for currency, stats in currency_stats.items():
-                        if stats['支出'] > 0:
-                            expense_data.append({'币种': currency, '金额': stats['支出']})
-
-                    if expense_data:
-                        expense_df = pd.DataFrame(expense_data)
-                        fig_expense = px.pie(expense_df, values='金额', names='币种', title='支出币种分布')
-                        st.plotly_chart(fig_expense, use_container_width=True)
+                    if figures['支出'] is not None:
+                        st.plotly_chart(figures['支出'], use_container_width=True)
 
             # 月度趋势分析
             st.subheader("📊 月度趋势")
-            if not st.session_state.transactions.empty:
-                df = st.session_state.transactions.copy()
-                df['日期'] = pd.to_datetime(df['日期'])
-                df['年月'] = df['日期'].dt.strftime('%Y-%m')
-
-                monthly_data = df.groupby(['年月', '类型']).agg({'金额': 'sum'}).reset_index()
-
-                # 创建月度趋势图
-                fig_trend = px.line(
-                    monthly_data,
-                    x='年月',
-                    y='金额',
-                    color='类型',
-                    title='月度收支趋势',
-                    markers=True
-                )
-                fig_trend.update_layout(xaxis_title='月份', yaxis_title='金额')
-                st.plotly_chart(fig_trend, use_container_width=True)
+            st.plotly_chart(figures['趋势'], use_container_width=True)
+
+            self.show_net_worth_history()
 
         else:
             st.info("暂无足够数据进行分析")
 
+    def build_net_worth_chart(self):
+        """生成从第一笔交易至今的每日净资产走势图（按当天汇率折算为本位币），以及缺少汇率的币种"""
+        base = self.base_currency()
+        first_day = st.session_state.transactions['日期'].min().date()
+        days = np.arange(np.datetime64(first_day, 'D'), np.datetime64(datetime.now().date(), 'D') + 1)
+        missing = set()
+
+        def convert(values, currency):
+            converted, absent = self.fx.convert(values, [currency] * len(values), days, base)
+            missing.update(absent)
+            return converted
+
+        series = self.balance_history().net_worth(st.session_state.bank_accounts, st.session_state.debts, days,
+                                                  convert=convert)
+        fig = px.line(series.reset_index(), x='日期', y=['总资产', '总债务', '净资产'],
+                      title=f'每日净资产走势（折合{base}）')
+        fig.update_layout(xaxis_title='日期', yaxis_title='金额', legend_title_text='')
+        return fig, missing
+
+    def show_net_worth_history(self):
+        """净资产走势，以及查询任意日期的各账户余额"""
+        st.subheader("🏆 净资产走势")
+        fig, missing = self.section_cache(self.fx_key('net_worth'), self.build_net_worth_chart)
+        self.show_missing_rates(missing)
+        st.plotly_chart(fig, use_container_width=True)
+
+        as_of = st.date_input("查询某日结束时的余额", value=datetime.now().date(), key="balance_as_of")
+        history = self.balance_history()
+        day = [np.datetime64(as_of, 'D')]
+        rows = [{"账户": name, "类型": "银行卡", "币种": info["币种"],
+                 "金额": history.values_as_of(f"{BANK_ACCOUNT}:{name}", info["余额"], day)[0]}
+                for name, info in st.session_state.bank_accounts.items()]
+        rows += [{"账户": name, "类型": "债务", "币种": info.get("币种", "人民币"),
+                  "金额": history.values_as_of(f"{DEBT_ACCOUNT}:{name}", info["剩余"], day)[0]}
+                 for name, info in st.session_state.debts.items()]
+        if rows:
+            st.dataframe(pd.DataFrame(rows).style.format({"金额": "{:,.2f}"}), use_container_width=True, hide_index=True)
+
     def run_app(self):
         """运行应用"""
         self.sidebar()
 
-        tabs = st.tabs([
-            "💰 添加交易", "📊 交易记录", "🏦 银行卡", "📋 债务管理", "💰 预算管理", "📈 财务分析"
-        ])
+        # 标签页会在每次重跑时执行全部页面，这里改为只运行选中的页面
+        page = st.radio("页面", list(self.PAGES), horizontal=True, key="active_page", label_visibility="collapsed")
+        st.markdown("---")
+        self.show_flash_message()
+        getattr(self, self.PAGES[page])()
+        if not self.live_views_drawn:
+            self.draw_live_views()
 
-        with tabs[0]:
-            self.add_transaction_form()
-        with tabs[1]:
-            self.show_transactions()
-        with tabs[2]:
-            self.show_bank_accounts()
-        with tabs[3]:
-            self.show_debts()
-        with tabs[4]:
-            self.show_budgets()
-        with tabs[5]:
-            self.show_analytics()
 
 
 def show_email_configuration():
@@ -2209,36 +5177,27 @@ def show_email_configuration():
         if test_btn:
             if all([smtp_server, smtp_port, sender_email, sender_password]):
                 email_manager.configure_smtp(smtp_server, smtp_port, sender_email, sender_password, enable_tls, use_ssl)
-                success, message = email_manager.test_connection()
-                if success:
-                    st.success("✅ " + message)
-
-                    # 测试发送邮件
-                    try:
-                        test_success, test_msg = email_manager.send_reset_email(
-                            sender_email, "TEST123", "TestUser"
-                        )
-                        if test_success:
-                            st.success("✅ 测试邮件发送成功！请检查您的收件箱")
-                        else:
-                            st.warning("⚠️ 连接成功但发送测试邮件失败: " + test_msg)
-                    except Exception as e:
-                        st.warning(f"⚠️ 连接成功但发送测试邮件失败: {str(e)}")
-                else:
-                    st.error("❌ " + message)
-
-                    # 提供故障排除建议
-                    if "126.com" in smtp_server:
-                        st.error("""
-                        **126邮箱故障排除：**
-                        1. 确认已开启SMTP服务
-                        2. 确认使用的是**授权码**而不是邮箱密码
-                        3. 尝试使用端口465 + SSL
-                        4. 检查邮箱地址是否正确
-                        """)
+                # 连接测试和测试邮件都在后台发送，下方显示进度
+                st.session_state.smtp_test_jobs = [
+                    ("邮箱连接测试", email_manager.test_connection()),
+                    ("测试邮件（请检查您的收件箱）", email_manager.send_reset_email(sender_email, "TEST123", "TestUser"))
+                ]
             else:
                 st.error("❌ 请先填写所有配置项")
 
+    if st.session_state.get('smtp_test_jobs'):
+        # 提供故障排除建议
+        troubleshooting = None
+        if "126.com" in st.session_state.smtp_test_jobs[0][1].config.get("smtp_server", ""):
+            troubleshooting = """
+            **126邮箱故障排除：**
+            1. 确认已开启SMTP服务
+            2. 确认使用的是**授权码**而不是邮箱密码
+            3. 尝试使用端口465 + SSL
+            4. 检查邮箱地址是否正确
+            """
+        show_mail_jobs(st.session_state.smtp_test_jobs, troubleshooting)
+
 
 def main():
     """主函数"""
@@ -2344,11 +5303,12 @@ def main():
 
                     if submitted:
                         if username:
-                            success, message = user_manager.request_password_reset(username)
+                            success, message, job = user_manager.request_password_reset(username)
                             if success:
                                 st.success("✅ " + message)
                                 st.session_state.reset_stage = "verify"
                                 st.session_state.reset_username = username
+                                st.session_state.reset_mail_job = job
                                 st.rerun()
                             else:
                                 st.error("❌ " + message)
@@ -2363,6 +5323,9 @@ def main():
                 # 验证重置令牌
                 st.subheader("🔑 密码找回 - 验证令牌")
 
+                if st.session_state.get('reset_mail_job') is not None:
+                    show_mail_jobs([("密码重置邮件", st.session_state.reset_mail_job)])
+
                 # 如果从URL获取了令牌，自动填充
                 if 'reset_token' not in st.session_state:
                     st.session_state.reset_token = ""
@@ -2393,8 +5356,10 @@ def main():
                 with col2:
                     if st.button("🔄 重新发送邮件", use_container_width=True):
                         if hasattr(st.session_state, 'reset_username'):
-                            success, message = user_manager.request_password_reset(st.session_state.reset_username)
+                            success, message, job = user_manager.request_password_reset(
+                                st.session_state.reset_username)
                             if success:
+                                st.session_state.reset_mail_job = job
                                 st.success("✅ " + message)
                             else:
                                 st.error("❌ " + message)
@@ -2500,5 +5465,140 @@ def main():
         finance_app.run_app()
 
 
+def export_all_users(output_dir, file_format='csv', usernames=None):
+    """导出所有（或指定）用户的交易记录，返回生成的文件路径列表"""
+    os.makedirs(output_dir, exist_ok=True)
+    exported = []
+    for username in usernames or user_data_names():
+        data_dir = os.path.join("user_data", username)
+        if not os.path.isdir(data_dir):
+            print(f"跳过 {username}: 数据目录不存在")
+            continue
+
+        # 加锁读取：load 会截掉未写完的日志尾部，不能与正在追加的会话并发
+        store = open_ledger_store(data_dir)
+        with store.locked():
+            data, _ = store.load()
+        output_file = os.path.join(output_dir, f"{username}_transactions.{file_format}")
+        with open(output_file, 'wb') as f:
+            write_transactions_file(transaction_frame(data['transactions']), f, file_format)
+        exported.append(output_file)
+    return exported
+
+
+def export_cli(argv):
+    """命令行导出：python App.py export [-o 目录] [-f csv|xlsx] [-u 用户名 ...]"""
+    parser = argparse.ArgumentParser(prog="App.py export", description="导出用户交易记录")
+    parser.add_argument("-o", "--output", default="exports", help="输出目录")
+    parser.add_argument("-f", "--format", choices=list(EXPORT_FORMATS), default="csv", help="导出格式")
+    parser.add_argument("-u", "--user", nargs="*", help="只导出指定用户")
+    args = parser.parse_args(argv)
+
+    exported = export_all_users(args.output, args.format, args.user)
+    for output_file in exported:
+        print(f"已导出 {output_file}")
+    if not exported:
+        print("没有可导出的用户数据")
+
+
+def reconcile_user(data_dir, fix=False):
+    """核对（fix=True 时同时修正）一个用户数据目录，返回 (差异列表, 补记债务的还款笔数)；在进程池中执行"""
+    store = open_ledger_store(data_dir)
+    with store.locked():
+        data, _ = store.load()
+        transactions = transaction_frame(data['transactions'])
+        differences, assigned = reconcile_ledger(transactions, data)
+
+        if fix and (differences or assigned):
+            ops = [{'op': 'update', 'id': record[ID_COLUMN], 'row': dict(record, 对方账户=assigned[record[ID_COLUMN]])}
+                   for record in transaction_records(transactions.loc[list(assigned)])]
+            apply_reconciliation(data, differences)
+            for difference in differences:
+                section = RECONCILE_ACCOUNTS[difference['科目']][0]
+                ops.append({'op': 'set', 'section': section, 'key': difference['名称'],
+                            'value': data[section][difference['名称']]})
+            store.append(ops)
+    return differences, len(assigned)
+
+
+def user_data_names():
+    """user_data 下各用户的数据目录名；全新安装还没有 user_data 时返回空列表"""
+    if not os.path.isdir("user_data"):
+        return []
+    return sorted(name for name in os.listdir("user_data") if os.path.isdir(os.path.join("user_data", name)))
+
+
+def reconcile_cli(argv):
+    """命令行核对：python App.py reconcile [--fix] [-u 用户名 ...] [-j 进程数]"""
+    parser = argparse.ArgumentParser(prog="App.py reconcile", description="按交易记录核对所有用户的银行卡余额和债务剩余")
+    parser.add_argument("--fix", action="store_true", help="按交易记录修正不一致的余额")
+    parser.add_argument("-u", "--user", nargs="*", help="只核对指定用户")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="并行进程数（默认为CPU核数）")
+    args = parser.parse_args(argv)
+
+    usernames = []
+    for username in args.user or user_data_names():
+        if os.path.isdir(os.path.join("user_data", username)):
+            usernames.append(username)
+        else:
+            print(f"跳过 {username}: 数据目录不存在")
+    data_dirs = [os.path.join("user_data", username) for username in usernames]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+
+        results = pool.map(reconcile_user, data_dirs, itertools.repeat(args.fix))
+        for username, (differences, assigned) in zip(usernames, results):
+            if not differences and not assigned:
+                print(f"{username}: 一致")
+                continue
+            missing = sum(difference['重算'] is None for difference in differences)
+            print(f"{username}: {len(differences) - missing} 个账户不一致，{missing} 个账户缺少期初金额，"
+                  f"{assigned} 笔还款未指明债务" + ("（已修正）" if args.fix else ""))
+            for difference in differences:
+                recomputed = "缺少期初金额" if difference['重算'] is None else f"{difference['重算']:,.2f}"
+                print(f"  {difference['科目']} {difference['名称']}: 当前 {difference['当前']:,.2f}，按交易重算 {recomputed}")
+
+
+def digest_cli(argv):
+    """命令行发送预算提醒邮件汇总：python App.py digest [-u 用户名 ...]，由定时任务每天运行一次"""
+    parser = argparse.ArgumentParser(prog="App.py digest", description="把开启了每日邮件汇总的用户的新预算提醒合并发送")
+    parser.add_argument("-u", "--user", nargs="*", help="只发送指定用户")
+    args = parser.parse_args(argv)
+
+    usernames = args.user or user_data_names()
+    directory = UserDirectory()
+    email_manager = EmailManager()
+    jobs = []
+    for username in usernames:
+        inbox = BudgetAlertInbox(os.path.join("user_data", username))
+        if not os.path.isdir(inbox.data_dir):
+            print(f"跳过 {username}: 数据目录不存在")
+            continue
+        with ledger_lock(inbox.data_dir):
+
+            state = inbox.state()
+            alerts = inbox.alerts(state['emailed']) if state['digest'] else []
+        if not alerts:
+            continue
+        info = directory.get(username)
+        if not info or not info.get("email"):
+            print(f"{username}: 未设置邮箱，跳过")
+            continue
+        job = email_manager.send_budget_digest(info["email"], username, alerts)
+        jobs.append((username, inbox, state['emailed'] + len(alerts), job))
+
+    for username, inbox, emailed, job in jobs:
+        if job.wait():
+            inbox.mark_emailed(emailed)
+            print(f"{username}: 已发送预算提醒汇总")
+        else:
+            print(f"{username}: 发送失败 - {job.error}")
+
+
+CLI_COMMANDS = {"export": export_cli, "reconcile": reconcile_cli, "digest": digest_cli}
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # 不经 streamlit 直接运行 "python App.py export|reconcile|digest ..." 时执行批处理命令，供定时任务使用
+    if sys.argv[1:2] and sys.argv[1] in CLI_COMMANDS and not st.runtime.exists():
+        CLI_COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,80 @@
+"""批量导入基准：python benchmarks/bench_import.py [--rows 500000] [--backend json|sqlite] [--single 2000]
+
+生成 rows 笔交易的 CSV，计时 import_transactions（分块读取、校验、记账）、保存和重新加载；
+--single 另外计时逐笔 add_transaction 添加前若干笔，作为对照。
+"""
+import argparse
+import time
+
+import streamlit as st
+
+from common import add_backend_argument, make_user, run_session, sample_transactions, scratch_dir, use_backend
+
+
+def import_file(path):
+    import time
+
+    import streamlit as st
+    import App
+
+    app = App.FinanceApp("alice")
+    start = time.perf_counter()
+    imported, rejected = app.import_transactions(path)
+    imported_at = time.perf_counter()
+    app.save_data()
+    st.session_state.timings = (imported, imported_at - start, time.perf_counter() - imported_at)
+
+
+def add_one_by_one(rows):
+    import time
+
+    import streamlit as st
+    import App
+
+    app = App.FinanceApp("bob")
+    start = time.perf_counter()
+    for row in rows:
+        app.add_transaction(dict(row, 币种="人民币", 汇率=1.0, 备注=""))
+    added_at = time.perf_counter()
+    app.save_data()
+    st.session_state.timings = (added_at - start, time.perf_counter() - added_at)
+
+
+def load(username):
+    import App
+
+    App.FinanceApp(username)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量导入基准")
+    parser.add_argument("--rows", type=int, default=500_000, help="导入的交易笔数")
+    parser.add_argument("--single", type=int, default=0, help="逐笔添加对照的笔数（0 为不对照）")
+    add_backend_argument(parser)
+    args = parser.parse_args()
+    use_backend(args.backend)
+
+    with scratch_dir():
+        banks = {"卡A": 10_000.0, "卡B": 5_000.0}
+        make_user("alice", banks)
+        rows = sample_transactions(args.rows)
+        rows.to_csv("import.csv", index=False)
+
+        imported, import_seconds, save_seconds = run_session(import_file, "import.csv").session_state.timings
+        print(f"导入 {imported:,} 笔（{args.backend}）：读取、校验和记账 {import_seconds:.2f} 秒，保存 {save_seconds:.2f} 秒")
+
+        st.cache_resource.clear()  # 不使用进程内的共享快照，从磁盘加载
+        start = time.perf_counter()
+        run_session(load, "alice")
+        print(f"重新加载 {time.perf_counter() - start:.2f} 秒")
+
+        if args.single:
+            make_user("bob", banks)
+            add_seconds, save_seconds = run_session(
+                add_one_by_one, rows.head(args.single).to_dict('records')).session_state.timings
+            print(f"逐笔添加 {args.single:,} 笔：{add_seconds:.2f} 秒（每笔 {add_seconds / args.single * 1000:.2f} 毫秒），"
+                  f"保存 {save_seconds:.2f} 秒")
+
+
+if __name__ == "__main__":
+    main()
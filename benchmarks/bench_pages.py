@@ -0,0 +1,34 @@
+"""页面重跑基准：python benchmarks/bench_pages.py [--rows 100000] [--backend json|sqlite]
+
+导入 rows 笔交易后依次打开各页面，计时切换到该页（首次计算图表等）和停留在该页再重跑一次
+（复用页面缓存）的耗时。只运行选中的页面，添加交易页的重跑不受图表页的影响。
+"""
+import argparse
+
+from common import (add_backend_argument, open_app, scratch_dir, seed_transactions, timed_run, use_backend,
+                    widget)
+
+PAGES = ["💰 添加交易", "📊 交易记录", "🏦 银行卡", "📋 债务管理", "💰 预算管理", "📈 财务分析"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="页面重跑基准")
+    parser.add_argument("--rows", type=int, default=100_000, help="交易笔数")
+    add_backend_argument(parser)
+    args = parser.parse_args()
+    use_backend(args.backend)
+
+    with scratch_dir():
+        seed_transactions(args.rows, {"卡A": 10_000.0, "卡B": 5_000.0})
+        at = open_app()
+
+        print(f"{args.rows:,} 笔交易（{args.backend}）")
+        for page in PAGES[1:] + PAGES[:1]:
+            widget(at.radio, "页面").set_value(page)
+            first = timed_run(at)
+            again = timed_run(at)
+            print(f"{page}：切换 {first * 1000:.0f} 毫秒，重跑 {again * 1000:.0f} 毫秒")
+
+
+if __name__ == "__main__":
+    main()
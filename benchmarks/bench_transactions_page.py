@@ -0,0 +1,42 @@
+"""交易记录页基准：python benchmarks/bench_transactions_page.py [--rows 100000] [--backend json|sqlite]
+
+导入 rows 笔交易后打开交易记录页，计时翻页、改每页条数和关键词搜索各自触发的一次重跑。
+每次重跑只格式化并发送当前页，耗时应与交易笔数基本无关。
+"""
+import argparse
+
+from common import (add_backend_argument, open_app, scratch_dir, seed_transactions, timed_run, use_backend,
+                    widget)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="交易记录页基准")
+    parser.add_argument("--rows", type=int, default=100_000, help="交易笔数")
+    add_backend_argument(parser)
+    args = parser.parse_args()
+    use_backend(args.backend)
+
+    with scratch_dir():
+        seed_transactions(args.rows, {"卡A": 10_000.0, "卡B": 5_000.0})
+        at = open_app()
+        widget(at.radio, "页面").set_value("📊 交易记录")
+
+        print(f"{args.rows:,} 笔交易（{args.backend}）")
+        steps = [
+            ("打开交易记录页", lambda: None),
+            ("原样重跑", lambda: None),
+            ("翻到第 2 页", lambda: widget(at.number_input, "页码").set_value(2)),
+            ("翻到最后一页", lambda: widget(at.number_input, "页码").set_value(args.rows // 20)),
+            ("每页 200 条", lambda: widget(at.selectbox, "每页条数").set_value(200)),
+            ("搜索“超市购物”", lambda: widget(at.text_input, "🔍 搜索").input("超市购物")),
+            ("搜索结果翻到第 3 页", lambda: widget(at.number_input, "页码").set_value(3)),
+            ("清空搜索", lambda: widget(at.text_input, "🔍 搜索").input("")),
+        ]
+        for name, action in steps:
+            action()
+            seconds = timed_run(at)
+            print(f"{name}：{seconds * 1000:.0f} 毫秒  {at.caption[0].value}")
+
+
+if __name__ == "__main__":
+    main()
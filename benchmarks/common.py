@@ -0,0 +1,123 @@
+"""基准测试的公共部分：在临时目录中准备用户数据，在模拟的 Streamlit 会话中运行被测代码"""
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+# App.py 位于仓库根目录，不是安装包
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def add_backend_argument(parser):
+    """--backend 选择存储后端；须在导入 App 之前设置环境变量"""
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json", help="存储后端")
+
+
+def use_backend(backend):
+    os.environ["FINANCE_STORAGE_BACKEND"] = backend
+
+
+@contextlib.contextmanager
+def scratch_dir():
+    """在临时目录中运行，结束后回到原目录并删除临时数据"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        os.chdir(path)
+        try:
+            yield path
+        finally:
+            os.chdir(cwd)
+            st.cache_resource.clear()
+
+
+def make_user(username="alice", bank_accounts=(), debts=()):
+    """创建用户数据目录；bank_accounts / debts 为 {名称: 金额}"""
+    data_dir = os.path.join("user_data", username)
+    os.makedirs(data_dir)
+    data = {
+        'transactions': [],
+        'bank_accounts': {name: {"余额": amount, "币种": "人民币", "创建时间": "2024-01-01 00:00:00",
+                                 "最后更新": "2024-01-01 00:00:00", "期初余额": amount}
+                          for name, amount in dict(bank_accounts).items()},
+        'debts': {name: {"总额": amount, "剩余": amount, "状态": "还款中", "币种": "人民币",
+                         "创建时间": "2024-01-01 00:00:00", "期初剩余": amount, "还款记录": []}
+                  for name, amount in dict(debts).items()},
+        'budgets': {},
+    }
+    with open(os.path.join(data_dir, "finance_data.json"), 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+def sample_transactions(count, seed=0):
+    """count 笔有效交易：收入、支出、本人账户间和向他人的转账，日期从 2015 年起递增"""
+    rng = np.random.default_rng(seed)
+    rows = pd.DataFrame({
+        '日期': pd.date_range('2015-01-01', periods=count, freq='10min').strftime('%Y-%m-%d'),
+        '类型': rng.choice(['收入', '支出', '转账'], count, p=[0.3, 0.6, 0.1]),
+        '类别': rng.choice(['餐饮', '交通', '购物', '工资'], count),
+        '项目描述': [f"第{i}笔 超市购物" if i % 7 == 0 else f"第{i}笔" for i in range(count)],
+        '金额': rng.integers(1, 50000, count) / 100,
+        '支付方式': rng.choice(['卡A', '卡B', '现金'], count),
+        '对方账户': '',
+    })
+    transfers = rows['类型'] == '转账'
+    rows.loc[transfers, '对方账户'] = np.where(rows.loc[transfers, '支付方式'] == '卡A', '卡B', '卡A')
+    return rows
+
+
+def run_session(script, *args, **kwargs):
+    """在模拟的 Streamlit 会话中运行 script(*args)，返回 AppTest，可读取其 session_state
+
+    script 的源码会被单独执行，所需的模块要在函数内导入。
+    """
+    at = AppTest.from_function(script, args=args, kwargs=kwargs, default_timeout=3600)
+    at.run()
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+    return at
+
+
+def seed_transactions(count, banks, username="alice"):
+    """创建用户并用 import_transactions 导入 count 笔示例交易"""
+    make_user(username, banks)
+    sample_transactions(count).to_csv("import.csv", index=False)
+    run_session(_import_file, username, "import.csv")
+
+
+def _import_file(username, path):
+    import App
+
+    app = App.FinanceApp(username)
+    app.import_transactions(path)
+    app.save_data()
+
+
+def open_app(username="alice"):
+    """以已登录的 username 打开 App.py，运行一次并返回 AppTest"""
+    app_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "App.py")
+    at = AppTest.from_file(app_file, default_timeout=3600)
+    at.session_state.logged_in = True
+    at.session_state.current_user = username
+    timed_run(at)
+    return at
+
+
+def timed_run(at):
+    """重跑一次脚本，返回耗时（秒）"""
+    start = time.perf_counter()
+    at.run()
+    seconds = time.perf_counter() - start
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+    return seconds
+
+
+def widget(widgets, label):
+    return next(w for w in widgets if w.label == label)
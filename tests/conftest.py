@@ -0,0 +1,75 @@
+import json
+import os
+import sys
+
+import pytest
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+# App.py 位于仓库根目录，不是安装包
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """在临时目录中运行：App 以当前目录下的 user_data、users.json 等文件为数据"""
+    monkeypatch.chdir(tmp_path)
+    # 共享账本快照、汇率表等进程级缓存属于上一个测试的目录
+    st.cache_resource.clear()
+    yield tmp_path
+    st.cache_resource.clear()
+
+
+@pytest.fixture
+def make_user(workdir):
+    """创建用户数据目录，返回目录路径；bank_accounts / debts 为 {名称: 金额}"""
+
+    def make_user(username="alice", bank_accounts=(), debts=()):
+        data_dir = workdir / "user_data" / username
+        data_dir.mkdir(parents=True)
+        data = {
+            'transactions': [],
+            'bank_accounts': {name: {"余额": amount, "币种": "人民币", "创建时间": "2024-01-01 00:00:00",
+                                     "最后更新": "2024-01-01 00:00:00", "期初余额": amount}
+                              for name, amount in dict(bank_accounts).items()},
+            'debts': {name: {"总额": amount, "剩余": amount, "状态": "还款中", "币种": "人民币",
+                             "创建时间": "2024-01-01 00:00:00", "期初剩余": amount, "还款记录": []}
+                      for name, amount in dict(debts).items()},
+            'budgets': {},
+        }
+        (data_dir / "finance_data.json").write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        return data_dir
+
+    return make_user
+
+
+@pytest.fixture
+def run_session():
+    """在一个模拟的 Streamlit 会话中运行 script(*args)，返回 AppTest，可读取其 session_state
+
+    script 的源码会被单独执行，所需的模块要在函数内导入。
+    """
+
+    def run_session(script, *args, **kwargs):
+        at = AppTest.from_function(script, args=args, kwargs=kwargs, default_timeout=600)
+        at.run()
+        assert not at.exception, at.exception
+        return at
+
+    return run_session
+
+
+@pytest.fixture
+def open_app(workdir):
+    """以已登录的 username 打开 App.py，返回已运行一次的 AppTest"""
+    app_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "App.py")
+
+    def open_app(username="alice"):
+        at = AppTest.from_file(app_file, default_timeout=600)
+        at.session_state.logged_in = True
+        at.session_state.current_user = username
+        at.run()
+        assert not at.exception, at.exception
+        return at
+
+    return open_app
@@ -0,0 +1,19 @@
+"""银行卡页面"""
+
+
+def widget(widgets, label):
+    return next(w for w in widgets if w.label == label)
+
+
+def test_overdrawn_account_can_be_edited(workdir, make_user, open_app):
+    make_user("alice", {"卡A": -250.0})
+    at = open_app()
+    widget(at.radio, "页面").set_value("🏦 银行卡")
+    at.run()
+    assert not at.exception, at.exception
+
+    widget(at.number_input, "新余额").set_value(-100.0)
+    at.run()
+    assert not at.exception, at.exception
+    assert widget(at.radio, "选择调整方式").value == "直接设置新余额"
+    assert ("新余额", "¥-100.00") in [(m.label, m.value) for m in at.metric]
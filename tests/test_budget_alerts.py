@@ -0,0 +1,67 @@
+"""预算提醒：记账时增量检查阈值，保存时与其他会话的修改合并后重新检查"""
+
+
+def expense(amount):
+    return {'日期': '2024-05-10', '类型': '支出', '类别': '餐饮', '项目描述': '午饭', '金额': amount,
+            '支付方式': '现金', '对方账户': '', '币种': '人民币', '汇率': 1.0, '备注': ''}
+
+
+def seed(row):
+    import streamlit as st
+    import App
+
+    app = App.FinanceApp("alice")
+    st.session_state.budgets['2024-05'] = {'餐饮': {'预算金额': 20.0, '已用金额': 0, '币种': '人民币'}}
+    app.save_data()
+    app.refresh_budget_usage()
+    app.add_transaction(row)
+    app.save_data()
+
+
+def spend(row, concurrent=None):
+    """本会话记一笔支出并保存；concurrent 为其他会话在本会话加载之后、保存之前写入的支出"""
+    import os
+
+    import App
+
+    app = App.FinanceApp("alice")
+    if concurrent:
+        store = App.open_ledger_store(os.path.join("user_data", "alice"))
+        with store.locked():
+            store.load()
+            store.append([{'op': 'add', 'row': {App.ID_COLUMN: App.new_transaction_id(), **concurrent}}])
+    app.add_transaction(row)
+    app.save_data()
+
+
+def alerts(at):
+    return [(alert['阈值'], alert['已用金额']) for alert in at.session_state.budget_alerts_new]
+
+
+def test_crossing_raises_alert(workdir, make_user, run_session):
+    make_user("alice")
+    run_session(seed, expense(10.0))
+
+    at = run_session(spend, expense(7.0))
+    assert alerts(at) == [(80, 17.0)]
+    assert alerts(run_session(spend, expense(5.0))) == [(100, 22.0)]
+
+
+def test_merge_rechecks_crossings_with_merged_usage(workdir, make_user, run_session):
+    make_user("alice")
+    run_session(seed, expense(10.0))
+
+    # 另一个会话把已用金额从 10 推到 17（越过 80%，由它自己提醒）；本会话仍以 10 为基础加 5，
+    # 合并后为 22，应越过 100%
+    at = run_session(spend, expense(5.0), concurrent=expense(7.0))
+    assert at.session_state.budgets['2024-05']['餐饮']['已用金额'] == 22.0
+    assert alerts(at) == [(100, 22.0)]
+
+
+def test_merge_drops_alerts_already_crossed_by_other_session(workdir, make_user, run_session):
+    make_user("alice")
+    run_session(seed, expense(10.0))
+
+    # 本会话单独看是 10 -> 17 越过 80%，但另一个会话已经越过，合并后是 17 -> 24，越过的是 100% 和 120%
+    at = run_session(spend, expense(7.0), concurrent=expense(7.0))
+    assert alerts(at) == [(120, 24.0)]
@@ -0,0 +1,27 @@
+"""命令行批处理：python App.py export|reconcile|digest"""
+import os
+
+import App
+
+
+def test_reconcile_skips_missing_users(workdir, make_user, capsys):
+    make_user("alice", {"卡A": 100.0})
+
+    App.reconcile_cli(["-u", "ghost", "alice", "-j", "1"])
+    assert capsys.readouterr().out.splitlines() == ["跳过 ghost: 数据目录不存在", "alice: 一致"]
+    assert not (workdir / "user_data" / "ghost").exists()
+
+
+def test_export_skips_missing_users(workdir, make_user, capsys):
+    make_user("alice")
+
+    App.export_cli(["-u", "ghost", "alice"])
+    assert capsys.readouterr().out.splitlines() == [
+        "跳过 ghost: 数据目录不存在", f"已导出 {os.path.join('exports', 'alice_transactions.csv')}"]
+
+
+def test_digest_skips_missing_users(workdir, make_user, capsys):
+    make_user("alice")
+
+    App.digest_cli(["-u", "ghost", "alice"])
+    assert capsys.readouterr().out.splitlines() == ["跳过 ghost: 数据目录不存在"]
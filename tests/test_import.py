@@ -0,0 +1,96 @@
+"""批量导入：结果必须与逐笔添加相同"""
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+BANKS = {"卡A": 1000.0, "卡B": 200.0}
+DEBTS = {"信用卡": 300.0, "借款": 5000.0}
+
+
+def sample_rows(count, seed=0):
+    """收入、支出（含未指明债务的还款）、本人账户间和向他人的转账，混有三行无效数据"""
+    rng = np.random.default_rng(seed)
+    rows = pd.DataFrame({
+        '日期': pd.date_range('2024-01-01', periods=count, freq='7h').strftime('%Y-%m-%d'),
+        '类型': rng.choice(['收入', '支出', '转账'], count, p=[0.4, 0.4, 0.2]),
+        '类别': rng.choice(['餐饮', '交通', '还款'], count),
+        '项目描述': [f"第{i}笔" for i in range(count)],
+        '金额': rng.integers(1, 20000, count) / 100,
+        '支付方式': rng.choice(['卡A', '卡B', '现金'], count),
+        '对方账户': rng.choice(['卡A', '卡B', '某人', ''], count),
+    })
+    rows.loc[rows['类型'] == '转账', '类别'] = ''
+    rows.loc[(rows['类型'] == '转账') & (rows['支付方式'] == rows['对方账户']), '对方账户'] = '某人'
+    rows.loc[(rows['类型'] != '转账') & (rows['类别'] != '还款'), '对方账户'] = ''
+    rows.loc[3, '金额'] = -1
+    rows.loc[10, '日期'] = '不是日期'
+    rows.loc[20, '类型'] = '借入'
+    return rows
+
+
+def import_file(path):
+    import streamlit as st
+    import App
+
+    app = App.FinanceApp("alice")
+    st.session_state.result = app.import_transactions(path, chunksize=100)
+    app.save_data()
+
+
+def add_one_by_one(rows):
+    import App
+
+    app = App.FinanceApp("bob")
+    for row in rows:
+        app.add_transaction(dict(row, 币种="人民币", 汇率=1.0, 备注=""))
+    app.save_data()
+
+
+def load(username):
+    import App
+
+    App.FinanceApp(username)
+
+
+def ledger_state(at):
+    state = at.session_state
+    return ({name: info["余额"] for name, info in state.bank_accounts.items()},
+            {name: (info["剩余"], info["状态"]) for name, info in state.debts.items()},
+            state.monthly_cube.months, len(state.transactions))
+
+
+def test_import_matches_adding_one_by_one(workdir, make_user, run_session):
+    make_user("alice", BANKS, DEBTS)
+    make_user("bob", BANKS, DEBTS)
+    rows = sample_rows(500)
+    rows.to_csv("import.csv", index=False)
+
+    imported = run_session(import_file, "import.csv")
+    valid = rows.drop(index=[3, 10, 20])
+    assert imported.session_state.result == (len(valid), [4, 11, 21])
+
+    added = run_session(add_one_by_one, valid.to_dict('records'))
+    assert ledger_state(imported) == ledger_state(added)
+
+    # 丢弃进程内共享的账本快照，从磁盘重新加载的结果与导入时内存中的一致
+    st.cache_resource.clear()
+    assert ledger_state(run_session(load, "alice")) == ledger_state(imported)
+
+
+def test_import_requires_columns(workdir, make_user, run_session):
+    make_user("alice")
+    pd.DataFrame({'日期': ['2024-01-01'], '金额': [1]}).to_csv("import.csv", index=False)
+
+    def import_invalid(path):
+        import streamlit as st
+        import App
+
+        try:
+            App.FinanceApp("alice").import_transactions(path)
+        except ValueError as e:
+            st.session_state.error = str(e)
+
+    at = run_session(import_invalid, "import.csv")
+    assert at.session_state.error == "缺少必需的列: 类型, 支付方式"
+    assert len(at.session_state.transactions) == 0
+
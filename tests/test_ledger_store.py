@@ -0,0 +1,37 @@
+"""账本存储：JSON 快照加日志、SQLite 两种后端的公共行为"""
+import pytest
+
+import App
+
+ROW = {App.ID_COLUMN: "t1", '日期': '2024-01-01', '类型': '收入', '类别': '工资', '项目描述': '', '金额': 1.0,
+       '币种': '人民币', '支付方式': '现金', '对方账户': '', '汇率': 1.0, '备注': ''}
+
+
+@pytest.fixture(params=[App.LedgerJournal, App.SQLiteLedgerStore], ids=["json", "sqlite"])
+def stores(request, make_user):
+    """同一数据目录上的两个会话"""
+    data_dir = str(make_user("alice"))
+    sessions = [request.param(data_dir), request.param(data_dir)]
+    for store in sessions:
+        with store.locked():
+            store.load()
+    return sessions
+
+
+def test_append_nothing_is_a_no_op(stores):
+    writer, reader = stores
+    signature = writer.signature()
+    with writer.locked():
+        writer.append([])
+    assert writer.signature() == signature
+    with reader.locked():
+        assert reader.read_new_ops() == []
+
+
+def test_other_session_reads_appended_ops(stores):
+    writer, reader = stores
+    with writer.locked():
+        writer.append([{'op': 'add', 'row': ROW}])
+    with reader.locked():
+        assert [op['row'][App.ID_COLUMN] for op in reader.read_new_ops()] == ["t1"]
+        assert reader.read_new_ops() == []
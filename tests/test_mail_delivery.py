@@ -0,0 +1,158 @@
+"""后台邮件发送：用本地 aiosmtpd 服务器代替真实邮件服务器"""
+import socket
+import threading
+import time
+from email.mime.text import MIMEText
+
+import pytest
+
+controller = pytest.importorskip("aiosmtpd.controller")
+
+import App
+
+
+class RecordingHandler:
+    """记录收到的邮件；前 fail_first 封返回临时错误，模拟邮件服务器偶发故障；收件人为 nobody@ 时拒收"""
+
+    def __init__(self, fail_first=0):
+        self.fail_first = fail_first
+        self.messages = []
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith("nobody@"):
+            return "550 no such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.fail_first:
+            self.fail_first -= 1
+            return "451 try again later"
+        self.messages.append(envelope)
+        return "250 OK"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def smtp_server():
+    handler = RecordingHandler()
+    server = controller.Controller(handler, hostname="127.0.0.1", port=free_port())
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def config(smtp_server):
+    # 本地服务器不需要认证（未设置密码时不登录）
+    return {"smtp_server": smtp_server.hostname, "smtp_port": smtp_server.port, "sender_email": "app@example.com",
+            "sender_password": "", "use_ssl": False, "enable_tls": False}
+
+
+@pytest.fixture
+def worker():
+    """记录每次新建连接的发送线程，重试间隔缩短为毫秒级"""
+    connections = []
+
+    def connect(config):
+        connections.append(config)
+        return App.open_smtp_connection(config)
+
+    worker = App.MailDeliveryWorker(connect)
+    worker.BACKOFF_BASE = 0.01
+    worker.connections = connections
+    return worker
+
+
+def message(to="user@example.com", subject="测试"):
+    msg = MIMEText("正文", "plain", "utf-8")
+    msg["From"] = "app@example.com"
+    msg["To"] = to
+    msg["Subject"] = subject
+    return msg
+
+
+def test_delivers_queued_jobs_over_one_connection(smtp_server, config, worker):
+    jobs = [worker.submit(config, message(subject=f"第{i}封")) for i in range(3)]
+
+    assert all(job.wait(10) for job in jobs)
+    assert [job.status for job in jobs] == ["已完成"] * 3
+    assert [job.attempts for job in jobs] == [1, 1, 1]
+    assert len(smtp_server.handler.messages) == 3
+    assert len(worker.connections) == 1
+
+
+def test_connection_test_job(config, worker):
+    job = worker.submit(config)
+
+    assert job.wait(10)
+    assert job.done and job.error == ""
+
+
+def test_retries_temporary_failures(smtp_server, config, worker):
+    smtp_server.handler.fail_first = 2
+    job = worker.submit(config, message())
+
+    assert job.wait(10)
+    assert job.attempts == 3
+    assert len(smtp_server.handler.messages) == 1
+
+
+def test_fails_after_max_attempts(smtp_server, config, worker):
+    smtp_server.handler.fail_first = worker.MAX_ATTEMPTS
+    job = worker.submit(config, message())
+
+    assert not job.wait(10)
+    assert job.done and job.status == "失败"
+    assert job.attempts == worker.MAX_ATTEMPTS
+    assert "451" in job.error
+    assert smtp_server.handler.messages == []
+
+
+def test_permanent_error_is_not_retried(smtp_server, config, worker):
+    job = worker.submit(config, message(to="nobody@example.com"))
+
+    assert not job.wait(10)
+    assert job.status == "失败"
+    assert job.attempts == 1
+
+
+def test_reconnects_when_connection_was_dropped(smtp_server, config, worker):
+    assert worker.submit(config, message()).wait(10)
+    worker.server.close()  # 服务器断开了空闲连接
+
+    assert worker.submit(config, message()).wait(10)
+    assert len(worker.connections) == 2
+    assert len(smtp_server.handler.messages) == 2
+
+
+def test_full_queue_fails_job_immediately(config):
+    release = threading.Event()
+
+    def connect(config):
+        release.wait(10)
+        raise OSError("unreachable")
+
+    class SmallWorker(App.MailDeliveryWorker):
+        QUEUE_SIZE = 1
+        MAX_ATTEMPTS = 1
+
+    worker = SmallWorker(connect)
+    first = worker.submit(config, message())
+    deadline = time.monotonic() + 10
+    while first.status == "排队中" and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    queued = worker.submit(config, message())
+    rejected = worker.submit(config, message())
+    assert rejected.done and rejected.status == "失败"
+    assert not queued.done
+
+    release.set()
+    assert not first.wait(10) and not queued.wait(10)
+    assert "unreachable" in queued.error
@@ -0,0 +1,62 @@
+"""页面导航：每次只运行选中的页面，页面结果在账本不变时复用"""
+import pandas as pd
+
+
+def seed(path):
+    import App
+
+    app = App.FinanceApp("alice")
+    app.import_transactions(path)
+    app.save_data()
+
+
+def widget(widgets, label):
+    return next(w for w in widgets if w.label == label)
+
+
+def rerun(at):
+    at.run()
+    assert not at.exception, at.exception
+
+
+def goto(at, page):
+    widget(at.radio, "页面").set_value(page)
+    rerun(at)
+
+
+def cached_keys(at):
+    return [key[0] if isinstance(key, tuple) else key for key in at.session_state.section_cache['results']]
+
+
+def test_only_the_active_page_runs(workdir, make_user, run_session, open_app):
+    make_user("alice", {"卡A": 1000.0}, {"借款": 500.0})
+    pd.DataFrame({'日期': ['2024-01-01', '2024-01-02'], '类型': ['收入', '支出'], '类别': ['工资', '餐饮'],
+                  '金额': [100.0, 30.0], '支付方式': ['卡A', '卡A']}).to_csv("import.csv", index=False)
+    run_session(seed, "import.csv")
+
+    at = open_app()
+    assert widget(at.radio, "页面").value == "💰 添加交易"
+    assert cached_keys(at) == []
+    assert not at.get("plotly_chart")
+
+    goto(at, "📈 财务分析")
+    assert cached_keys(at) == ['analytics', 'net_worth']
+    figures = next(iter(at.session_state.section_cache['results'].values()))
+    assert at.get("plotly_chart")
+
+    # 其他控件引起的重跑直接复用上次的图表
+    rerun(at)
+    assert next(iter(at.session_state.section_cache['results'].values())) is figures
+
+    goto(at, "🏦 银行卡")
+    assert cached_keys(at) == ['analytics', 'net_worth', 'bank_charts']
+
+    # 账本变化后重新计算
+    goto(at, "💰 添加交易")
+    widget(at.number_input, "💰 金额").set_value(50.0)
+    widget(at.selectbox, "💳 支付方式").set_value("卡A")
+    widget(at.button, "✅ 添加交易").click()
+    rerun(at)
+    goto(at, "📈 财务分析")
+    assert cached_keys(at) == ['analytics', 'net_worth']
+    assert next(iter(at.session_state.section_cache['results'].values())) is not figures
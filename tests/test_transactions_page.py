@@ -0,0 +1,71 @@
+"""交易记录页：只格式化和发送当前页，编辑选择框只列出当前页"""
+import pandas as pd
+
+ROWS = 1000
+
+
+def seed(path):
+    import App
+
+    app = App.FinanceApp("alice")
+    app.import_transactions(path)
+    app.save_data()
+
+
+def widget(widgets, label):
+    return next(w for w in widgets if w.label == label)
+
+
+def rerun(at):
+    at.run()
+    assert not at.exception, at.exception
+
+
+def open_transactions(make_user, run_session, open_app):
+    make_user("alice", {"卡A": 0.0})
+    pd.DataFrame({
+        '日期': pd.date_range('2024-01-01', periods=ROWS, freq='h').strftime('%Y-%m-%d'),
+        '类型': '收入',
+        '类别': '工资',
+        '项目描述': [f"超市购物{i}" if i % 10 == 0 else f"第{i}笔" for i in range(ROWS)],
+        '金额': 1.0,
+        '支付方式': '卡A',
+    }).to_csv("import.csv", index=False)
+    run_session(seed, "import.csv")
+
+    at = open_app()
+    widget(at.radio, "页面").set_value("📊 交易记录")
+    rerun(at)
+    return at
+
+
+def test_only_the_current_page_is_sent(workdir, make_user, run_session, open_app):
+    at = open_transactions(make_user, run_session, open_app)
+
+    assert at.caption[0].value == f"共 {ROWS} 条记录，第 1/{ROWS // 20} 页（按日期倒序）"
+    assert len(at.dataframe[0].value) == 20
+    assert len(widget(at.selectbox, "选择要编辑的交易记录").options) == 20
+    # 按日期倒序，最后导入的在最前
+    assert at.dataframe[0].value['项目描述'].iloc[0] == f"第{ROWS - 1}笔"
+
+    widget(at.selectbox, "每页条数").set_value(100)
+    rerun(at)
+    widget(at.number_input, "页码").set_value(10)
+    rerun(at)
+    page = at.dataframe[0].value
+    assert len(page) == 100
+    assert list(page['项目描述'][:2]) == ["第99笔", "第98笔"]
+    options = widget(at.selectbox, "选择要编辑的交易记录").options
+    assert len(options) == 100 and options[0].startswith("901. ")
+
+
+def test_search_resets_to_first_page(workdir, make_user, run_session, open_app):
+    at = open_transactions(make_user, run_session, open_app)
+    widget(at.number_input, "页码").set_value(3)
+    rerun(at)
+
+    widget(at.text_input, "🔍 搜索").input("超市购物")
+    rerun(at)
+    assert at.caption[0].value == f"共 {ROWS // 10} 条记录，第 1/{ROWS // 10 // 20} 页（按日期倒序）"
+    assert widget(at.number_input, "页码").value == 1
+    assert list(at.dataframe[0].value['项目描述'][:2]) == [f"超市购物{ROWS - 10}", f"超市购物{ROWS - 20}"]
@@ -0,0 +1,37 @@
+"""用户目录：多个进程共享 users.json 和登录日志"""
+import App
+
+
+def user(email):
+    return {"password": "x", "email": email, "created_at": "2024-01-01T00:00:00", "last_login": None}
+
+
+def test_sees_logins_recorded_by_another_process(workdir):
+    first, second = App.UserDirectory(), App.UserDirectory()
+    first.add("alice", user("alice@example.com"))
+    assert second.get("alice")["last_login"] is None
+
+    first.record_login("alice")
+    assert second.get("alice")["last_login"] == first.get("alice")["last_login"]
+
+    # 写了一半的行等写完后再读
+    with open("login_log.jsonl", "a", encoding="utf-8") as f:
+        f.write('{"user": "alice", "at": "2030-01-01T00:00:00"')
+    assert second.get("alice")["last_login"] != "2030-01-01T00:00:00"
+    with open("login_log.jsonl", "a", encoding="utf-8") as f:
+        f.write('}\n')
+    assert second.get("alice")["last_login"] == "2030-01-01T00:00:00"
+
+
+def test_merged_log_is_read_from_the_start_again(workdir):
+    first, second = App.UserDirectory(), App.UserDirectory()
+    first.add("alice", user("alice@example.com"))
+    first.record_login("alice")
+    second.get("alice")
+
+    # 注册新用户时登录日志合并进 users.json 并清空
+    first.add("bob", user("bob@example.com"))
+    first.record_login("bob")
+    assert second.username_for_email("BOB@example.com") == "bob"
+    assert second.get("bob")["last_login"] == first.get("bob")["last_login"]
+    assert second.get("alice")["last_login"] == first.get("alice")["last_login"]